@@ -0,0 +1,420 @@
+#!/usr/bin/env python3
+"""Reproducible benchmarks for srp.
+
+This replaces the old test4.py through test7.py scripts, which compared
+tarfile, the BLOB format and the C extractor by hand.  Instead of timing
+bits and pieces, we generate a synthetic package payload with a controlled
+shape and run it through srp.build(), srp.install(), srp.query(),
+srp.action() (verify) and srp.uninstall() into a scratch --root, just like
+the real thing.
+
+The payload is generated from a random seed, so the same arguments always
+produce the same payload:
+
+  --files - Number of payload entries (regular files, hard links and
+      symlinks).
+
+  --dirs - Number of directories to spread them over (defaults to one per
+      20 files), nested at most --depth levels deep.
+
+  --min-size, --max-size - Regular file sizes are picked from a
+      log-uniform distribution between these (i.e., lots of small files
+      and a few big ones, like a real package).
+
+  --hardlinks, --symlinks - Fraction of entries that are hard links or
+      symlinks to other files in the payload.
+
+  --elf - Fraction of regular files that are ELF binaries (copies of a real
+      one, padded out to their size) instead of text.  These are what the
+      deps Feature has to go dig through.
+
+The scratch root gets a lib dir with (symlinks to) the host's copies of the
+libraries that ELF binary needs, so the deps Feature's install check has
+something to find.  To leave ELF parsing out of it, use --options=no_deps.
+
+Each phase runs in its own forked process, so we can report its peak RSS.
+The results are written as JSON:
+
+  {"params": {...}, "host": {...}, "import": {"seconds": ...},
+   "phases": {"install": {"seconds": ..., "files_per_sec": ...,
+                          "mb_per_sec": ..., "peak_rss_kb": ...,
+                          "stages": {"install_iter": ..., ...}}, ...}}
+
+The per-stage timings come from srp.profiler.times.  If --baseline is given,
+each phase's time and peak RSS are compared against the baseline file (e.g.,
+from a previous run w/ --output) and anything more than --threshold worse
+is flagged as a regression, in which case we exit non-zero.
+
+Example:
+
+  PYTHONPATH=. ./benchmark.py --files 5000 --output base.json
+  ... hack hack hack ...
+  PYTHONPATH=. ./benchmark.py --files 5000 --baseline base.json
+"""
+
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import srp
+import srp.elf
+
+
+# the phases we run, in order
+phases = ["build", "install", "query", "verify", "uninstall"]
+
+# name (and fullname) of the synthetic package
+pkgname = "srp-bench"
+pkgfullname = pkgname + "-1.0-1"
+
+notes_template = """\
+[header]
+name = {}
+version = 1.0
+pkg_rev = 1
+description = Synthetic payload for benchmark.py.
+
+[script]
+%%BUFFER_BEGIN%%
+#!/bin/sh
+cp -a "$SOURCE_DIR"/payload/. "$PAYLOAD_DIR"/ || exit 1
+%%BUFFER_END%%
+"""
+
+words = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do"
+         " eiusmod tempor incididunt ut labore et dolore magna aliqua").split()
+
+
+def elf_template():
+    """Returns the path of the host's ELF file we copy for the payload's
+    binaries.
+
+    """
+    return os.path.realpath(shutil.which("true") or sys.executable)
+
+
+def seed_root(root):
+    """Creates scratch root dir `root' with a lib dir containing symlinks to
+    the host's copies of the libraries needed by elf_template() (i.e., the
+    deps the deps Feature will have to find at install time).
+
+    """
+    libdir = os.path.join(root, "lib")
+    os.makedirs(libdir)
+    info = srp.elf.read(elf_template())
+    if not info:
+        return
+    host = srp.features.load_feature("deps").LibraryIndex("/")
+    host.scan()
+    for x in info.needed:
+        path = host.lookup(info.file_format, x)
+        if path:
+            os.symlink(os.path.realpath(path), os.path.join(libdir, x))
+
+
+def gen_payload(args, dest):
+    """Populates directory `dest' according to the payload shape in `args'.
+    Returns a dict describing what got created.
+
+    """
+    rng = random.Random(args.seed)
+
+    # a chunk of text to take file contents from
+    text = " ".join(rng.choice(words) for x in range(16384)).encode()
+
+    def fill(size):
+        start = rng.randrange(len(text))
+        return (text * (size // len(text) + 2))[start:start+size]
+
+    # a real ELF file to base our binaries on
+    with open(elf_template(), "rb") as f:
+        elf = f.read()
+
+    # directory tree
+    dirs = [("usr", 1)]
+    ndirs = args.dirs if args.dirs is not None else max(1, args.files // 20)
+    for i in range(ndirs - 1):
+        parent, depth = rng.choice(dirs)
+        if depth >= args.depth:
+            parent, depth = dirs[0]
+        dirs.append((os.path.join(parent, "d{}".format(i)), depth + 1))
+    for d, depth in dirs:
+        os.makedirs(os.path.join(dest, d))
+
+    stats = {"dirs": len(dirs), "files": 0, "elf": 0, "hardlinks": 0,
+             "symlinks": 0, "bytes": 0}
+    regular = []
+    lo = math.log(args.min_size)
+    hi = math.log(args.max_size)
+    for i in range(args.files):
+        d = rng.choice(dirs)[0]
+        x = rng.random()
+        if regular and x < args.symlinks:
+            target = rng.choice(regular)
+            path = os.path.join(d, "s{}".format(i))
+            os.symlink(os.path.relpath(target, d),
+                       os.path.join(dest, path))
+            stats["symlinks"] += 1
+            continue
+        if regular and x < args.symlinks + args.hardlinks:
+            target = rng.choice(regular)
+            path = os.path.join(d, "h{}".format(i))
+            os.link(os.path.join(dest, target), os.path.join(dest, path))
+            stats["hardlinks"] += 1
+            continue
+
+        size = int(math.exp(rng.uniform(lo, hi)))
+        if rng.random() < args.elf:
+            path = os.path.join(d, "b{}".format(i))
+            # NOTE: Padding keeps them all different from each other, and
+            #       the ELF parser doesn't mind.
+            buf = elf + fill(max(0, size - len(elf))) + str(i).encode()
+            stats["elf"] += 1
+        else:
+            path = os.path.join(d, "f{}.txt".format(i))
+            buf = fill(size)
+        with open(os.path.join(dest, path), "wb") as f:
+            f.write(buf)
+        regular.append(path)
+        stats["files"] += 1
+        stats["bytes"] += len(buf)
+
+    return stats
+
+
+def run_phase(phase, args, workdir, conn):
+    """Runs benchmark `phase' (in a forked child), sending a dict of results
+    back via `conn'.
+
+    """
+    # NOTE: srp is pretty chatty, and we don't want to benchmark the
+    #       terminal.
+    if not args.verbose:
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, 1)
+        os.dup2(devnull, 2)
+        os.close(devnull)
+
+    os.chdir(workdir)
+    srp.work = srp.features.WorkBag()
+    srp.params.root = os.path.join(workdir, "root")
+    srp.params.options = args.options.split(",") if args.options else []
+    srp.profiler.times.clear()
+
+    t = time.time()
+    if phase == "build":
+        srp.params.build = srp.BuildParameters(
+            os.path.join(workdir, "src", "bench.notes"))
+        srp.build()
+    elif phase == "install":
+        srp.params.install = srp.InstallParameters(
+            srp.utils.expand_path(os.path.join(workdir,
+                                               pkgfullname + ".*.brp")))
+        srp.install()
+    elif phase == "query":
+        srp.params.query = srp.QueryParameters(["info", "files"],
+                                               {"pkg": pkgname})
+        srp.query()
+    elif phase == "verify":
+        srp.params.action = srp.ActionParameters(["verify"],
+                                                 {"pkg": pkgname})
+        srp.action()
+    elif phase == "uninstall":
+        srp.params.uninstall = srp.UninstallParameters(pkgname)
+        srp.uninstall()
+    seconds = time.time() - t
+
+    shutil.rmtree(srp.work.topdir, ignore_errors=True)
+    conn.send({"seconds": seconds,
+               "peak_rss_kb": resource.getrusage(
+                   resource.RUSAGE_SELF).ru_maxrss,
+               "stages": dict(srp.profiler.times)})
+    conn.close()
+
+
+def import_time(repeat=5):
+    """Returns the best time (in seconds) it takes to import srp in a new
+    interpreter, minus the interpreter's own startup time.
+
+    """
+    def best(cmd):
+        times = []
+        for i in range(repeat):
+            t = time.time()
+            subprocess.check_call([sys.executable, "-c", cmd])
+            times.append(time.time() - t)
+        return min(times)
+    return max(0.0, best("import srp") - best("pass"))
+
+
+def run(args):
+    """Runs all the benchmarks, returns the results dict."""
+    workdir = tempfile.mkdtemp(prefix="srp-bench-", dir=args.workdir)
+    ctx = multiprocessing.get_context("fork")
+    try:
+        src = os.path.join(workdir, "src")
+        os.makedirs(src)
+        with open(os.path.join(src, "bench.notes"), "w") as f:
+            f.write(notes_template.format(pkgname))
+        payload = gen_payload(args, os.path.join(src, "payload"))
+        seed_root(os.path.join(workdir, "root"))
+
+        results = {"params": {k: v for k, v in vars(args).items()
+                              if k not in ("output", "baseline", "verbose",
+                                           "workdir", "threshold")},
+                   "host": {"python": platform.python_version(),
+                            "machine": platform.machine(),
+                            "cpus": os.cpu_count(),
+                            "srp": srp.config.version},
+                   "payload": payload,
+                   "import": {"seconds": import_time()},
+                   "phases": {}}
+
+        entries = (payload["files"] + payload["hardlinks"]
+                   + payload["symlinks"])
+        for phase in phases:
+            best = None
+            for i in range(args.repeat):
+                # every run of a phase needs the same starting point
+                if i and phase in ("install", "uninstall"):
+                    shutil.rmtree(os.path.join(workdir, "root"))
+                    seed_root(os.path.join(workdir, "root"))
+                    if phase == "uninstall":
+                        _install(ctx, args, workdir)
+                r, w = ctx.Pipe(duplex=False)
+                p = ctx.Process(target=run_phase,
+                                args=(phase, args, workdir, w))
+                p.start()
+                w.close()
+                try:
+                    x = r.recv()
+                except EOFError:
+                    raise Exception("{} phase failed (exit status {}), try"
+                                    " --verbose".format(phase, p.exitcode))
+                p.join()
+                if best is None or x["seconds"] < best["seconds"]:
+                    best = x
+
+            best["files_per_sec"] = entries / best["seconds"]
+            best["mb_per_sec"] = payload["bytes"] / 2**20 / best["seconds"]
+            results["phases"][phase] = best
+            print("{:10} {:8.3f}s {:10.0f} files/s {:8.2f} MB/s {:8} KB"
+                  " peak RSS".format(phase, best["seconds"],
+                                     best["files_per_sec"],
+                                     best["mb_per_sec"],
+                                     best["peak_rss_kb"]))
+        print("{:10} {:8.3f}s".format("import",
+                                      results["import"]["seconds"]))
+        return results
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def _install(ctx, args, workdir):
+    """Re-installs the package (e.g., before uninstalling it again)."""
+    r, w = ctx.Pipe(duplex=False)
+    p = ctx.Process(target=run_phase, args=("install", args, workdir, w))
+    p.start()
+    w.close()
+    r.recv()
+    p.join()
+
+
+def compare(results, baseline, threshold):
+    """Compares `results' to `baseline' (both results dicts), printing a
+    report.  Returns the list of regressions.
+
+    """
+    regressions = []
+    if results["params"] != baseline["params"]:
+        print("WARNING: baseline was run with different parameters:",
+              baseline["params"])
+
+    rows = [("import", "seconds", results["import"],
+             baseline.get("import"))]
+    for phase in phases:
+        for metric in ("seconds", "peak_rss_kb"):
+            rows.append((phase, metric, results["phases"][phase],
+                         baseline["phases"].get(phase)))
+
+    print("{:10} {:12} {:>12} {:>12} {:>8}".format(
+        "phase", "metric", "baseline", "now", "change"))
+    for phase, metric, now, base in rows:
+        if not base or not base.get(metric):
+            continue
+        change = now[metric] / base[metric] - 1
+        flag = ""
+        if change > threshold:
+            flag = "  <-- REGRESSION"
+            regressions.append((phase, metric, change))
+        print("{:10} {:12} {:12.3f} {:12.3f} {:+7.1%}{}".format(
+            phase, metric, base[metric], now[metric], change, flag))
+    return regressions
+
+
+def main():
+    p = argparse.ArgumentParser(
+        description="Benchmark srp with a synthetic package.")
+    p.add_argument("--files", type=int, default=2000,
+                   help="number of payload entries (default: %(default)s)")
+    p.add_argument("--dirs", type=int, default=None,
+                   help="number of directories (default: files/20)")
+    p.add_argument("--depth", type=int, default=4,
+                   help="max directory depth (default: %(default)s)")
+    p.add_argument("--min-size", type=int, default=64,
+                   help="smallest regular file (default: %(default)s)")
+    p.add_argument("--max-size", type=int, default=65536,
+                   help="biggest regular file (default: %(default)s)")
+    p.add_argument("--hardlinks", type=float, default=0.02,
+                   help="fraction of hard links (default: %(default)s)")
+    p.add_argument("--symlinks", type=float, default=0.05,
+                   help="fraction of symlinks (default: %(default)s)")
+    p.add_argument("--elf", type=float, default=0.1,
+                   help="fraction of regular files that are ELF"
+                   " (default: %(default)s)")
+    p.add_argument("--seed", type=int, default=0,
+                   help="random seed for the payload (default: %(default)s)")
+    p.add_argument("--options", default="",
+                   help="srp --options for each phase (default: none, e.g."
+                   " no_deps to skip the ELF parsing)")
+    p.add_argument("--repeat", type=int, default=1,
+                   help="run each phase this many times, keeping the best"
+                   " (default: %(default)s)")
+    p.add_argument("--workdir", default=None,
+                   help="where to create the scratch dir (default: TMPDIR)")
+    p.add_argument("--output", metavar="JSON",
+                   help="write results to this file")
+    p.add_argument("--baseline", metavar="JSON",
+                   help="compare results to this file")
+    p.add_argument("--threshold", type=float, default=0.1,
+                   help="how much worse than --baseline counts as a"
+                   " regression (default: %(default)s)")
+    p.add_argument("-v", "--verbose", action="store_true",
+                   help="don't hide srp's output")
+    args = p.parse_args()
+
+    results = run(args)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""Checks that importing srp stays cheap.
+
+Every srp invocation (even srp --help) starts by importing srp, so
+anything slow to import that isn't needed by most invocations should be
+imported by the code that needs it instead (see srp.features.feature_index
+and the imports in srp.core).  This fails (i.e., exits non-zero) if:
+
+  - any of the --forbid modules are in sys.modules after import srp, or
+
+  - the best of --repeat imports of srp (in a fresh interpreter each time,
+    w/ byte-compiled modules) takes longer than --budget seconds.
+
+The module check is the one to trust, since the timing depends on the
+machine.  It's run by make check.
+
+Example:
+
+  PYTHONPATH=. ./importcheck.py
+  PYTHONPATH=. ./importcheck.py --budget 0.2 --forbid subprocess
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+
+# modules that have no business being imported just because srp was
+forbidden = ["subprocess", "tarfile", "multiprocessing", "socket",
+             "platform", "argparse", "srp.cli", "srp.bdiff",
+             "srp.dbserver"]
+
+check_code = """\
+import json, sys, time
+t = time.perf_counter()
+import srp
+t = time.perf_counter() - t
+print(json.dumps({"seconds": t, "modules": sorted(sys.modules)}))
+"""
+
+
+def import_srp(env):
+    """Imports srp in a new interpreter, returns (seconds, list of module
+    names in sys.modules).
+
+    """
+    out = subprocess.check_output([sys.executable, "-c", check_code],
+                                  env=env)
+    ret = json.loads(out.decode())
+    return ret["seconds"], ret["modules"]
+
+
+def main():
+    p = argparse.ArgumentParser(
+        description="Check that importing srp stays cheap.")
+    p.add_argument("--budget", type=float, default=0.05,
+                   help="max seconds import srp may take (default:"
+                   " %(default)s)")
+    p.add_argument("--repeat", type=int, default=5,
+                   help="import this many times, keeping the best (default:"
+                   " %(default)s)")
+    p.add_argument("--forbid", default=",".join(forbidden),
+                   help="comma separated list of modules import srp must not"
+                   " import (default: %(default)s)")
+    args = p.parse_args()
+
+    # NOTE: We want the byte-compiled modules (like an installed srp would
+    #       have), but we don't want to litter the source tree with them.
+    with tempfile.TemporaryDirectory(prefix="srp-importcheck-") as tmp:
+        env = dict(os.environ)
+        env.pop("PYTHONDONTWRITEBYTECODE", None)
+        env["PYTHONPYCACHEPREFIX"] = tmp
+        import_srp(env)
+        results = [import_srp(env) for i in range(args.repeat)]
+
+    failed = False
+    modules = results[0][1]
+    for x in args.forbid.split(","):
+        if x and x in modules:
+            print("FAIL: import srp imports {}".format(x))
+            failed = True
+
+    seconds = min(x[0] for x in results)
+    if seconds > args.budget:
+        print("FAIL: import srp takes {:.3f}s (budget is {:.3f}s)".format(
+            seconds, args.budget))
+        failed = True
+    else:
+        print("import srp takes {:.3f}s (budget is {:.3f}s)".format(
+            seconds, args.budget))
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
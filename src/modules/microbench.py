@@ -0,0 +1,547 @@
+#!/usr/bin/env python3
+"""Micro-benchmarks for srp's hot paths.
+
+benchmark.py times whole srp runs, which tells us when something got slower
+but not what.  These time the individual pieces those runs spend their time
+in, each at a range of sizes, so that any change to them can come with
+before and after numbers:
+
+  manifest_setitem - Manifest.__setitem__, adding each entry of an N file
+      payload (in the order Manifest.fromdir would).
+
+  manifest_fromdir - Manifest.fromdir() on an N file payload.
+
+  blob_fromfile - BlobFile.fromfile() (i.e., unpickling the manifest) of an
+      N file BLOB.
+
+  extract_py, extract_c - BlobFile.extract() of each entry in an N file
+      BLOB, using the pure Python and C copy routines.
+
+  perms_getitem - PermsList.__getitem__ for each of N filenames, against a
+      typical set of perms rules.
+
+  stage_sort - get_function_list() for the install stage w/ N (synthetic)
+      features enabled, on top of the default ones.
+
+  db_register - srp.db.register() of N packages.
+
+  db_commit, db_load - srp.db.commit() and srp.db.load() of a db w/ N
+      packages.
+
+  db_lookup_by_name - srp.db.lookup_by_name() of 100 packages in a db w/ N
+      packages.
+
+Each benchmark is run at each size in its own forked process, so that
+state left behind by one (e.g., a loaded db or registered features) can't
+affect the next.  The setup isn't timed, and of --repeat timed runs we keep
+the best.  Anything that takes longer than --timeout seconds (setup
+included) gets killed, and the bigger sizes of that benchmark are skipped
+(e.g., Manifest.__setitem__ is quadratic, so manifest_setitem and
+manifest_fromdir don't finish at 100k files).
+
+NOTE: The synthetic db packages share everything but their header and
+      manifest (3 entries each), so the db is a lot smaller than a real one
+      w/ the same number of packages.  It's the per-package overhead we're
+      after.
+
+The results are written as JSON:
+
+  {"params": {...}, "host": {...},
+   "results": {"manifest_setitem": {"10": {"ops": ..., "seconds": ...,
+                                           "usec_per_op": ...},
+                                    "100000": {"timeout": ...}, ...}, ...}}
+
+If --baseline is given, each result is compared against the baseline file
+(e.g., from a previous run w/ --output) and anything more than --threshold
+slower is flagged as a regression, in which case we exit non-zero.
+
+Example:
+
+  PYTHONPATH=. ./microbench.py --output base.json
+  ... hack hack hack ...
+  PYTHONPATH=. ./microbench.py --only manifest,blob --baseline base.json
+"""
+
+import argparse
+import copy
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+
+import srp
+import srp.features.perms
+
+
+# files per directory in generated payloads
+files_per_dir = 20
+
+# top-level directory of generated payloads
+topdir = "usr/share/srp-micro"
+
+notes_template = """\
+[header]
+name = srp-micro
+version = 1.0
+pkg_rev = 1
+description = Synthetic package for microbench.py.
+
+[script]
+%%BUFFER_BEGIN%%
+#!/bin/sh
+exit 0
+%%BUFFER_END%%
+"""
+
+perms_rules = r"""
+/usr/bin/.*:user=root,group=root,mode=755
+/usr/sbin/.*:user=root,group=root,mode=700
+/usr/lib/.*\.so(\.[0-9]+)*$:mode=755
+/etc/.*\.conf$:mode=644
+/var/named:user=named,group=named,mode_set=384,mode_unset=63,recursive=true
+/usr/share/srp-micro/d0000[0-4]:user=nobody,group=nogroup,recursive=true
+.*\.key$:mode_unset=63
+"""
+
+
+def gen_names(n):
+    """Returns a sorted list of (name, isdir) tuples for an `n' file
+    payload, w/ files_per_dir files in each directory.  Names are relative
+    (like TarInfo names).
+
+    """
+    ret = [("usr", True), ("usr/share", True), (topdir, True)]
+    for d in range((n + files_per_dir - 1) // files_per_dir):
+        dname = "{}/d{:05}".format(topdir, d)
+        ret.append((dname, True))
+        for i in range(d * files_per_dir, min(n, (d + 1) * files_per_dir)):
+            ret.append(("{}/f{:06}".format(dname, i), False))
+    return ret
+
+
+def gen_tinfo(name, isdir, size=0):
+    """Returns a TarInfo for a directory or regular file, like the ones in
+    a real manifest.
+
+    """
+    x = tarfile.TarInfo(name)
+    if isdir:
+        x.type = tarfile.DIRTYPE
+        x.mode = 0o755
+    else:
+        x.size = size
+        x.mode = 0o644
+    x.mtime = 1000000000
+    return x
+
+
+def gen_payload(n, dest, seed=0):
+    """Populates directory `dest' w/ an `n' file payload of small files (it's
+    the per-file overhead we're after).
+
+    """
+    rng = random.Random(seed)
+    for name, isdir in gen_names(n):
+        path = os.path.join(dest, name)
+        if isdir:
+            os.makedirs(path)
+            continue
+        with open(path, "wb") as f:
+            f.write(rng.randbytes(rng.randrange(1024)))
+
+
+def scan(payload_dir):
+    """Returns a Manifest for `payload_dir' like Manifest.fromdir() does, but
+    w/out going through Manifest.__setitem__ (which is too slow to use for
+    setup at the bigger sizes, and gets timed by manifest_setitem anyway).
+
+    """
+    m = srp.blob.Manifest()
+    m.payload_dir = os.path.abspath(payload_dir)
+    tar = tarfile.open("tar", fileobj=tempfile.TemporaryFile(), mode="w")
+    for root, dirs, files in os.walk(payload_dir):
+        for x in dirs + files:
+            realname = os.path.join(root, x)
+            t = tar.gettarinfo(realname, realname[len(payload_dir):])
+            t.uid = 0
+            t.gid = 0
+            del(t.tarfile)
+            m.data["/" + t.name] = {"tinfo": t}
+    m.sortedkeys = sorted(m.data)
+    return m
+
+
+def make_blob(n, workdir):
+    """Writes out an `n' file BLOB, returns its filename."""
+    payload = os.path.join(workdir, "payload")
+    gen_payload(n, payload)
+    blob = srp.blob.BlobFile()
+    blob.fname = os.path.join(workdir, "BLOB")
+    blob.manifest = scan(payload)
+    blob.tofile()
+    return blob.fname
+
+
+def timed(func):
+    """Returns a function that calls `func' and returns how long it took."""
+    def wrapper(i):
+        t = time.perf_counter()
+        func(i)
+        return time.perf_counter() - t
+    return wrapper
+
+
+# Each bench_* function does the setup for its benchmark at size `n' (using
+# scratch directory `workdir') and returns (ops, run).  ops is the number of
+# operations being timed, and run(i) does timed run number i and returns how
+# many seconds it took.
+
+def bench_manifest_setitem(n, workdir):
+    items = [("/" + name, {"tinfo": gen_tinfo(name, isdir)})
+             for name, isdir in gen_names(n)]
+
+    @timed
+    def run(i):
+        m = srp.blob.Manifest()
+        for k, v in items:
+            m[k] = v
+
+    return len(items), run
+
+
+def bench_manifest_fromdir(n, workdir):
+    payload = os.path.join(workdir, "payload")
+    gen_payload(n, payload)
+    return len(gen_names(n)), timed(
+        lambda i: srp.blob.Manifest.fromdir(payload))
+
+
+def bench_blob_fromfile(n, workdir):
+    fname = make_blob(n, workdir)
+
+    @timed
+    def run(i):
+        srp.blob.BlobFile.fromfile(fname).fobj.close()
+
+    return len(gen_names(n)), run
+
+
+def _bench_extract(n, workdir, c):
+    blob = srp.blob.BlobFile.fromfile(make_blob(n, workdir))
+    order = blob.manifest.install_order()
+
+    def run(i):
+        dest = os.path.join(workdir, "root{}".format(i))
+        t = time.perf_counter()
+        # NOTE: We have to pass c positionally, since extract's __c arg
+        #       gets its name mangled.
+        with blob.context(dest) as ctx:
+            for f in order:
+                blob.extract(f, dest, c, ctx)
+        t = time.perf_counter() - t
+        shutil.rmtree(dest)
+        return t
+
+    return len(order), run
+
+
+def bench_extract_py(n, workdir):
+    return _bench_extract(n, workdir, False)
+
+
+def bench_extract_c(n, workdir):
+    return _bench_extract(n, workdir, True)
+
+
+def bench_perms_getitem(n, workdir):
+    perms = srp.features.perms.PermsList(perms_rules)
+    names = ["/" + name for name, isdir in gen_names(n) if not isdir]
+
+    @timed
+    def run(i):
+        for x in names:
+            perms[x]
+
+    return len(names), run
+
+
+def bench_stage_sort(n, workdir):
+    # NOTE: Each one comes after core (like most real features do) and
+    #       optionally after the one before it, so the sort has something
+    #       to chew on.
+    names = []
+    for i in range(n):
+        name = "micro{:06}".format(i)
+        pre_reqs = ["core"]
+        if i:
+            pre_reqs.append("?" + names[-1])
+        srp.features.register_feature(srp.features.feature_struct(
+            name, "microbench.py synthetic feature",
+            install=srp.features.stage_struct(name, None, pre_reqs, [])))
+        names.append(name)
+    random.Random(0).shuffle(names)
+    features = srp.features.default_features + names
+
+    # NOTE: This imports the modules for the default features, which we
+    #       don't want to time.
+    srp.features.get_function_list("install", features)
+
+    return len(names), timed(
+        lambda i: srp.features.get_function_list("install", features))
+
+
+def gen_packages(n, workdir):
+    """Returns a list of `n' srp.db.InstalledPackage instances, each w/ its
+    own name and a few files in its own directory.
+
+    """
+    # NOTE: NotesFile checks that the source dir is there, so we need
+    #       srp.params.build.
+    fname = os.path.join(workdir, "micro.notes")
+    with open(fname, "w") as f:
+        f.write(notes_template)
+    srp.params.build = srp.BuildParameters(fname)
+    with open(fname, "rb") as f:
+        template = srp.notes.NotesFile(f)
+    ret = []
+    for i in range(n):
+        notes = copy.copy(template)
+        notes.header = copy.copy(template.header)
+        notes.header.name = "srp-micro-{:06}".format(i)
+        notes.header.fullname = "{}-{}-{}".format(notes.header.name,
+                                                  notes.header.version,
+                                                  notes.header.pkg_rev)
+        m = srp.blob.Manifest()
+        dname = "{}/{}".format(topdir, notes.header.name)
+        m["/" + dname] = {"tinfo": gen_tinfo(dname, True)}
+        for x in ("a", "b"):
+            fname = "{}/{}".format(dname, x)
+            m["/" + fname] = {"tinfo": gen_tinfo(fname, False, 100)}
+        ret.append(srp.db.InstalledPackage(notes, m))
+    return ret
+
+
+def gen_db(n, workdir, commit=True):
+    """Registers `n' packages in a new db under `workdir' (committing it, if
+    `commit' is set).  Returns the list of packages.
+
+    """
+    pkgs = gen_packages(n, workdir)
+    srp.params.root = os.path.join(workdir, "root")
+    srp.db.load()
+    for p in pkgs:
+        srp.db.register(p)
+    if commit:
+        srp.db.commit()
+    return pkgs
+
+
+def bench_db_register(n, workdir):
+    pkgs = gen_packages(n, workdir)
+
+    def run(i):
+        # every run gets a fresh (empty) db
+        srp.params.root = os.path.join(workdir, "root{}".format(i))
+        srp.db.load()
+        t = time.perf_counter()
+        for p in pkgs:
+            srp.db.register(p)
+        return time.perf_counter() - t
+
+    return n, run
+
+
+def bench_db_commit(n, workdir):
+    gen_db(n, workdir, commit=False)
+    return n, timed(lambda i: srp.db.commit())
+
+
+def bench_db_load(n, workdir):
+    gen_db(n, workdir)
+
+    def run(i):
+        srp.db.unload()
+        t = time.perf_counter()
+        srp.db.load()
+        return time.perf_counter() - t
+
+    return n, run
+
+
+def bench_db_lookup_by_name(n, workdir):
+    pkgs = gen_db(n, workdir, commit=False)
+    names = [p.notes.header.name for p in pkgs[::max(1, n // 100)]]
+
+    @timed
+    def run(i):
+        for x in names:
+            srp.db.lookup_by_name(x)
+
+    return len(names), run
+
+
+# all the benchmarks, in the order we run them
+benchmarks = ["manifest_setitem", "manifest_fromdir", "blob_fromfile",
+              "extract_py", "extract_c", "perms_getitem", "stage_sort",
+              "db_register", "db_commit", "db_load", "db_lookup_by_name"]
+
+
+def run_one(name, n, args, workdir, conn):
+    """Runs benchmark `name' at size `n' (in a forked child), sending a dict
+    of results back via `conn'.
+
+    """
+    # NOTE: srp is pretty chatty, and we don't want to benchmark the
+    #       terminal.
+    if not args.verbose:
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, 1)
+        os.dup2(devnull, 2)
+        os.close(devnull)
+
+    os.chdir(workdir)
+    ops, run = globals()["bench_" + name](n, workdir)
+    seconds = min(run(i) for i in range(args.repeat))
+    conn.send({"ops": ops, "seconds": seconds,
+               "usec_per_op": seconds / ops * 1e6})
+    conn.close()
+
+
+def run(args):
+    """Runs all the selected benchmarks, returns the results dict."""
+    workdir = tempfile.mkdtemp(prefix="srp-micro-", dir=args.workdir)
+    ctx = multiprocessing.get_context("fork")
+    results = {"params": {"sizes": args.sizes, "repeat": args.repeat},
+               "host": {"python": platform.python_version(),
+                        "machine": platform.machine(),
+                        "cpus": os.cpu_count(),
+                        "srp": srp.config.version},
+               "results": {}}
+    try:
+        for name in args.only:
+            results["results"][name] = {}
+            for n in args.sizes:
+                wd = os.path.join(workdir, "{}-{}".format(name, n))
+                os.makedirs(wd)
+                r, w = ctx.Pipe(duplex=False)
+                p = ctx.Process(target=run_one, args=(name, n, args, wd, w))
+                p.start()
+                w.close()
+                if r.poll(args.timeout):
+                    try:
+                        x = r.recv()
+                    except EOFError:
+                        p.join()
+                        raise Exception("{} failed at {} (exit status {}),"
+                                        " try --verbose".format(
+                                            name, n, p.exitcode))
+                else:
+                    p.kill()
+                    x = {"timeout": args.timeout}
+                p.join()
+                shutil.rmtree(wd, ignore_errors=True)
+
+                results["results"][name][str(n)] = x
+                if "timeout" in x:
+                    print("{:18} {:>7} timed out after {}s, skipping bigger"
+                          " sizes".format(name, n, args.timeout))
+                    break
+                print("{:18} {:>7} {:10.4f}s {:10.2f} usec/op".format(
+                    name, n, x["seconds"], x["usec_per_op"]))
+        return results
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def compare(results, baseline, threshold):
+    """Compares `results' to `baseline' (both results dicts), printing a
+    report.  Returns the list of regressions.
+
+    """
+    regressions = []
+    if results["params"] != baseline["params"]:
+        print("WARNING: baseline was run with different parameters:",
+              baseline["params"])
+
+    print("{:18} {:>7} {:>12} {:>12} {:>8}".format(
+        "benchmark", "size", "baseline", "now", "change"))
+    for name, sizes in results["results"].items():
+        for n, now in sizes.items():
+            base = baseline["results"].get(name, {}).get(n)
+            if not base or "timeout" in base:
+                continue
+            if "timeout" in now:
+                regressions.append((name, n, None))
+                print("{:18} {:>7} {:11.4f}s {:>12}  <-- REGRESSION".format(
+                    name, n, base["seconds"], "timeout"))
+                continue
+            change = now["seconds"] / base["seconds"] - 1
+            flag = ""
+            if change > threshold:
+                flag = "  <-- REGRESSION"
+                regressions.append((name, n, change))
+            print("{:18} {:>7} {:11.4f}s {:11.4f}s {:+7.1%}{}".format(
+                name, n, base["seconds"], now["seconds"], change, flag))
+    return regressions
+
+
+def main():
+    p = argparse.ArgumentParser(
+        description="Micro-benchmark srp's hot paths.")
+    p.add_argument("--sizes", default="10,1000,100000",
+                   help="comma separated list of sizes to run each benchmark"
+                   " at (default: %(default)s)")
+    p.add_argument("--only", default=None,
+                   help="comma separated list of benchmarks (or prefixes,"
+                   " like db) to run (default: all of them: {})".format(
+                       ", ".join(benchmarks)))
+    p.add_argument("--repeat", type=int, default=3,
+                   help="time each benchmark this many times, keeping the"
+                   " best (default: %(default)s)")
+    p.add_argument("--timeout", type=float, default=120,
+                   help="seconds before giving up on a benchmark"
+                   " (default: %(default)s)")
+    p.add_argument("--workdir", default=None,
+                   help="where to create the scratch dir (default: TMPDIR)")
+    p.add_argument("--output", metavar="JSON",
+                   help="write results to this file")
+    p.add_argument("--baseline", metavar="JSON",
+                   help="compare results to this file")
+    p.add_argument("--threshold", type=float, default=0.1,
+                   help="how much slower than --baseline counts as a"
+                   " regression (default: %(default)s)")
+    p.add_argument("-v", "--verbose", action="store_true",
+                   help="don't hide srp's output")
+    args = p.parse_args()
+
+    args.sizes = [int(x) for x in args.sizes.split(",")]
+    if args.only:
+        only = args.only.split(",")
+        args.only = [x for x in benchmarks
+                     if any(x.startswith(y) for y in only)]
+        if not args.only:
+            p.error("no such benchmark: {}".format(", ".join(only)))
+    else:
+        args.only = benchmarks
+
+    results = run(args)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
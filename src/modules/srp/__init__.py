@@ -1,7 +1,9 @@
 """The toplevel srp module.
 
 This module contains all the python back-end code for the Source Ruckus
-Packager.  Importing it will automatically include all submodules.
+Packager.  Importing it will automatically include all the submodules
+needed by srp.core (the cli, bdiff and dbserver submodules have to be
+imported explicitly).
 
 To get started, look at the documentation for srp.core.
 """
@@ -14,7 +16,10 @@ params = core.RunTimeParameters()
 #
 # FIXME: was setting __all__ and iterating over it... but not sure why now
 #
-for x in ["utils", "config", "features", "notes", "cli", "blob", "db"]:
+# NOTE: The cli, bdiff and dbserver submodules aren't needed by most srp
+#       invocations, so they only get imported when they're used.
+#
+for x in ["utils", "config", "features", "notes", "blob", "db"]:
     __import__(".".join([__name__, x]))
 del x
 
@@ -0,0 +1,331 @@
+"""Binary deltas between BLOBs.
+
+This module is used to create (and apply) delta packages, which carry only
+what changed between two versions of a package.  For each regular file in
+the new package, the delta holds either nothing (file is unchanged), a
+binary diff against the file in the old package, or the whole new file,
+whichever is smallest.
+
+The binary diff is a stream of copy (from the old file) and insert (new
+data) instructions, found by indexing the old file in fixed-size blocks and
+looking up each position of the new file in that index (the same trick
+rsync uses).  The instruction stream is then compressed with lzma.
+
+Diffing means having both files in memory and (in the worst case) doing a
+dict lookup for every byte of the new file, so files bigger than
+max_diff_size aren't diffed at all and diff() gives up once it's clear the
+files have little in common (see max_miss).  Those files just get shipped
+whole.
+
+NOTE: Applying a delta requires the old version of each patched file, so
+      delta packages are installed over the currently installed version of
+      the package, after verifying that each installed file matches the
+      one the delta was generated against.
+"""
+
+import hashlib
+import lzma
+import os
+import pickle
+import struct
+
+import srp
+
+
+# size of the blocks the old file gets indexed in
+#
+# NOTE: Smaller blocks find more (shorter) matches at the expense of a
+#       bigger index.
+block_size = 32
+
+# files bigger than this don't get diffed (both have to fit in memory)
+max_diff_size = 16 * 1024 * 1024
+
+# diff() gives up after this many bytes in a row w/out finding a match, or
+# once more than half of the new file has to be inserted.  Either way, the
+# files are too different for a patch to beat compressing the whole file
+# by much.
+max_miss = 64 * 1024
+
+# files are read and compressed in pieces of this size
+chunk_size = 1024 * 1024
+
+# instruction header: opcode, offset into old file, length
+_hdr = struct.Struct("<BQQ")
+_COPY = 0
+_INSERT = 1
+
+
+def _match_len(a, i, b, j):
+    """Returns the length of the common run of bytes starting at a[i] and
+    b[j].  Compares in big steps first, so long runs are cheap.
+
+    """
+    n = 0
+    limit = min(len(a) - i, len(b) - j)
+    step = 4096
+    while step:
+        while n + step <= limit and a[i+n:i+n+step] == b[j+n:j+n+step]:
+            n += step
+        step //= 8
+    return n
+
+
+def diff(old, new):
+    """Returns a delta (bytes) that turns `old' into `new' when passed to
+    patch(), or None if they're too different to bother (see max_miss).
+
+    """
+    index = {}
+    # NOTE: Walking backwards means the first occurrence of each block
+    #       wins.
+    for i in range(len(old) - block_size - len(old) % block_size, -1,
+                   -block_size):
+        index[old[i:i+block_size]] = i
+
+    mold = memoryview(old)
+    mnew = memoryview(new)
+    ops = []
+    lit = 0
+    inserted = 0
+    i = 0
+    while i + block_size <= len(new):
+        j = index.get(new[i:i+block_size])
+        if j is None:
+            i += 1
+            if i - lit > max_miss or inserted + i - lit > len(new) // 2:
+                return None
+            continue
+
+        # grow the match backwards over anything we'd otherwise insert
+        while i > lit and j > 0 and new[i-1] == old[j-1]:
+            i -= 1
+            j -= 1
+
+        n = _match_len(mold, j, mnew, i)
+        if i > lit:
+            ops.append(_hdr.pack(_INSERT, 0, i - lit))
+            ops.append(new[lit:i])
+            inserted += i - lit
+        ops.append(_hdr.pack(_COPY, j, n))
+        i += n
+        lit = i
+
+    if lit < len(new):
+        ops.append(_hdr.pack(_INSERT, 0, len(new) - lit))
+        ops.append(new[lit:])
+
+    return lzma.compress(b"".join(ops))
+
+
+def patch(old, delta):
+    """Returns the result of applying `delta' (from diff()) to `old'."""
+    buf = lzma.decompress(delta)
+    ret = []
+    pos = 0
+    while pos < len(buf):
+        op, offset, size = _hdr.unpack_from(buf, pos)
+        pos += _hdr.size
+        if op == _COPY:
+            if offset + size > len(old):
+                raise ValueError("delta doesn't match old data")
+            ret.append(old[offset:offset+size])
+        elif op == _INSERT:
+            ret.append(buf[pos:pos+size])
+            pos += size
+        else:
+            raise ValueError("corrupt delta")
+    return b"".join(ret)
+
+
+def _read(blob, fname):
+    """Returns the contents of regular file `fname' in BlobFile `blob'."""
+    return b"".join(_chunks(blob, fname))
+
+
+def _chunks(blob, fname):
+    """Yields the contents of regular file `fname' in BlobFile `blob' in
+    pieces of at most chunk_size bytes.
+
+    """
+    x = blob.manifest[fname]
+    left = x["tinfo"].size
+    with open(blob.fname, "rb") as f:
+        f.seek(blob.hdr_offset + x["offset"])
+        while left:
+            buf = f.read(min(left, chunk_size))
+            if not buf:
+                raise Exception("{} is truncated".format(blob.fname))
+            left -= len(buf)
+            yield buf
+
+
+class BlobDelta(srp.SrpObject):
+    """Class representing the difference between two BLOBs.
+
+    Data:
+
+      from_fullname - Fullname of the package the delta applies to.
+
+      manifest - The new BLOB's srp.blob.Manifest instance.
+
+      algorithm - Hash algorithm used for src and dst checksums.
+
+      files - Dict mapping each regular file in manifest to a (how, offset,
+          size, src, dst) tuple.  `how' is either "same" (unchanged), "patch"
+          (the data is a delta against the old file) or "data" (the data
+          is the whole lzma compressed file).  `offset' and `size' locate
+          the data in the delta package's DATA file (both are 0 for
+          "same").  `src' and `dst' are checksums of the old and new file.
+
+    """
+    def __init__(self):
+        self.from_fullname = None
+        self.manifest = None
+        self.algorithm = srp.config.checksum_algorithm
+        self.files = {}
+
+    @property
+    def same(self):
+        """Set of the names of files that are unchanged."""
+        return set(k for k, v in self.files.items() if v[0] == "same")
+
+    def checksum(self, data):
+        return hashlib.new(self.algorithm, data).hexdigest().encode()
+
+    def checksum_file(self, blob, fname):
+        """Returns the checksum of file `fname' in BlobFile `blob'."""
+        sha = hashlib.new(self.algorithm)
+        for buf in _chunks(blob, fname):
+            sha.update(buf)
+        return sha.hexdigest().encode()
+
+    @classmethod
+    def fromblobs(cls, from_fullname, old, new, data):
+        """Creates a BlobDelta instance from BlobFile instances `old' and
+        `new', writing the data for changed files to file object `data'.
+
+        """
+        obj = cls()
+        obj.from_fullname = from_fullname
+        obj.manifest = new.manifest
+        for fname in new.manifest:
+            tinfo = new.manifest[fname]["tinfo"]
+            if not tinfo.isreg():
+                continue
+            dst = obj.checksum_file(new, fname)
+
+            o = None
+            src = None
+            try:
+                o = old.manifest[fname]["tinfo"]
+                if o.isreg():
+                    src = obj.checksum_file(old, fname)
+            except KeyError:
+                pass
+
+            if src == dst and o.size == tinfo.size:
+                obj.files[fname] = ("same", 0, 0, src, dst)
+                continue
+
+            offset = data.tell()
+            if (src is not None and o.size <= max_diff_size
+                and tinfo.size <= max_diff_size):
+                n = _read(new, fname)
+                buf = lzma.compress(n)
+                d = diff(_read(old, fname), n)
+                if d is not None and len(d) < len(buf):
+                    obj.files[fname] = ("patch", offset, len(d), src, dst)
+                    data.write(d)
+                    continue
+                data.write(buf)
+            else:
+                c = lzma.LZMACompressor()
+                for buf in _chunks(new, fname):
+                    data.write(c.compress(buf))
+                data.write(c.flush())
+            obj.files[fname] = ("data", offset, data.tell() - offset, src,
+                                dst)
+
+        return obj
+
+    def apply(self, prev, data_fname, blob_fname):
+        """Writes out a new BLOB file named `blob_fname' by applying the delta
+        (with data from file `data_fname') to the files installed by
+        srp.db.InstalledPackage instance `prev'.  Returns the resulting
+        srp.blob.BlobFile instance.
+
+        NOTE: Unchanged files don't get any data in the resulting BLOB
+              (their offset is None), so they can't be extracted from it
+              and have to be left alone during install.
+
+        """
+        if prev.notes.header.fullname != self.from_fullname:
+            raise Exception("delta requires {} to be installed".format(
+                self.from_fullname))
+
+        try:
+            algo = prev.notes.checksum.algorithm
+        except AttributeError:
+            algo = None
+
+        def installed(fname, checksum):
+            # NOTE: We have to chop the leading '/' off of fname so that
+            #       os.path.join will really add in our root path.
+            #
+            path = os.path.join(srp.params.root, fname[1:])
+            with open(path, "rb") as f:
+                buf = f.read()
+            if self.checksum(buf) != checksum:
+                raise Exception("installed file {} has been modified, install"
+                                " the full package instead".format(path))
+            return buf
+
+        m = self.manifest
+        old = prev.manifest
+        # NOTE: This happens before the install stages are looked up, so
+        #       the core Feature might not have been imported yet.
+        key = srp.features.load_feature("core").upgrade_key
+        offset = 0
+        for fname in m:
+            if not m[fname]["tinfo"].isreg():
+                continue
+            how, off, size, src, dst = self.files[fname]
+            if how == "same":
+                # NOTE: If the checksum Feature recorded a sum w/ the same
+                #       algorithm at install-time, we can trust that instead
+                #       of reading the file.
+                path = os.path.join(srp.params.root, fname[1:])
+                if (algo != self.algorithm
+                    or old[fname].get("checksum") != src
+                    or os.path.getsize(path) != m[fname]["tinfo"].size):
+                    installed(fname, src)
+
+                # NOTE: If only the metadata changed (e.g., mode), the file
+                #       still has to be re-extracted, so it needs data.
+                if key(old[fname]["tinfo"]) == key(m[fname]["tinfo"]):
+                    m[fname]["offset"] = None
+                    continue
+            m[fname]["offset"] = offset
+            offset += m[fname]["tinfo"].size
+
+        with open(data_fname, "rb") as data, open(blob_fname, "wb") as f:
+            pickle.dump(m, f)
+            for fname in m:
+                if m[fname].get("offset") is None:
+                    continue
+                how, off, size, src, dst = self.files[fname]
+                if how == "same":
+                    f.write(installed(fname, src))
+                    continue
+                data.seek(off)
+                buf = data.read(size)
+                if how == "patch":
+                    buf = patch(installed(fname, src), buf)
+                else:
+                    buf = lzma.decompress(buf)
+                if self.checksum(buf) != dst:
+                    raise Exception("failed to reconstruct {}".format(fname))
+                f.write(buf)
+
+        return srp.blob.BlobFile.fromfile(blob_fname)
@@ -1,14 +1,76 @@
 /* -*- c-file-style: "k&r"; indent-tabs-mode: nil -*-
  *
- * This simple C extension for the srp.blob module provides a faster
- * single-file extraction method.
+ * This simple C extension for the srp.blob module provides faster
+ * extraction methods.
  */
 
+#define _GNU_SOURCE
 #include <Python.h>
 
+#include <errno.h>
 #include <sys/types.h>
 #include <sys/stat.h>
 #include <fcntl.h>
+#include <unistd.h>
+
+
+/* Copies `size' bytes starting at `offset' in fd `b' to the current
+ * position of fd `f'.  Returns 0 on success, -1 w/ errno set on failure.
+ *
+ * NOTE: We try copy_file_range first (which lets the kernel do the copy,
+ *       or even share extents on filesystems that support it), then fall
+ *       back to a pread/write loop if it's not supported here.
+ */
+static int copy_range(int b, int f, unsigned long long offset,
+                      unsigned long long size)
+{
+     char buf[65536];
+     loff_t off = offset;
+     ssize_t n, w, done;
+
+     while (size) {
+          n = copy_file_range(b, &off, f, NULL, size, 0);
+          if (n > 0) {
+               size -= n;
+               continue;
+          }
+          if (n == 0)
+               break;
+          if (errno == EINTR)
+               continue;
+          if (errno != ENOSYS && errno != EXDEV && errno != EINVAL &&
+              errno != EOPNOTSUPP)
+               return -1;
+
+          /* fall back to doing it ourselves */
+          while (size) {
+               n = pread(b, buf, size < sizeof(buf) ? size : sizeof(buf),
+                         off);
+               if (n == -1 && errno == EINTR)
+                    continue;
+               if (n <= 0)
+                    return -1;
+               for (done = 0; done < n; done += w) {
+                    w = write(f, buf + done, n - done);
+                    if (w == -1 && errno == EINTR) {
+                         w = 0;
+                         continue;
+                    }
+                    if (w <= 0)
+                         return -1;
+               }
+               off += n;
+               size -= n;
+          }
+     }
+
+     if (size) {
+          /* BLOB is truncated */
+          errno = EIO;
+          return -1;
+     }
+     return 0;
+}
 
 
 /* extract(blobname, filename, offset, size)
@@ -16,37 +78,33 @@
 static PyObject *blob_extract(PyObject *self, PyObject *args)
 {
      const char *bname, *fname;
-     unsigned int offset, size;
-     char *buf;
-     int b, f;
+     unsigned long long offset, size;
+     int b, f, ret;
 
-     if (!PyArg_ParseTuple(args, "ssII", &bname, &fname, &offset, &size))
+     if (!PyArg_ParseTuple(args, "ssKK", &bname, &fname, &offset, &size))
           return NULL;
 
-     b = open(bname, O_RDONLY);
-     if (b == -1) {
-          /* FIXME: I should set an appropriate exception */
-          return NULL;
-     }
+     b = open(bname, O_RDONLY | O_CLOEXEC);
+     if (b == -1)
+          return PyErr_SetFromErrnoWithFilename(PyExc_OSError, bname);
 
-     if (lseek(b, offset, SEEK_SET) == -1) {
-          /* FIXME: exception */
-          return NULL;
+     f = open(fname, O_WRONLY | O_CREAT | O_TRUNC | O_CLOEXEC, 0600);
+     if (f == -1) {
+          close(b);
+          return PyErr_SetFromErrnoWithFilename(PyExc_OSError, fname);
      }
 
-     f = open(fname, O_WRONLY | O_CREAT | O_TRUNC);
-     if (f == -1) {
-          /* FIXME */
+     Py_BEGIN_ALLOW_THREADS
+     ret = copy_range(b, f, offset, size);
+     Py_END_ALLOW_THREADS
+
+     if (ret == -1) {
+          PyErr_SetFromErrnoWithFilename(PyExc_OSError, fname);
+          close(f);
+          close(b);
           return NULL;
      }
 
-     /* FIXME: I'm sure we could do this more efficiently... Maybe
-      *        read/write 4K at a time or something?
-      */
-     buf = malloc(size);
-     read(b, buf, size);
-     write(f, buf, size);
-
      close(f);
      close(b);
 
@@ -54,11 +112,59 @@ static PyObject *blob_extract(PyObject *self, PyObject *args)
 }
 
 
+/* copy(blob_fd, fd, offset, size)
+ */
+static PyObject *blob_copy(PyObject *self, PyObject *args)
+{
+     int b, f, ret;
+     unsigned long long offset, size;
+
+     if (!PyArg_ParseTuple(args, "iiKK", &b, &f, &offset, &size))
+          return NULL;
+
+     Py_BEGIN_ALLOW_THREADS
+     ret = copy_range(b, f, offset, size);
+     Py_END_ALLOW_THREADS
+
+     if (ret == -1)
+          return PyErr_SetFromErrno(PyExc_OSError);
+
+     Py_RETURN_NONE;
+}
+
+
+/* syncfs(fd)
+ */
+static PyObject *blob_syncfs(PyObject *self, PyObject *args)
+{
+     int fd, ret;
+
+     if (!PyArg_ParseTuple(args, "i", &fd))
+          return NULL;
+
+     Py_BEGIN_ALLOW_THREADS
+     ret = syncfs(fd);
+     Py_END_ALLOW_THREADS
+
+     if (ret == -1)
+          return PyErr_SetFromErrno(PyExc_OSError);
+
+     Py_RETURN_NONE;
+}
+
+
 /* define all methods to expose */
 static PyMethodDef BlobMethods[] = {
      {"extract",  blob_extract, METH_VARARGS,
       "extract(blob_fname, fname, offset, size) - Extract `size' bytes\n"
       "starting from `offset' in `blob_fname' to file `fname'."},
+     {"copy",  blob_copy, METH_VARARGS,
+      "copy(blob_fd, fd, offset, size) - Copy `size' bytes starting from\n"
+      "`offset' in open file `blob_fd' to the current position of open\n"
+      "file `fd'."},
+     {"syncfs",  blob_syncfs, METH_VARARGS,
+      "syncfs(fd) - Commit the filesystem containing open file `fd' to\n"
+      "disk."},
      {NULL, NULL, 0, NULL}        /* Sentinel */
 };
 
@@ -2,14 +2,9 @@
 """
 
 import collections
-import grp
 import os
 import pickle
-import pprint
-import pwd
 import stat
-import subprocess
-import tarfile
 import tempfile
 
 import srp
@@ -47,6 +42,9 @@ class Manifest(srp.SrpObject, collections.UserDict):
     Manifest object will be a dict of filenames, each of which is
     associated with a dict describing some aspect of the file.
 
+    The `links' attribute holds the hard link groups (see hardlinks()) once
+    the Manifest has been written out to a BLOB.
+
     NOTE: This inherits from collections.UserDict instead of builtins.dict
           because deriving from dict and then adding a __dict__ resulted
           in an un-pickle-able mess.
@@ -57,6 +55,7 @@ class Manifest(srp.SrpObject, collections.UserDict):
         srp.SrpObject.__init__(self)
         self.sortedkeys = []
         self.payload_dir = None
+        self.links = None
 
     def __iter__(self):
         return iter(self.sortedkeys)
@@ -110,16 +109,55 @@ class Manifest(srp.SrpObject, collections.UserDict):
             return ret
 
         ret += "\nManifest Contents:\n"
+        import pprint
         ret += pprint.pformat(self.data)
 
         return ret
 
+    def hardlinks(self):
+        """Returns a dict mapping the name of each file that has hard links to
+        it (i.e., the one that actually owns the data) to a sorted list of
+        the names of its links.
+
+        NOTE: This is precomputed by BlobFile.tofile() and stored in the
+              BLOB, but we compute it on the fly for BLOBs that were
+              created before that was the case.
+
+        """
+        links = getattr(self, "links", None)
+        if links is not None:
+            return links
+        links = {}
+        for k in self.sortedkeys:
+            t = self.data[k]["tinfo"]
+            if t.islnk():
+                links.setdefault(os.path.sep + t.linkname, []).append(k)
+        return links
+
+    def install_order(self):
+        """Returns a list of all our filenames, in the order they should be
+        extracted.  This is sorted order, except that hard links all come
+        at the very end, after the files they link to.
+
+        """
+        aliases = []
+        for v in self.hardlinks().values():
+            aliases.extend(v)
+        if not aliases:
+            return list(self.sortedkeys)
+        skip = set(aliases)
+        ret = [k for k in self.sortedkeys if k not in skip]
+        ret.extend(sorted(aliases))
+        return ret
+
     @classmethod
     def fromdir(cls, payload_dir):
         """Returns a new Manifest object populated with entries for each file in
         the specified `payload_dir'.
 
         """
+        import tarfile
+
         obj = cls()
         obj.payload_dir = os.path.abspath(payload_dir)
 
@@ -176,6 +214,156 @@ class Manifest(srp.SrpObject, collections.UserDict):
         return obj
 
 
+# suffix added to the names of files extracted by a staging ExtractContext
+staged_suffix = ".srpnew"
+
+
+def _copy(b, f, offset, size):
+    """Pure Python version of srp._blob.copy().  Copies `size' bytes starting
+    at `offset' in fd `b' to fd `f'.
+
+    """
+    while size:
+        try:
+            n = os.copy_file_range(b, f, size, offset)
+        except (AttributeError, OSError):
+            # not supported here, fall back to doing it ourselves
+            break
+        if not n:
+            break
+        offset += n
+        size -= n
+    while size:
+        buf = os.pread(b, min(size, 65536), offset)
+        if not buf:
+            raise OSError("BLOB truncated")
+        os.write(f, buf)
+        offset += len(buf)
+        size -= len(buf)
+
+
+class ExtractContext(srp.SrpObject):
+    """Class holding state shared by a series of BlobFile.extract() calls
+    into the same destination, so that each call doesn't have to re-open
+    the BLOB, re-create leading directories, or unlink files that can't
+    possibly be there yet.
+
+    Data:
+
+      path - Destination directory (or None for the current working
+          directory).
+
+      fd - File descriptor of the BLOB opened for reading, or None if the
+          BlobFile was created via fobj.
+
+      dirs - Dict of directories known to exist, each mapped to True if it
+          was empty when we got there (i.e., we created it, or it's the
+          empty destination itself).
+
+      counts - collections.Counter of filesystem syscalls made, by name.
+
+      ids - srp.utils.IdMap used to resolve the user and group names
+          stored in the BLOB.
+
+      staging - If True, everything but directories gets extracted to a
+          sibling temporary name (see staged_suffix), and only moved into
+          place by commit().
+
+      staged - Dict mapping final target paths to the temporary paths
+          they've been extracted to, in the order they were extracted.
+
+    """
+    def __init__(self, blob, path=None, staging=False):
+        self.path = path
+        self.staging = staging
+        self.staged = {}
+        self.fd = None
+        if blob.fname:
+            self.fd = os.open(blob.fname, os.O_RDONLY | os.O_CLOEXEC)
+        self.dirs = {}
+        self.counts = collections.Counter()
+        self.ids = srp.utils.idmap(srp.params.root)
+
+        # if the destination doesn't have anything in it yet, we know
+        # nothing we extract is going to be in the way
+        dest = os.path.normpath(path or ".")
+        try:
+            self.dirs[dest] = not os.listdir(dest)
+        except FileNotFoundError:
+            self.makedirs(dest)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Closes the BLOB.  Anything staged but not committed yet gets
+        removed.
+
+        """
+        for tmp in self.staged.values():
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+        self.staged = {}
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def target(self, name):
+        """Returns the path where the file that will end up at `name' (a
+        path under our destination) currently lives.
+
+        """
+        return self.staged.get(name, name)
+
+    def commit(self):
+        """Moves everything staged into place.  All the staged data is
+        flushed to disk first (via one syncfs call), so a crash can't
+        leave behind renamed files that are missing their contents.
+
+        NOTE: The renames themselves are left to normal writeback.
+
+        """
+        if not self.staged:
+            return
+        fd = os.open(self.path or ".", os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            self.counts["syncfs"] += 1
+            srp._blob.syncfs(fd)
+        finally:
+            os.close(fd)
+        for final, tmp in self.staged.items():
+            self.counts["rename"] += 1
+            os.rename(tmp, final)
+        self.staged = {}
+
+    def makedirs(self, d):
+        """Creates directory `d' (and any missing leading path segments)
+        unless we already know it exists.
+
+        """
+        if not d or d in self.dirs:
+            return
+        parent = os.path.dirname(d)
+        if parent != d:
+            self.makedirs(parent)
+        self.counts["mkdir"] += 1
+        try:
+            os.mkdir(d)
+            self.dirs[d] = True
+        except OSError:
+            self.dirs[d] = False
+
+    def report(self):
+        """Returns a one line summary of the syscalls made."""
+        return ", ".join("{}={}".format(k, v)
+                         for k, v in sorted(self.counts.items()))
+
+
 # FIXME: if created via fobj, extract will not be functional... unless we
 #        make it work later.  the c func takes a filename, so we would
 #        have to make sure to know the path to the file on disk.
@@ -252,6 +440,11 @@ class BlobFile(srp.SrpObject):
         tmp.seek(0)
         tmp.flush()
 
+        # figure out the hard link groups now, so extraction doesn't have
+        # to
+        self.manifest.links = None
+        self.manifest.links = self.manifest.hardlinks()
+
         # now pickle the manifest
         #
         # FIXME: woah, i cannot pikcle.loads() the resulting string...
@@ -277,16 +470,34 @@ class BlobFile(srp.SrpObject):
 
 
 
+    def context(self, path=None, staging=False):
+        """Returns a new ExtractContext for a series of extract() calls into
+        `path' (or the current working directory).  If `staging' is set,
+        extracted files don't replace anything until the context's
+        commit() method is called.
+
+        """
+        return ExtractContext(self, path, staging)
+
+
     # FIXME: this needs to make backups of existing files.  i think we'll
     #        add the upgrade logic via an upgrade feature, but we need to
     #        at least make srpbak files here.
-    def extract(self, fname, path=None, __c=True):
+    def extract(self, fname, path=None, __c=True, ctx=None):
         """Extracts `fname' from the BLOB file to the current working directory.
         If `path' is specified, it is prepended to the resulting pathname.
         The C implementation is used if availalbe unless `__c' is set to
         False.
 
+        If `ctx' is specified, it's an ExtractContext (see context()) shared
+        with previous calls, which lets us skip redundant syscalls.  It must
+        have been created with the same `path'.
+
         """
+        if ctx is None:
+            ctx = self.context(path)
+        counts = ctx.counts
+
         # get the TarInfo object
         x = self.manifest[fname]['tinfo']
         if srp.params.verbosity > 1:
@@ -307,18 +518,48 @@ class BlobFile(srp.SrpObject):
         #       sorted order.  However, if we're just randomly grabbing a
         #       single file, then we're going to be creating a bunch of
         #       directories here.
-        try:
-            os.makedirs(os.path.dirname(target))
-        except:
-            pass
+        parent = os.path.dirname(target) or "."
+        ctx.makedirs(parent)
+
+        # NOTE: Directories don't replace anything (and things need to go
+        #       in them), so they're never staged.
+        if ctx.staging and not x.isdir():
+            ctx.staged[target] = target + staged_suffix
+            target = ctx.staged[target]
 
         # delete file if already present
         #
+        # NOTE: If we created the parent dir ourselves (or the whole
+        #       destination was empty to begin with), there's nothing there
+        #       to delete.
+        #
         # FIXME: add srpbak support
-        try:
-            os.remove(target)
-        except:
-            pass
+        if not ctx.dirs[parent]:
+            counts["unlink"] += 1
+            try:
+                os.remove(target)
+            except:
+                pass
+
+        # get ownership
+        #
+        # NOTE: For now, I'm going to only chown with uid/gid if the string
+        #       user/group isn't set.  In other words, the human readable
+        #       ones take precedence.
+        u = -1
+        g = -1
+        if x.uid:
+            u = x.uid
+        if x.uname:
+            uid = ctx.ids.uid(x.uname)
+            if uid is not None:
+                u = uid
+        if x.gid:
+            g = x.gid
+        if x.gname:
+            gid = ctx.ids.gid(x.gname)
+            if gid is not None:
+                g = gid
 
         # create target file
         #
@@ -328,87 +569,105 @@ class BlobFile(srp.SrpObject):
             offset = self.hdr_offset + self.manifest[fname]["offset"]
             if srp.params.verbosity > 1:
                 print("regular file: offset:", offset, "size:", x.size)
-            if __c:
-                srp._blob.extract(self.fname, target, offset, x.size)
-            else:
-                self.fobj.seek(offset)
-                with open(target, "wb") as t_fobj:
-                    t_fobj.write(self.fobj.read(x.size))
+            # NOTE: We hang onto the fd for the rest of the metadata so
+            #       the kernel doesn't have to look up the path again for
+            #       each call.
+            counts["open"] += 1
+            fd = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+                         | os.O_CLOEXEC, 0o600)
+            try:
+                counts["copy"] += 1
+                if ctx.fd is None:
+                    self.fobj.seek(offset)
+                    with open(fd, "wb", closefd=False) as t_fobj:
+                        t_fobj.write(self.fobj.read(x.size))
+                elif __c:
+                    srp._blob.copy(ctx.fd, fd, offset, x.size)
+                else:
+                    _copy(ctx.fd, fd, offset, x.size)
+
+                if srp.params.verbosity > 1:
+                    print("chowning to user", u, ", group", g)
+                counts["fchown"] += 1
+                try:
+                    os.fchown(fd, u, g)
+                except:
+                    print("WARNING: failed to set ownership of", target, "to",
+                          "{}:{}".format(u, g))
+
+                if srp.params.verbosity > 1:
+                    print("chmoding to", x.mode)
+                counts["fchmod"] += 1
+                os.fchmod(fd, x.mode)
+
+                if srp.params.verbosity > 1:
+                    print("setting mtime", x.mtime)
+                counts["futimens"] += 1
+                os.utime(fd, (x.mtime, x.mtime))
+            finally:
+                os.close(fd)
+            return
 
         elif x.isdir():
             if srp.params.verbosity > 1:
                 print("directory")
-            try:
-                os.mkdir(target)
-            except:
-                # We'll get OSError if we've already created this dir
-                # (e.g., as a leading path element to a file we've already
-                # extracted)
-                pass
+            if target not in ctx.dirs:
+                counts["mkdir"] += 1
+                try:
+                    os.mkdir(target)
+                    ctx.dirs[target] = True
+                except:
+                    # We'll get OSError if this dir is already there
+                    # (e.g., from a previously installed package)
+                    ctx.dirs[target] = False
 
         elif x.issym():
             if srp.params.verbosity > 1:
                 print("symlink")
+            counts["symlink"] += 1
             os.symlink(x.linkname, target)
 
         elif x.islnk():
             if srp.params.verbosity > 1:
                 print("hard link")
-            # NOTE: This will fail if the archived link is being extracted
-            #       prior to the file it links to.  I guess if we're
-            #       extracting a link to a nonexistent file, we'd better
-            #       follow the link in the archive and extract that file
-            #       too.
+            # NOTE: The file we link to has to have been extracted
+            #       already, which is why hard links come last in
+            #       Manifest.install_order().
             #
-            # FIXME: What happens if the other file gets extracted in
-            #        another thread?  I think it'll still be fine... but
-            #        this might be a corner case we need to fix later.
-            try:
-                os.link(os.path.join(path, x.linkname), target)
-            except:
-                self.extract(os.path.sep + x.linkname, path)
-                os.link(os.path.join(path, x.linkname), target)
+            # NOTE: The rest of the meta-data belongs to the inode, which
+            #       got set when the file we link to was extracted, so
+            #       we're done.
+            counts["link"] += 1
+            if path:
+                os.link(ctx.target(os.path.join(path, x.linkname)), target)
+            else:
+                os.link(ctx.target(x.linkname), target)
+            return
 
         elif x.ischr():
             if srp.params.verbosity > 1:
                 print("char device")
+            counts["mknod"] += 1
             os.mknod(target, x.mode | stat.S_IFCHR,
                      os.makedev(x.devmajor, x.devminor))
 
         elif x.isblk():
             if srp.params.verbosity > 1:
                 print("block device")
+            counts["mknod"] += 1
             os.mknod(target, x.mode | stat.S_IFBLK,
                      os.makedev(x.devmajor, x.devminor))
 
         elif x.isfifo():
             if srp.params.verbosity > 1:
                 print("fifo")
-            os.makefifo(target)
+            counts["mkfifo"] += 1
+            os.mkfifo(target)
 
         # set ownership
-        #
-        # NOTE: For now, I'm going to only chown with uid/gid if the string
-        #       user/group isn't set.  In other words, the human readable
-        #       ones take precedence.
-        u = -1
-        g = -1
-        if x.uid:
-            u = x.uid
-        if x.uname:
-            try:
-                u = pwd.getpwnam(x.uname).pw_uid
-            except:
-                pass
-        if x.gid:
-            g = x.gid
-        if x.gname:
-            try:
-                g = grp.getgrnam(x.gname).gr_gid
-            except:
-                pass
         if srp.params.verbosity > 1:
             print("chowning to user", u, ", group", g)
+        counts["lchown"] += 1
         try:
             os.lchown(target, u, g)
         except:
@@ -422,6 +681,7 @@ class BlobFile(srp.SrpObject):
         # set mode
         if srp.params.verbosity > 1:
             print("chmoding to", x.mode)
+        counts["chmod"] += 1
         os.chmod(target, x.mode)
 
         # set time(s)
@@ -429,6 +689,7 @@ class BlobFile(srp.SrpObject):
         # FIXME: does tar really only track mtime?
         if srp.params.verbosity > 1:
             print("setting mtime", x.mtime)
+        counts["utime"] += 1
         os.utime(target, (x.mtime, x.mtime))
 
 
@@ -437,5 +698,6 @@ class BlobFile(srp.SrpObject):
         directory, or to `path' if specified.
 
         """
-        for f in self.manifest:
-            self.extract(f, path)
+        with self.context(path) as ctx:
+            for f in self.manifest.install_order():
+                self.extract(f, path, ctx=ctx)
@@ -2,6 +2,7 @@
 """
 
 import argparse
+import os
 import sys
 
 from pprint import pprint # FIXME: this was for debug...?
@@ -98,9 +99,11 @@ g.add_argument('-B', '--build-and-install', metavar="NOTES[,key=val,...]",
                action=OrderedMode,
                help="""Build and install the package specified by the supplied
                NOTES file (and optional keyword arguments).
-               If the package already exists in PWD and is newer than the
-               NOTES file, the previously built package is installed w/out
-               triggering a re-build.""")
+               If the package already exists in PWD and none of the NOTES
+               file, source, extra_content, or enabled features have changed
+               since it was built, the previously built package is installed
+               w/out triggering a re-build (unless update=False is
+               set).""")
 
 g.add_argument('-u', '--uninstall', metavar="PKG[,key=val,...]",
                action=OrderedMode,
@@ -108,6 +111,14 @@ g.add_argument('-u', '--uninstall', metavar="PKG[,key=val,...]",
                     installed, this will quietly return successfully (well,
                     it DID get uninstalled at some point).""")
 
+g.add_argument('-d', '--delta', metavar="OLD,NEW",
+               action=OrderedMode,
+               help="""Create a delta package that upgrades package OLD to
+                    package NEW.  The resulting drp is installed just like
+                    a brp, but only on systems that have OLD installed, and
+                    it only carries the files that changed (as binary diffs
+                    when that's smaller).""")
+
 # FIXME: some way to display all registered query types and criteria?
 #
 g.add_argument('-q', '--query', metavar="QUERY",
@@ -121,8 +132,9 @@ g.add_argument('-a', '--action', metavar="ACTIONS",
                action=OrderedMode,
                help="""Perform some sort of action on an installed PACKAGE.
                     ACTIONS is a comma-delimited list of actions to be
-                    performed (e.g.,
-                    --action=strip_debug,strip_docs,commit).""")
+                    performed followed by criteria for selecting installed
+                    packages (e.g.,
+                    --action=verify,pkg=perl*).""")
 
 
 # FIXME: need to document supported actions somewhere.  here's a list of the
@@ -162,8 +174,12 @@ p.add_argument("--help-install", action="store_true",
                help="""Extra help for --install""")
 p.add_argument("--help-uninstall", action="store_true",
                help="""Extra help for --uninstall""")
+p.add_argument("--help-delta", action="store_true",
+               help="""Extra help for --delta""")
 p.add_argument("--help-query", action="store_true",
                help="""Extra help for --query""")
+p.add_argument("--help-action", action="store_true",
+               help="""Extra help for --action""")
 
 p.add_argument('-V', '--version', action='version',
                version="{} version {}".format(
@@ -209,6 +225,20 @@ p.add_argument('--root', metavar='ROOTDIR',
 #               If a specified PACKAGE is '-', additional PACKAGEs are read
 #               from stdin.""")
 
+p.add_argument('-j', '--jobs', metavar='N', type=int,
+               help="""Do up to N things concurrently (e.g., install
+               multiple packages at once).  Defaults to the number of
+               CPUs.""")
+
+p.add_argument('--profile', metavar='DIR', nargs='?', const='srp-profile',
+               help="""Profile each operational mode and its stages, writing
+               per-stage pstats and collapsed-stack (flamegraph) files to
+               DIR (or ./srp-profile if DIR not supplied).""")
+
+p.add_argument('--profile-funcs', action='store_true',
+               help="""When used with --profile, also profile each Feature
+               stage function separately.""")
+
 # FIXME: rename this to --show-features if we change --options as
 #        mentioned...
 #
@@ -221,6 +251,13 @@ p.add_argument('-l', '--list', metavar="PATTERN", nargs='?', const='*',
                all packages if PATTERN not supplied).  This is really just
                shorthand for --query name,pkg=PATTERN.""")
 
+p.add_argument('--db-server', action='store_true',
+               help="""Run a server that keeps the installed package db for
+               ROOTDIR in memory and serializes access to it, until
+               interrupted.  While it's running, other srp invocations on
+               the same ROOTDIR use it automatically instead of loading
+               the db themselves, and commits get batched together.""")
+
 # FIXME: i think this is going to end up as a list of features to
 #        enable/disable at run-time... and if so, it should get renamed to
 #        --features... and the old --features flag should end up as
@@ -318,6 +355,11 @@ def main():
     if args.root:
         srp.params.root = args.root
     srp.params.options = args.options
+    if args.jobs:
+        srp.params.jobs = args.jobs
+    if args.profile:
+        srp.params.profile = os.path.abspath(args.profile)
+        srp.params.profile_funcs = args.profile_funcs
 
     # check for any information-and-exit type flags
     if args.help_build:
@@ -332,10 +374,25 @@ def main():
         print(format_extra_help("--uninstall"))
         return
 
+    if args.help_delta:
+        print(format_extra_help("--delta"))
+        return
+
     if args.help_query:
         print(format_extra_help("--query"))
         return
 
+    if args.help_action:
+        print(format_extra_help("--action"))
+        return
+
+    if args.db_server:
+        # NOTE: This is the only thing that needs srp.dbserver, so it
+        #       doesn't get imported until now.
+        __import__("srp.dbserver")
+        srp.dbserver.serve()
+        return
+
     if args.features:
         m = srp.features.get_stage_map(srp.features.registered_features)
         pprint(m)
@@ -351,8 +408,28 @@ def main():
         srp.query()
         return
 
+    # group consecutive installs (and consecutive builds) together so they
+    # can be done as a batch
+    modes = []
+    for mode, arg in args.OrderedMode:
+        if mode == "--install" or mode == "-i":
+            if modes and modes[-1][0] == "--install":
+                modes[-1][1].append(arg)
+            else:
+                modes.append(("--install", [arg]))
+        elif mode in ("--build", "-b", "--build-and-install", "-B"):
+            if modes and modes[-1][0] == "build_batch":
+                modes[-1][1].append((mode, arg))
+            elif modes and modes[-1][0] in ("--build", "-b",
+                                            "--build-and-install", "-B"):
+                modes[-1] = ("build_batch", [modes[-1], (mode, arg)])
+            else:
+                modes.append((mode, arg))
+        else:
+            modes.append((mode, arg))
+
     # now iterate over our generated list of operational modes
-    for mode in args.OrderedMode:
+    for mode in modes:
         mode, arg = mode
         
         if mode == "--build" or mode == "-b":
@@ -367,17 +444,27 @@ def main():
             srp.build()
             srp.params.build = None
 
-        elif mode == "--install" or mode == "-i":
-            arg = arg.split(',')
-            kwargs = {"pkg": arg[0]}
-            for x in arg[1:]:
-                k,v = x.split('=')
-                kwargs[k] = v
-            srp.params.install = srp.InstallParameters(**kwargs)
-            if srp.params.verbosity:
-                print(srp.params)
-            srp.install()
-            srp.params.install = None
+        elif mode == "--install":
+            params = []
+            for a in arg:
+                a = a.split(',')
+                kwargs = {"pkg": a[0]}
+                for x in a[1:]:
+                    k,v = x.split('=')
+                    kwargs[k] = v
+                params.append(srp.InstallParameters(**kwargs))
+            if len(params) == 1:
+                srp.params.install = params[0]
+                if srp.params.verbosity:
+                    print(srp.params)
+                srp.install()
+                srp.params.install = None
+            else:
+                srp.params.install_batch = params
+                if srp.params.verbosity:
+                    print(srp.params)
+                srp.install_batch()
+                srp.params.install_batch = None
 
         elif mode == "--build-and-install" or mode == "-B":
             # we need to do a little extra work here weeding out kwargs
@@ -393,14 +480,10 @@ def main():
                     kwargs_i[k] = v
                 else:
                     raise Exception("invalid keyword argument: {}".format(k))
-            # FIXME: we need to check to see if the package already exists
-            #        on disk and is newer then NOTES file... and skip the
-            #        actual build if so
-            #
-            #        if we want to use any of srp.work.build (e.g., to get
-            #        at notes to figure out pname below) for the install
-            #        part of this, we cannot just SKIP the build...
-            #
+            # NOTE: If the package already exists on disk and nothing has
+            #       changed since it was built, it gets installed w/out
+            #       being rebuilt unless update=False was specified.
+            kwargs_b.setdefault("update", True)
             srp.params.build = srp.BuildParameters(**kwargs_b)
             if srp.params.verbosity:
                 print(srp.params)
@@ -418,7 +501,32 @@ def main():
                 print(srp.params)
             srp.install()
             srp.params.build = None
-            psr.params.install = None
+            srp.params.install = None
+
+        elif mode == "build_batch":
+            params = []
+            for m, a in arg:
+                a = a.split(',')
+                kwargs_b = {"notes": a[0]}
+                kwargs_i = None
+                if m == "--build-and-install" or m == "-B":
+                    kwargs_b["update"] = True
+                    kwargs_i = {}
+                for x in a[1:]:
+                    k,v = x.split('=')
+                    if k in srp.BuildParameters.__slots__:
+                        kwargs_b[k] = v
+                    elif (kwargs_i is not None
+                          and k in srp.InstallParameters.__slots__):
+                        kwargs_i[k] = v
+                    else:
+                        raise Exception("invalid keyword argument: {}".format(k))
+                params.append((srp.BuildParameters(**kwargs_b), kwargs_i))
+            srp.params.build_batch = params
+            if srp.params.verbosity:
+                print(srp.params)
+            srp.build_batch()
+            srp.params.build_batch = None
 
         elif mode == "--uninstall" or mode == "-u":
             arg = arg.split(',')
@@ -448,8 +556,31 @@ def main():
             srp.params.query = None
 
         elif mode == "--action" or mode == "-a":
-            # FIXME: not implemented
-            pass
+            a_t = []
+            a_c = {}
+            kwargs = {}
+            for x in arg.split(','):
+                if '=' in x:
+                    k,v = x.split('=')
+                    if k in srp.ActionParameters.__slots__:
+                        kwargs[k] = v
+                    else:
+                        a_c[k] = v
+                else:
+                    a_t.append(x)
+            srp.params.action = srp.ActionParameters(a_t, a_c, **kwargs)
+            if srp.params.verbosity:
+                print(srp.params)
+            srp.action()
+            srp.params.action = None
+
+        elif mode == "--delta" or mode == "-d":
+            old, new = arg.split(',')
+            srp.params.delta = srp.DeltaParameters(old, new)
+            if srp.params.verbosity:
+                print(srp.params)
+            srp.delta()
+            srp.params.delta = None
 
         else:
             # shouldn't happen?
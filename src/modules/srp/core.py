@@ -6,16 +6,28 @@ functions that actually DO STUFF using the other components of srp).
 This module gets merged into the toplevel srp module.
 """
 
+# NOTE: Modules that are slow to import and only needed by a few functions
+#       (e.g., multiprocessing, subprocess and tarfile) get imported by
+#       those functions instead, so that every srp invocation doesn't have
+#       to pay for them.  See importcheck.py.
+#
+import collections
+import fnmatch
 import glob
+import hashlib
+import io
 import os
 import pickle
 import shutil
 import stat
-import tarfile
+import sys
+import tempfile
 import time
+import traceback
 import types
 
 import srp
+import srp.profiler
 
 
 class SrpObject:
@@ -59,12 +71,21 @@ class RunTimeParameters(SrpObject):
 
       install - instance of InstallParameters
 
+      install_batch - list of InstallParameters instances
+
+      build_batch - list of (BuildParameters, dict) tuples, where the
+          dict holds InstallParameters keyword arguments (other than pkg)
+          if the package is to be installed once it's been built, or is
+          None otherwise
+
       uninstall - instance of UninstallParameters
 
       query - instance of QueryParameters
 
       action - instance of ActionParameters
 
+      delta - instance of DeltaParameters
+
     Global Parameters:
 
       verbosity - Integer representing verbosity level.  0 is off, 1 is a
@@ -86,6 +107,17 @@ class RunTimeParameters(SrpObject):
           with "no_").  This list is used to modify the default list of
           enabled Features at run-time.
 
+      profile - Directory to write profiling data to (see srp.profiler).
+          Profiling is disabled if set to None (the default).
+
+      profile_funcs - If set to True (and profiling is enabled), each
+          Feature stage function gets profiled separately as well.
+
+      jobs - Maximum number of things (e.g., package installs) to do
+          concurrently.  Defaults to the number of CPUs.  When building
+          multiple packages, this is the total number of job slots shared
+          by all the build scripts (see build_batch).
+
 
     FIXME: should force be global? or specific to install, perhaps with a
            more detailed name?
@@ -95,32 +127,39 @@ class RunTimeParameters(SrpObject):
         # global params
         self.verbosity = 0
         self.dry_run = False
+        self.force = False
         self.root = "/"
         self.options = []
+        self.profile = None
+        self.profile_funcs = False
+        self.jobs = os.cpu_count() or 1
 
         # mode param instances
         self.build = None
         self.install = None
+        self.install_batch = None
+        self.build_batch = None
         self.uninstall = None
         self.query = None
         self.action = None
+        self.delta = None
 
     def __setattr__(self, name, value):
         """This special __setattr__ method does some extra work if `root' is
         being set.  Namely, it 1) ensures that the new rootdir exists, creating
-        it if needed, and 2) automatically re-invokes srp.db.load() if
-        it's already been loaded.
+        it if needed, and 2) invokes srp.db.unload() so that the db gets
+        re-loaded from the new root the next time it's needed.
 
         """
         # set it
         object.__setattr__(self, name, value)
 
-        # reload the database if we just modified 'root' and db module has
-        # already been loaded
+        # unload the database if we just modified 'root' and db module has
+        # already been imported
         if name == "root":
             os.makedirs(value, exist_ok=True)
             if hasattr(srp, "db"):
-                srp.db.load()
+                srp.db.unload()
 
 
 class BuildParameters(SrpObject):
@@ -135,15 +174,16 @@ class BuildParameters(SrpObject):
 
       extradir - Absolute, validated path.
 
-      copysrc - Same as param to __init__.
+      copysrc - Either False or one of the copy modes supported by
+          srp.utils.copytree (True gets stored as "reflink").
 
       gitsrc - Same as param to __init__.
 
-      update - Internally, we still go through some of the motions even if
-          the package is not being built.  This allows for enough of the
-          BuildWork to get populated for subsequent InstallParams to be
-          created (e.g., we can look at srp.work.build.notes to figure out
-          package name).
+      update - Stored as a bool.  Internally, we still go through some of
+          the motions even if the package is not being built.  This allows
+          for enough of the BuildWork to get populated for subsequent
+          InstallParams to be created (e.g., we can look at
+          srp.work.build.notes to figure out package name).
 
     NOTE: This describes how the data members DIFFER from the args passed
           into the constructor.  See __init__ for the full story.
@@ -166,16 +206,21 @@ class BuildParameters(SrpObject):
 
           copysrc - If set to True, the build will create a copy of the
               source tree (i.e., so we don't modify an external source
-              tree).  Defaults to False.
+              tree).  Files are cloned via reflinks if the filesystem
+              supports it and copied otherwise.  Can also be set to
+              "hardlink" (to create a hard link farm instead, which is
+              only safe if the build doesn't modify source files in place)
+              or "copy" (to force a plain copy).  Defaults to False.
 
           gitsrc - If specified, the build will create a copy of the
               source tree by cloning via git and checking out the
               specified branch ("HEAD" results in no additional checkout).
               Defaults to None.
 
-          update - If set to True, only build the package if the NOTES
-              file is newer than the built package (or the package hasn't
-              ever been built).  Defaults to False.
+          update - If set to True, only build the package if something
+              that goes into it has changed since the last time it was
+              built (or it hasn't ever been built).  See build_key for
+              what gets checked.  Defaults to False.
 
         NOTE: All paths can be specified as relative paths, but will get
               stored away as absolute paths after validation.
@@ -198,12 +243,17 @@ class BuildParameters(SrpObject):
         except:
             self.extradir = os.path.dirname(self.notes)
 
-        self.copysrc = copysrc
+        if copysrc in ("reflink", "hardlink", "copy"):
+            self.copysrc = copysrc
+        elif srp.utils.parse_bool(copysrc):
+            self.copysrc = "reflink"
+        else:
+            self.copysrc = False
         self.gitsrc = gitsrc
-        self.update = update
+        self.update = srp.utils.parse_bool(update)
 
         # error checking
-        if copysrc and gitsrc:
+        if self.copysrc and gitsrc:
             raise Exception("cannot specify both `copysrc` and `gitsrc`")
 
 
@@ -214,14 +264,16 @@ class InstallParameters(SrpObject):
 
       pkg - Absolute, validated path.
 
-      upgrade - Same as param to __init__.
+      upgrade - Stored as a bool.
+
+      staged - Stored as a bool.
 
     NOTE: This describes how the data members DIFFER from the args passed
           into the constructor.  See __init__ for the full story.
 
     """
-    __slots__ = ["pkg", "upgrade"]
-    def __init__(self, pkg, upgrade=True):
+    __slots__ = ["pkg", "upgrade", "staged"]
+    def __init__(self, pkg, upgrade=True, staged=False):
         """Args:
         
           pkg - Path to the package to be installed.
@@ -230,6 +282,13 @@ class InstallParameters(SrpObject):
               an error if the specified package is already installed.
               Defaults to True.
 
+          staged - Setting to True extracts every file next to its final
+              destination under a temporary name, flushes them all to disk
+              at once, and only then renames them into place.  This keeps
+              the system from being left half-updated (or with empty
+              files after a crash) for the whole install.  Defaults to
+              False.
+
         NOTE: All paths can be specified as relative paths, but will get
               stored away as absolute paths after validation.
 
@@ -238,7 +297,36 @@ class InstallParameters(SrpObject):
 
         """
         self.pkg = srp.utils.expand_path(pkg)
-        self.upgrade = upgrade
+        self.upgrade = srp.utils.parse_bool(upgrade)
+        self.staged = srp.utils.parse_bool(staged)
+
+
+class UninstallParameters(SrpObject):
+    """Class representing the parameters for srp.uninstall().
+
+    Data:
+
+      verify - Stored as a bool.
+
+    NOTE: This describes how the data members DIFFER from the args passed
+          into the constructor.  See __init__ for the full story.
+
+    """
+    __slots__ = ["pkg", "verify"]
+    def __init__(self, pkg, verify=False):
+        """Args:
+
+          pkg - Name of the installed package(s) to be uninstalled.  Can use
+              shell globbing (e.g., 'srp-example-*'), in which case every
+              matching installed package is uninstalled.
+
+          verify - Setting to True re-hashes every installed file before
+              removing it and warns about any that have been modified
+              (see --action verify).  Defaults to False.
+
+        """
+        self.pkg = pkg
+        self.verify = srp.utils.parse_bool(verify)
 
 
 class QueryParameters(SrpObject):
@@ -270,8 +358,79 @@ class QueryParameters(SrpObject):
         self.criteria = criteria
 
 
+class ActionParameters(SrpObject):
+    """Class representing the parameters for srp.action().
+
+    Data:
+
+      actions - Stored as a list.
+
+      criteria - Stored as a dict.
+
+      iolimit - Stored as an integer number of bytes per second (or None).
+
+    NOTE: This describes how the data members DIFFER from the args passed
+          into the constructor.  See __init__ for the full story.
+
+    """
+    __slots__ = ["actions", "criteria", "iolimit"]
+    def __init__(self, actions, criteria, iolimit=None):
+        """Args:
+
+          actions - Comma-delimited list of actions to perform on each
+              matching installed package (e.g., 'verify').
+
+          criteria - Comma-delimited list of key=val pairs describing the
+              installed packages to act on (e.g., 'pkg=*').  Same as for
+              --query, except only installed packages are matched.
+
+          iolimit - Limit on total disk read throughput for I/O heavy
+              actions (e.g., verify), in bytes per second.  Accepts K, M,
+              and G suffixes (e.g., '50M').  Defaults to no limit.
+
+        """
+        self.actions = actions
+        self.criteria = criteria
+        self.iolimit = None
+        if iolimit:
+            self.iolimit = srp.utils.parse_size(iolimit)
+
+
+class DeltaParameters(SrpObject):
+    """Class representing the parameters for srp.delta().
+
+    Data:
+
+      old - Absolute, validated path.
+
+      new - Absolute, validated path.
+
+    NOTE: This describes how the data members DIFFER from the args passed
+          into the constructor.  See __init__ for the full story.
+
+    """
+    __slots__ = ["old", "new"]
+    def __init__(self, old, new):
+        """Args:
+
+          old - Path to the package the delta will be installed over.
+
+          new - Path to the package the delta will upgrade it to.
+
+        NOTE: All paths can be specified as relative paths, but will get
+              stored away as absolute paths after validation.
+
+        NOTE: All paths can use shell globbing (e.g., src/foo/foo*.tar.*)
+              but MUST only result in a single match.
+
+        """
+        self.old = srp.utils.expand_path(old)
+        self.new = srp.utils.expand_path(new)
+
+
 # FIXME: decorator to purge topdir when we're done?
 
+@srp.profiler.profiled("build")
 def build():
     """Builds a package according to the RunTimeParameters instance
     `srp.params'.  All work is stored in the features.WorkBag instance
@@ -284,6 +443,19 @@ def build():
     # get some local refs with shorter names
     n = srp.work.build.notes
     funcs = srp.work.build.funcs
+
+    # reuse the package from last time if nothing's changed
+    if srp.params.build.update:
+        n.brp.build_key = build_key(n)
+        pname = brp_name(n)
+        try:
+            prev = read_notes(pname).brp.build_key
+        except Exception:
+            prev = None
+        if prev == n.brp.build_key:
+            print("{} is up to date, skipping build".format(pname))
+            n.brp.pname = pname
+            return
     iter_funcs = srp.work.build.iter_funcs
     final_funcs = srp.work.build.final_funcs
 
@@ -306,74 +478,303 @@ def build():
     if srp.params.verbosity:
         print(srp.work)
         print("build funcs:", funcs)
-    for f in funcs:
-        # check for notes section class and create if needed
-        section = getattr(getattr(srp.features, f.name),
-                          "Notes"+f.name.capitalize(), False)
-        if section and not getattr(n, f.name, False):
-            if srp.params.verbosity:
-                print("creating notes section:", f.name)
-            setattr(n, f.name, section())
-
-        if srp.params.verbosity:
-            print("executing:", f)
-        if not srp.params.dry_run:
-            try:
-                f.func()
-            except:
-                print("ERROR: failed feature stage function:", f)
-                raise
-
-    # now run through all queued up stage funcs for build_iter
-    #
-    # FIXME: multiprocessing
-    print("--- build_iter ---")
-    if srp.params.verbosity:
-        print("build_iter funcs:", iter_funcs)
-    for x in srp.work.build.manifest:
-        for f in iter_funcs:
+    with srp.profiler.region("build"):
+        for f in funcs:
             # check for notes section class and create if needed
             section = getattr(getattr(srp.features, f.name),
                               "Notes"+f.name.capitalize(), False)
             if section and not getattr(n, f.name, False):
-                if srp.params.verbosity > 1:
+                if srp.params.verbosity:
                     print("creating notes section:", f.name)
                 setattr(n, f.name, section())
 
-            if srp.params.verbosity > 1:
-                print("executing:", f, x)
+            if srp.params.verbosity:
+                print("executing:", f)
             if not srp.params.dry_run:
                 try:
-                    f.func(x)
+                    srp.profiler.call(f)
                 except:
                     print("ERROR: failed feature stage function:", f)
                     raise
 
+    # now run through all queued up stage funcs for build_iter
+    #
+    # FIXME: multiprocessing
+    print("--- build_iter ---")
+    if srp.params.verbosity:
+        print("build_iter funcs:", iter_funcs)
+    with srp.profiler.region("build_iter"):
+        for x in srp.work.build.manifest:
+            for f in iter_funcs:
+                # check for notes section class and create if needed
+                section = getattr(getattr(srp.features, f.name),
+                                  "Notes"+f.name.capitalize(), False)
+                if section and not getattr(n, f.name, False):
+                    if srp.params.verbosity > 1:
+                        print("creating notes section:", f.name)
+                    setattr(n, f.name, section())
+
+                if srp.params.verbosity > 1:
+                    print("executing:", f, x)
+                if not srp.params.dry_run:
+                    try:
+                        srp.profiler.call(f, x)
+                    except:
+                        print("ERROR: failed feature stage function:", f)
+                        raise
+
     # and now run all the stage funcs for build_final
     print("--- build_final ---")
     if srp.params.verbosity:
         print("build_final funcs:", final_funcs)
-    for f in final_funcs:
-        # FIXME: build has magic NotesThingy creation code... is that
-        #        needed here?  or even there?  i thought that just
-        #        happened during NotesFile()...
-        if srp.params.verbosity:
-            print("executing:", f)
-        if not srp.params.dry_run:
-            try:
-                f.func()
-            except:
-                print("ERROR: failed feature stage function:", f)
-                raise
+    with srp.profiler.region("build_final"):
+        for f in final_funcs:
+            # FIXME: build has magic NotesThingy creation code... is that
+            #        needed here?  or even there?  i thought that just
+            #        happened during NotesFile()...
+            if srp.params.verbosity:
+                print("executing:", f)
+            if not srp.params.dry_run:
+                try:
+                    srp.profiler.call(f)
+                except:
+                    print("ERROR: failed feature stage function:", f)
+                    raise
+
+
+def previous_deps(n):
+    """Returns the NotesDeps instance from the last time the package
+    described by srp.notes.NotesFile instance `n' was built (i.e., its brp
+    is in PWD) or installed, or None if we don't know.
+
+    """
+    pname = brp_name(n)
+    if os.path.exists(pname):
+        try:
+            return getattr(read_notes(pname), "deps", None)
+        except Exception:
+            pass
+    prevs = srp.db.lookup_by_name(n.header.name)
+    if prevs:
+        return getattr(prevs[-1].notes, "deps", None)
+    return None
 
 
-def install():
+def _build_child(conn, log, params, install_kwargs, jobserver):
+    """Entry point for each forked build process spawned by build_batch.
+    All our output goes to the `log' fd, and a (InstalledPackage, error)
+    tuple gets sent back to the parent via `conn' when we're done.
+
+    """
+    os.dup2(log, 1)
+    os.dup2(log, 2)
+    os.close(log)
+    sys.stdout.reconfigure(line_buffering=True)
+    try:
+        # each child needs its own topdir
+        srp.work = srp.features.WorkBag()
+        srp.work.jobserver = jobserver
+        srp.params.build = params
+        build()
+        inst = None
+        if install_kwargs is not None and not srp.params.dry_run:
+            kwargs = dict(install_kwargs, pkg=srp.work.build.notes.brp.pname)
+            srp.params.install = srp.InstallParameters(**kwargs)
+            install([])
+            inst = srp.work.install.installed
+        conn.send((inst, None))
+    except BaseException as e:
+        traceback.print_exc()
+        conn.send((None, "{}: {}".format(type(e).__name__, e)))
+    finally:
+        conn.close()
+        shutil.rmtree(srp.work.topdir, ignore_errors=True)
+
+
+@srp.profiler.profiled("build_batch")
+def build_batch():
+    """Builds (and optionally installs) a list of packages according to the
+    RunTimeParameters instance `srp.params'.
+
+    We can't know what libraries a package needs or provides until it's
+    been built, so packages are ordered by what they needed and provided
+    the last time they were built or installed (see previous_deps).
+    Packages we don't know that about are built after everything given
+    before them on the command line.  Each package is then built via
+    build() (and installed via install() if requested) in its own forked
+    process as soon as everything it depends on is done.
+
+    Concurrency is limited by a GNU make jobserver holding
+    srp.params.jobs job slots.  We take a slot for each build we start
+    (other than the first) and the build scripts get the jobserver via
+    MAKEFLAGS, so the build scripts' make jobs and our builds all share
+    the same budget.
+
+    Each package's output is echoed as it arrives with a [FULLNAME] prefix
+    (the build log itself goes to PWD/FULLNAME.log, see BuildLog).
+    Installed packages are registered with the db and the db is committed
+    once at the very end.  If any package fails, no new builds are
+    started.
+
+    NOTE: Feature stage funcs run in the child processes, so profiling
+          only covers the scheduling done here.
+
+    """
+    import multiprocessing
+    import multiprocessing.connection
+
+    params = srp.params.build_batch
+    notes = []
+    for b, i in params:
+        # NOTE: NotesFile needs the BuildParameters to validate things
+        srp.params.build = b
+        try:
+            with open(b.notes, "rb") as f:
+                n = srp.notes.NotesFile(f)
+        finally:
+            srp.params.build = None
+        n.deps = previous_deps(n)
+        notes.append(n)
+    deps = order_batch(notes)
+
+    # if we don't know what a package needs (e.g., it's never been built),
+    # it could need anything given before it (libraries, headers, build
+    # tools, etc), so it waits for all of them just like it would have
+    # before we started building things concurrently
+    #
+    # NOTE: Nothing can depend on one of these packages (we don't know
+    #       what it provides either), so this can't introduce a cycle.
+    for i, n in enumerate(notes):
+        if n.deps is None:
+            deps[i].update(range(i))
+    if srp.params.verbosity:
+        for i, n in enumerate(notes):
+            print("{} after {}".format(
+                n.header.fullname,
+                [notes[j].header.fullname for j in sorted(deps[i])]))
+
+    # create the jobserver, 1 slot is implicit
+    #
+    # NOTE: We read tokens via our own non-blocking open of the pipe (as
+    #       apposed to setting O_NONBLOCK on the shared read end), so the
+    #       makes reading from it don't get surprised.
+    jobserver = os.pipe()
+    os.write(jobserver[1], b"+" * (srp.params.jobs - 1))
+    tokens = os.open("/proc/self/fd/{}".format(jobserver[0]),
+                     os.O_RDONLY | os.O_NONBLOCK)
+    held = 0
+
+    ctx = multiprocessing.get_context("fork")
+    pending = list(range(len(params)))
+    running = {}
+    logs = {}
+    done = set()
+    failed = []
+    installed = False
+    try:
+        while running or logs or (pending and not failed):
+            ready = [i for i in pending if deps[i] <= done]
+            if not ready and not running and pending and not failed:
+                # circular dependency, just go in the order we were given
+                print("WARNING: circular library dependencies, building {}"
+                      " anyway".format(notes[pending[0]].header.fullname))
+                ready = pending[:1]
+
+            waiting = False
+            for i in ready:
+                if failed:
+                    break
+                if running:
+                    try:
+                        os.read(tokens, 1)
+                    except BlockingIOError:
+                        waiting = True
+                        break
+                    held += 1
+                pending.remove(i)
+                name = notes[i].header.fullname
+                print("building {}".format(name))
+                log_r, log_w = os.pipe()
+                r, w = ctx.Pipe(duplex=False)
+                # flush so the child doesn't inherit (and re-print) our
+                # buffered output
+                sys.stdout.flush()
+                sys.stderr.flush()
+                proc = ctx.Process(target=_build_child,
+                                   args=(w, log_w, params[i][0],
+                                         params[i][1], jobserver))
+                proc.start()
+                w.close()
+                os.close(log_w)
+                running[r] = (i, proc)
+                logs[log_r] = (name, [b""])
+
+            objs = list(running) + list(logs)
+            if waiting:
+                # wake up when a job slot frees up
+                objs.append(tokens)
+            for x in multiprocessing.connection.wait(objs):
+                if x in logs:
+                    name, partial = logs[x]
+                    buf = os.read(x, 65536)
+                    if not buf:
+                        if partial[0]:
+                            print("[{}] {}".format(
+                                name, partial[0].decode(errors="replace")))
+                        os.close(x)
+                        del logs[x]
+                        continue
+                    lines = (partial[0] + buf).split(b"\n")
+                    partial[0] = lines.pop()
+                    for line in lines:
+                        print("[{}] {}".format(
+                            name, line.decode(errors="replace")))
+
+                elif x in running:
+                    i, proc = running.pop(x)
+                    try:
+                        inst, err = x.recv()
+                    except EOFError:
+                        inst, err = None, "exited with status {}".format(
+                            proc.exitcode)
+                    x.close()
+                    proc.join()
+                    if held:
+                        os.write(jobserver[1], b"+")
+                        held -= 1
+                    done.add(i)
+                    if err:
+                        print("ERROR: failed to build {}: {}".format(
+                            notes[i].header.fullname, err))
+                        failed.append(notes[i].header.fullname)
+                    elif inst:
+                        srp.db.register(inst)
+                        installed = True
+    finally:
+        os.close(tokens)
+        os.close(jobserver[0])
+        os.close(jobserver[1])
+
+    # commit db to disk
+    if installed and not srp.params.dry_run:
+        srp.db.commit()
+
+    if failed:
+        raise Exception("failed to build: {}".format(", ".join(failed)))
+
+
+@srp.profiler.profiled("install")
+def install(batch=None):
     """Installs a package according to the RunTimeParameters instance
     `srp.params'.
 
+    If `batch' is specified, it's a list of srp.notes.NotesFile instances
+    for the other packages being installed in the same run, and committing
+    the db is left up to the caller (see install_batch).
+
     """
     # create our work instance
-    srp.work.install = srp.features.InstallWork()
+    srp.work.install = srp.features.InstallWork(batch)
 
     # get some local refs with shorter names
     n = srp.work.install.notes
@@ -389,66 +790,535 @@ def install():
     print("--- install ---")
     if srp.params.verbosity:
         print("install funcs:", funcs)
-    for f in funcs:
-        # check for notes section class and create if needed
-        section = getattr(getattr(srp.features, f.name),
-                          "Notes"+f.name.capitalize(), False)
-        if section and not getattr(n, f.name, False):
-            if srp.params.verbosity:
-                print("creating notes section:", f.name)
-            setattr(n, f.name, section())
-
-        if srp.params.verbosity:
-            print("executing:", f)
-        if not srp.params.dry_run:
-            try:
-                f.func()
-            except:
-                print("ERROR: failed feature stage function:", f)
-                raise
-
-    # now run through all queued up stage funcs for install_iter
-    #
-    # FIXME: multiprocessing
-    print("--- install_iter ---")
-    if srp.params.verbosity:
-        print("install_iter funcs:", iter_funcs)
-    for x in m:
-        for f in iter_funcs:
+    with srp.profiler.region("install"):
+        for f in funcs:
             # check for notes section class and create if needed
             section = getattr(getattr(srp.features, f.name),
                               "Notes"+f.name.capitalize(), False)
             if section and not getattr(n, f.name, False):
-                if srp.params.verbosity > 1:
+                if srp.params.verbosity:
                     print("creating notes section:", f.name)
                 setattr(n, f.name, section())
 
-            if srp.params.verbosity > 1:
-                print("executing:", f, x)
+            if srp.params.verbosity:
+                print("executing:", f)
             if not srp.params.dry_run:
                 try:
-                    f.func(x)
+                    srp.profiler.call(f)
                 except:
                     print("ERROR: failed feature stage function:", f)
+                    # don't leave staged files lying around
+                    srp.work.install.extract.close()
                     raise
 
+    # now run through all queued up stage funcs for install_iter
+    #
+    # FIXME: multiprocessing
+    print("--- install_iter ---")
+    if srp.params.verbosity:
+        print("install_iter funcs:", iter_funcs)
+    with srp.profiler.region("install_iter"):
+        for x in m.install_order():
+            for f in iter_funcs:
+                # check for notes section class and create if needed
+                section = getattr(getattr(srp.features, f.name),
+                                  "Notes"+f.name.capitalize(), False)
+                if section and not getattr(n, f.name, False):
+                    if srp.params.verbosity > 1:
+                        print("creating notes section:", f.name)
+                    setattr(n, f.name, section())
+
+                if srp.params.verbosity > 1:
+                    print("executing:", f, x)
+                if not srp.params.dry_run:
+                    try:
+                        srp.profiler.call(f, x)
+                    except:
+                        print("ERROR: failed feature stage function:", f)
+                        # don't leave staged files lying around
+                        srp.work.install.extract.close()
+                        raise
+
+    # everything's been extracted, so if we're staging, this is where it all
+    # gets moved into place
+    #
+    # NOTE: This has to happen before any install_final funcs run, since
+    #       they expect to find the installed files at their final paths
+    #       (e.g., the postinstall script).
+    if not srp.params.dry_run:
+        srp.work.install.extract.commit()
+
     # and now run all the stage funcs for install_final
     print("--- install_final ---")
     if srp.params.verbosity:
         print("install_final funcs:", final_funcs)
-    for f in final_funcs:
-        # FIXME: build has magic NotesThingy creation code... is that
-        #        needed here?  or even there?  i thought that just
-        #        happened during NotesFile()...
-        if srp.params.verbosity:
-            print("executing:", f)
-        if not srp.params.dry_run:
+    with srp.profiler.region("install_final"):
+        for f in final_funcs:
+            # FIXME: build has magic NotesThingy creation code... is that
+            #        needed here?  or even there?  i thought that just
+            #        happened during NotesFile()...
+            if srp.params.verbosity:
+                print("executing:", f)
+            if not srp.params.dry_run:
+                try:
+                    srp.profiler.call(f)
+                except:
+                    print("ERROR: failed feature stage function:", f)
+                    # don't leave staged files lying around
+                    srp.work.install.extract.close()
+                    raise
+
+
+
+@srp.profiler.profiled("delta")
+def delta():
+    """Creates a delta package according to the RunTimeParameters instance
+    `srp.params'.
+
+    The delta package (drp) can be installed in place of the new brp on any
+    system that has the old one installed (see srp.bdiff).  It's an
+    uncompressed tar archive (the data in it is already compressed) holding
+    the new package's NOTES, a pickled srp.bdiff.BlobDelta instance
+    (DELTA), the data for all the changed files (DATA), and a SHA just like
+    a brp.
+
+    """
+    import tarfile
+    import srp.bdiff
+
+    blobs = []
+    notes = []
+    for pkg in (srp.params.delta.old, srp.params.delta.new):
+        with tarfile.open(pkg) as p:
+            srp.features.verify_sha(p)
+            notes.append(p.extractfile("NOTES").read())
+            path = os.path.join(srp.work.topdir, "delta", str(len(blobs)))
+            p.extract("BLOB", path)
+            blobs.append(srp.blob.BlobFile.fromfile(path + "/BLOB"))
+    old, new = [pickle.loads(x) for x in notes]
+
+    if old.header.name != new.header.name:
+        raise Exception("{} and {} are different packages".format(
+            old.header.name, new.header.name))
+
+    dname = brp_name(new)[:-len(".brp")]
+    dname = dname.replace(new.header.fullname, "{}.from-{}-{}".format(
+        new.header.fullname, old.header.version, old.header.pkg_rev), 1)
+    dname += ".drp"
+    print("creating", dname)
+    if srp.params.dry_run:
+        return
+
+    with tempfile.TemporaryFile() as data:
+        d = srp.bdiff.BlobDelta.fromblobs(old.header.fullname, blobs[0],
+                                          blobs[1], data)
+        members = [("NOTES", notes[1]), ("DELTA", pickle.dumps(d))]
+        sha = hashlib.new("sha1")
+        with tarfile.open(dname, "w") as drp:
+            for name, buf in members:
+                sha.update(buf)
+                t = tarfile.TarInfo(name)
+                t.size = len(buf)
+                t.mtime = time.time()
+                drp.addfile(t, io.BytesIO(buf))
+
+            data.seek(0)
+            t = drp.gettarinfo(arcname="DATA", fileobj=data)
+            drp.addfile(t, data)
+            data.seek(0)
+            while True:
+                buf = data.read(1024*1024)
+                if not buf:
+                    break
+                sha.update(buf)
+
+            buf = sha.hexdigest().encode()
+            t = tarfile.TarInfo("SHA")
+            t.size = len(buf)
+            t.mtime = time.time()
+            drp.addfile(t, io.BytesIO(buf))
+
+    for b in blobs:
+        b.fobj.close()
+
+    counts = collections.Counter(x[0] for x in d.files.values())
+    print("{} unchanged, {} patched, {} replaced: {} bytes (vs {})".format(
+        counts["same"], counts["patch"], counts["data"],
+        os.path.getsize(dname), os.path.getsize(srp.params.delta.new)))
+
+
+def brp_name(n):
+    """Returns the filename of the brp built from srp.notes.NotesFile
+    instance `n'.
+
+    """
+    import platform
+
+    mach = platform.machine()
+    if not mach:
+        mach = "unknown"
+    return "{}.{}.brp".format(n.header.fullname, mach)
+
+
+def _hash_path(sha, path, exclude):
+    """Updates hashlib object `sha' with the contents of file or directory
+    `path', skipping any file matching the `exclude' list of absolute paths
+    (which may contain fnmatch wildcards in the last path component).
+
+    NOTE: Directory trees are walked in sorted order and each file's
+          relative path and permissions are included, so renames and chmods
+          are noticed.  Symlinks are not followed, we just hash where they
+          point.  Version control dirs are skipped.
+
+    """
+    def hash_file(fname):
+        with open(fname, "rb") as f:
+            while True:
+                buf = f.read(1024*1024)
+                if not buf:
+                    break
+                sha.update(buf)
+
+    if not os.path.isdir(path):
+        hash_file(path)
+        return
+
+    for top, dirs, files in os.walk(path):
+        dirs[:] = sorted(x for x in dirs if x not in (".git", ".svn", ".hg"))
+        skip = [os.path.basename(x) for x in exclude
+                if os.path.dirname(x) == top]
+        for x in sorted(files):
+            if any(fnmatch.fnmatchcase(x, pat) for pat in skip):
+                continue
+            fname = os.path.join(top, x)
+            st = os.lstat(fname)
+            sha.update("{}:{:o}\0".format(os.path.relpath(fname, path),
+                                           stat.S_IMODE(st.st_mode)).encode())
+            if stat.S_ISLNK(st.st_mode):
+                sha.update(os.readlink(fname).encode())
+            elif stat.S_ISREG(st.st_mode):
+                hash_file(fname)
+
+
+def build_key(n):
+    """Returns a hex digest of everything that goes into building the
+    package described by srp.notes.NotesFile instance `n' according to
+    srp.params.build: the NOTES file, the source tarball or tree (or git
+    revision, for gitsrc), the extra_content files, the list of enabled
+    features, and the version of srp.
+
+    NOTE: If the build script modifies the source tree (e.g., bootstrapping
+          or building in-tree w/out copysrc), the next build won't match.
+
+    NOTE: Only computed for update builds, since it means reading the
+          whole source tree.
+
+    """
+    import subprocess
+
+    sha = hashlib.new("sha256")
+    sha.update(srp.config.version.encode())
+    sha.update(repr(sorted(n.header.features)).encode())
+    with open(srp.params.build.notes, "rb") as f:
+        sha.update(f.read())
+
+    # don't include our own output if it's being written into the source
+    # tree
+    pname = brp_name(n)
+    exclude = [os.path.abspath(x) for x in (pname, n.header.fullname+".log")]
+
+    # ...or anyone else's, if the source tree is the dir the NOTES file is
+    # in (i.e., packages that share a dir would never be up to date)
+    notesdir = os.path.dirname(srp.params.build.notes)
+    if os.path.abspath(srp.params.build.src) == notesdir:
+        exclude.extend(os.path.join(notesdir, x) for x in ("*.brp", "*.log"))
+
+    if srp.params.build.gitsrc:
+        rev = subprocess.check_output(
+            ["git", "rev-parse", srp.params.build.gitsrc],
+            cwd=srp.params.build.src)
+        sha.update(rev)
+    else:
+        _hash_path(sha, srp.params.build.src, exclude)
+    for x in n.header.extra_content:
+        sha.update(os.path.basename(x).encode() + b"\0")
+        _hash_path(sha, x, exclude)
+    return sha.hexdigest()
+
+
+def read_notes(pkg):
+    """Returns the srp.notes.NotesFile instance stored in package file
+    `pkg', without extracting anything else.
+
+    """
+    import tarfile
+
+    with tarfile.open(pkg) as p:
+        return pickle.load(p.extractfile("NOTES"))
+
+
+def order_batch(notes):
+    """Returns a list with an entry for each srp.notes.NotesFile instance in
+    `notes', each of which is the set of indices of the other packages that
+    need to be installed first (i.e., they provide libraries it needs).
+
+    NOTE: Multiple versions of the same package get installed in the order
+          they were given.
+
+    """
+    providers = {}
+    for i, n in enumerate(notes):
+        for x in getattr(getattr(n, "deps", None), "libs_provided", []):
+            providers.setdefault(tuple(x), set()).add(i)
+
+    retval = []
+    for i, n in enumerate(notes):
+        before = set()
+        for x in getattr(getattr(n, "deps", None), "libs_needed", []):
+            before.update(providers.get(tuple(x), ()))
+        for j in range(i):
+            if notes[j].header.name == n.header.name:
+                before.add(j)
+        before.discard(i)
+        retval.append(before)
+    return retval
+
+
+def _install_child(conn, params, batch):
+    """Entry point for each forked install process spawned by
+    install_batch.  Sends an (InstalledPackage, replaced InstalledPackage,
+    error) tuple back to the parent via `conn'.
+
+    """
+    try:
+        # each child needs its own topdir
+        srp.work = srp.features.WorkBag()
+        srp.params.install = params
+        install(batch)
+        conn.send((srp.work.install.installed, srp.work.install.prev, None))
+    except BaseException as e:
+        traceback.print_exc()
+        conn.send((None, None, "{}: {}".format(type(e).__name__, e)))
+    finally:
+        conn.close()
+        shutil.rmtree(srp.work.topdir, ignore_errors=True)
+
+
+@srp.profiler.profiled("install_batch")
+def install_batch():
+    """Installs a list of packages according to the RunTimeParameters
+    instance `srp.params'.
+
+    The NOTES file of every package is read up front so we can order the
+    installs by library dependencies.  Each package then gets installed
+    via install() in its own forked process, running up to srp.params.jobs
+    at once as soon as all of its dependencies have been installed.  The
+    resulting InstalledPackage instances are sent back to us, registered,
+    and the db is committed once at the very end.
+
+    If any package fails to install, no new installs are started but
+    everything that did get installed is still committed to the db.
+
+    NOTE: Packages are assumed not to overwrite each other's files (other
+          than newer versions of the same package, which are installed in
+          order).  If they do, which one wins is undefined.
+
+    NOTE: Feature stage funcs run in the child processes, so profiling
+          only covers the scheduling done here.
+
+    """
+    import multiprocessing
+    import multiprocessing.connection
+
+    params = srp.params.install_batch
+    notes = [read_notes(x.pkg) for x in params]
+    deps = order_batch(notes)
+    if srp.params.verbosity:
+        for i, n in enumerate(notes):
+            print("{} after {}".format(
+                n.header.fullname,
+                [notes[j].header.fullname for j in sorted(deps[i])]))
+
+    # NOTE: We have to fork (as apposed to spawn) so that the children
+    #       inherit our params, loaded db, registered features, etc.
+    ctx = multiprocessing.get_context("fork")
+    pending = list(range(len(params)))
+    running = {}
+    done = set()
+    failed = []
+    while running or (pending and not failed):
+        ready = [i for i in pending if deps[i] <= done]
+        if not ready and not running and not failed:
+            # circular dependency, just go in the order we were given
+            print("WARNING: circular library dependencies, installing {}"
+                  " anyway".format(notes[pending[0]].header.fullname))
+            ready = pending[:1]
+
+        for i in ready:
+            if len(running) >= srp.params.jobs or failed:
+                break
+            pending.remove(i)
+            print("installing {}".format(notes[i].header.fullname))
+            r, w = ctx.Pipe(duplex=False)
+            others = notes[:i] + notes[i+1:]
+            # flush so the child doesn't inherit (and re-print) our
+            # buffered output
+            sys.stdout.flush()
+            sys.stderr.flush()
+            proc = ctx.Process(target=_install_child,
+                               args=(w, params[i], others))
+            proc.start()
+            w.close()
+            running[r] = (i, proc)
+
+        for r in multiprocessing.connection.wait(list(running)):
+            i, proc = running.pop(r)
             try:
-                f.func()
-            except:
-                print("ERROR: failed feature stage function:", f)
-                raise
+                inst, prev, err = r.recv()
+            except EOFError:
+                inst, prev, err = None, None, "exited with status {}".format(
+                    proc.exitcode)
+            r.close()
+            proc.join()
+            done.add(i)
+            if err:
+                print("ERROR: failed to install {}: {}".format(
+                    notes[i].header.fullname, err))
+                failed.append(notes[i].header.fullname)
+            elif inst and prev:
+                srp.db.replace(prev, inst)
+            elif inst:
+                srp.db.register(inst)
+
+    # commit db to disk
+    if not srp.params.dry_run:
+        srp.db.commit()
+
+    if failed:
+        raise Exception("failed to install: {}".format(", ".join(failed)))
+
+
+@srp.profiler.profiled("uninstall")
+def uninstall():
+    """Uninstalls package(s) according to the RunTimeParameters instance
+    `srp.params'.  All work is stored in the features.WorkBag instance
+    `srp.work'.
+
+    NOTE: If nothing matching is installed, we just say so and return
+          successfully.
+
+    """
+    pkgs = srp.db.lookup_by_name(srp.params.uninstall.pkg)
+    if not pkgs:
+        print("Package {} not installed".format(srp.params.uninstall.pkg))
+        return
+
+    for p in pkgs:
+        # create our work instance
+        srp.work.uninstall = srp.features.UninstallWork(p)
+
+        # get some local refs with shorter names
+        m = srp.work.uninstall.manifest
+        funcs = srp.work.uninstall.funcs
+        iter_funcs = srp.work.uninstall.iter_funcs
+        final_funcs = srp.work.uninstall.final_funcs
+        times = srp.work.uninstall.times
+
+        print("uninstalling:", p.notes.header.fullname)
+        if srp.params.verbosity:
+            print(srp.work)
+
+        # run through uninstall funcs
+        print("--- uninstall ---")
+        if srp.params.verbosity:
+            print("uninstall funcs:", funcs)
+        times["uninstall"] = time.time()
+        with srp.profiler.region("uninstall"):
+            for f in funcs:
+                if srp.params.verbosity:
+                    print("executing:", f)
+                if not srp.params.dry_run:
+                    try:
+                        srp.profiler.call(f)
+                    except:
+                        print("ERROR: failed feature stage function:", f)
+                        raise
+        times["uninstall"] = time.time() - times["uninstall"]
+
+        # now run through all the stage funcs for uninstall_iter
+        print("--- uninstall_iter ---")
+        if srp.params.verbosity:
+            print("uninstall_iter funcs:", iter_funcs)
+        times["uninstall_iter"] = time.time()
+        with srp.profiler.region("uninstall_iter"):
+            for x in m:
+                for f in iter_funcs:
+                    if srp.params.verbosity > 1:
+                        print("executing:", f, x)
+                    if not srp.params.dry_run:
+                        try:
+                            srp.profiler.call(f, x)
+                        except:
+                            print("ERROR: failed feature stage function:", f)
+                            raise
+        times["uninstall_iter"] = time.time() - times["uninstall_iter"]
+
+        # and now run all the stage funcs for uninstall_final
+        print("--- uninstall_final ---")
+        if srp.params.verbosity:
+            print("uninstall_final funcs:", final_funcs)
+        times["uninstall_final"] = time.time()
+        with srp.profiler.region("uninstall_final"):
+            for f in final_funcs:
+                if srp.params.verbosity:
+                    print("executing:", f)
+                if not srp.params.dry_run:
+                    try:
+                        srp.profiler.call(f)
+                    except:
+                        print("ERROR: failed feature stage function:", f)
+                        raise
+        times["uninstall_final"] = time.time() - times["uninstall_final"]
+
+        if srp.params.verbosity:
+            print("uninstall timings:", ", ".join(
+                "{}={:.3f}s".format(k, v) for k, v in times.items()))
+
 
+@srp.profiler.profiled("action")
+def action():
+    """Performs actions on installed packages according to the
+    RunTimeParameters instance `srp.params'.  All work is stored in the
+    features.WorkBag instance `srp.work'.
+
+    NOTE: Each action's stage funcs are called once (with no args) for the
+          whole list of matching packages in srp.work.action.packages,
+          which lets I/O heavy actions (e.g., verify) make a single pass
+          over everything.
+
+    """
+    # create our work instance
+    srp.work.action = srp.features.ActionWork()
+
+    if srp.params.verbosity:
+        print(srp.work)
+    print("packages:", [p.notes.header.fullname
+                        for p in srp.work.action.packages])
+    for a in srp.params.action.actions:
+        funcs = srp.work.action.funcs[a]
+        print("--- {} ---".format(a))
+        if srp.params.verbosity:
+            print("{} funcs:".format(a), funcs)
+        with srp.profiler.region(a):
+            for f in funcs:
+                if srp.params.verbosity:
+                    print("executing:", f)
+                if not srp.params.dry_run:
+                    try:
+                        srp.profiler.call(f)
+                    except:
+                        print("ERROR: failed feature action function:", f)
+                        raise
 
 
 # FIXME: Need to document these query type and criteria ramblings
@@ -502,6 +1372,7 @@ def install():
 # Everything, and I mean everything, about a package:
 #   srp -q raw,pkg=srp-example
 #
+@srp.profiler.profiled("query")
 def query():
     """Performs a query according to the RunTimeParamters instance
     `srp.params'.
@@ -559,6 +1430,8 @@ def query():
 #        API.
 #
 def query_pkg(name):
+    import tarfile
+
     if os.path.exists(name):
         # query package file on disk
         #
@@ -599,10 +1472,11 @@ def format_results_info(p):
     info.append("Package: {}".format(format_results_name(p)))
     info.append("Description: {}".format(p.notes.header.description))
     
-    for f in srp.features.registered_features:
-        info_func = srp.features.registered_features[f].info
-        if info_func:
-            info.append(info_func(p))
+    for f in srp.features.feature_index:
+        # NOTE: Checking the feature_index first means we only import the
+        #       Features that actually have an info func.
+        if srp.features.feature_index[f].info:
+            info.append(srp.features.registered_features[f].info(p))
 
     return "\n".join(info)
 
@@ -611,11 +1485,19 @@ def format_results_files(p):
     return "\n".join(p.manifest.sortedkeys)
 
 
-def format_tinfo(t):
+def format_tinfo(t, ids=None):
+    """Returns a line of ls -l style output for TarInfo object `t'.  If
+    it's missing a user or group name, it's looked up by id in
+    srp.utils.IdMap instance `ids' (defaults to the one for
+    srp.params.root).
+
+    """
     fmt = "{mode} {uid:8} {gid:8} {size:>8} {date} {name}{link}"
     mode = stat.filemode(t.mode)
-    uid = t.uname or t.uid
-    gid = t.gname or t.gid
+    if not (t.uname and t.gname) and ids is None:
+        ids = srp.utils.idmap(srp.params.root)
+    uid = t.uname or ids.uname(t.uid) or t.uid
+    gid = t.gname or ids.gname(t.gid) or t.gid
     if t.ischr() or t.isblk():
         size = "{},{}".format(t.devmajor, t.devminor)
     else:
@@ -634,9 +1516,10 @@ def format_tinfo(t):
 
 def format_results_stats(p):
     retval = []
+    ids = srp.utils.idmap(srp.params.root)
     for f in p.manifest:
         tinfo = p.manifest[f]["tinfo"]
-        retval.append(format_tinfo(tinfo))
+        retval.append(format_tinfo(tinfo, ids))
     return "\n".join(retval)
 
 
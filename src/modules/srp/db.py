@@ -1,13 +1,15 @@
 """The SRP db module - on-disk representation of installed pacakges and
 lookup functions
 """
+import contextlib
+import fcntl
 import os
 import pickle
 import hashlib
 import fnmatch
+import functools
 
 import srp
-from pprint import pprint
 
 
 # let's store the db as a pickled map
@@ -90,9 +92,82 @@ class InstalledPackage(srp.SrpObject):
 #__db = {}
 
 
+# If an srp db server is running for our root (see srp.dbserver), we don't
+# load the db at all.  Instead, the functions below that use it are
+# forwarded to the server.
+#
+# NOTE: serving is set in the server process itself, so it doesn't try to
+#       forward requests to itself.
+#
+serving = False
+_conn = None
+_conn_pid = None
+
+
+def _connection():
+    """returns our connection to the db server, or None if there isn't one"""
+    global _conn, _conn_pid
+    if _conn and _conn_pid != os.getpid():
+        # NOTE: We've been forked (e.g., by install_batch), and the child
+        #       can't share the parent's connection w/out their requests
+        #       and replies getting mixed up.
+        _conn = _connect()
+        _conn_pid = os.getpid()
+    return _conn
+
+
+def _connect():
+    """returns a new connection to the db server for our root, or None if
+    there isn't one running"""
+    # NOTE: Don't bother importing srp.dbserver (and multiprocessing) unless
+    #       there's a socket there to connect to.
+    path = sockpath()
+    if not os.path.exists(path):
+        return None
+    import srp.dbserver
+    return srp.dbserver.connect(path)
+
+
+def sockpath():
+    """returns the path of the db server's socket for our root"""
+    # NOTE: We have to chop the leading '/' off of fname so that
+    #       os.path.join will really add in our root path.
+    #
+    return os.path.join(srp.params.root, dbpath[1:]) + ".sock"
+
+
+def _call(method, *args):
+    """runs method on the db server, returning the result"""
+    conn = _connection()
+    conn.send((method, args))
+    ok, ret = conn.recv()
+    if not ok:
+        raise Exception("db server failed {}: {}".format(method, ret))
+    return ret
+
+
+def _remote(func):
+    """decorator that forwards calls to func to the db server, if we're
+    connected to one (loading the db or connecting first, if needed)"""
+    @functools.wraps(func)
+    def wrapper(*args):
+        if not _ready:
+            load()
+        if _connection():
+            return _call(func.__name__, *args)
+        return func(*args)
+    return wrapper
+
+
+@_remote
 def register(p):
     """register InstalledPackage instance p in the db"""
+    _journal.append((register, (p,)))
     name = p.notes.header.name
+    # NOTE: This can happen when commit() replays our changes on top of
+    #       somebody else's.
+    if p.sha in [x.sha for x in __db.get(name, [])]:
+        return
     # FIXME: should the __db[name] entry be a list or a dict? for now it's
     #        a list, but we should revisit this once we've had a chance to
     #        figure out what the API is gonna be like... a dict might make
@@ -103,48 +178,336 @@ def register(p):
     except:
         __db[name] = [p]
 
+    index_provides(p)
+    index_dirs(p)
+
+
+@_remote
+def replace(old, new):
+    """replace InstalledPackage instance old with new in the db (e.g., when
+    upgrading), keeping its place in the list of installed versions"""
+    _journal.append((replace, (old, new)))
+    name = old.notes.header.name
+    pkgs = __db.get(name, [])
+    for i, x in enumerate(pkgs):
+        if x.sha == old.sha:
+            pkgs[i] = new
+            break
+    else:
+        register(new)
+        return
+
+    unindex_provides(old)
+    unindex_dirs(old)
+    index_provides(new)
+    index_dirs(new)
+
+
+@_remote
+def unregister(p):
+    """remove InstalledPackage instance p from the db"""
+    _journal.append((unregister, (p,)))
+    name = p.notes.header.name
+    # NOTE: This can happen when commit() replays our changes on top of
+    #       somebody else's.
+    if p.sha not in [x.sha for x in __db.get(name, [])]:
+        return
+    __db[name] = [x for x in __db[name] if x.sha != p.sha]
+    if not __db[name]:
+        del __db[name]
+
+    unindex_provides(p)
+    unindex_dirs(p)
+
+
+# In addition to the db itself, we keep an index of which packages provide
+# each library, so that dependency checks don't have to go digging through
+# every installed package (or the filesystem).
+#
+# __provides = {(file_format, soname): [pkgname, ...], ...}
+#
+# NOTE: This gets pickled alongside the db (at dbpath + ".provides") and is
+#       regenerated from the db if it's missing.
+#
+__provides = {}
+
+
+def index_provides(p):
+    """add libs provided by InstalledPackage instance p to the provides
+    index"""
+    name = p.notes.header.name
+    try:
+        libs = p.notes.deps.libs_provided
+    except AttributeError:
+        # deps feature wasn't enabled for this package
+        return
+    for x in libs:
+        names = __provides.setdefault(tuple(x), [])
+        if name not in names:
+            names.append(name)
+
+
+def unindex_provides(p):
+    """remove libs provided by InstalledPackage instance p from the provides
+    index, unless another installed version of the same package still
+    provides them"""
+    name = p.notes.header.name
+    try:
+        libs = p.notes.deps.libs_provided
+    except AttributeError:
+        return
+    still = set()
+    for other in __db.get(name, []):
+        try:
+            still.update(map(tuple, other.notes.deps.libs_provided))
+        except AttributeError:
+            pass
+    for x in map(tuple, libs):
+        if x in still:
+            continue
+        names = __provides.get(x, [])
+        if name in names:
+            names.remove(name)
+        if not names:
+            __provides.pop(x, None)
+
+
+def rebuild_provides():
+    """regenerate the provides index from scratch"""
+    global __provides
+    __provides = {}
+    for name in __db:
+        for p in __db[name]:
+            index_provides(p)
+
+
+# We also keep a count of how many installed packages contain each
+# directory, so that uninstall knows which directories it's allowed to
+# remove without having to go through every other package's manifest.
+#
+# __dirs = {"/usr/bin": 12, ...}
+#
+# NOTE: Like the provides index, this gets pickled alongside the db (at
+#       dbpath + ".dirs") and is regenerated from the db if it's missing.
+#
+__dirs = {}
+
+
+def index_dirs(p):
+    """add directories in InstalledPackage instance p's manifest to the
+    directory refcount index"""
+    m = p.manifest
+    for fname in m:
+        if m[fname]["tinfo"].isdir():
+            __dirs[fname] = __dirs.get(fname, 0) + 1
+
+
+def unindex_dirs(p):
+    """remove directories in InstalledPackage instance p's manifest from the
+    directory refcount index"""
+    m = p.manifest
+    for fname in m:
+        if m[fname]["tinfo"].isdir():
+            n = __dirs.get(fname, 0) - 1
+            if n > 0:
+                __dirs[fname] = n
+            else:
+                __dirs.pop(fname, None)
+
+
+def rebuild_dirs():
+    """regenerate the directory refcount index from scratch"""
+    global __dirs
+    __dirs = {}
+    for name in __db:
+        for p in __db[name]:
+            index_dirs(p)
+
+
+@_remote
+def dir_refcount(dname):
+    """returns the number of installed packages containing directory dname
+    (a manifest-style name, like /usr/bin)"""
+    return __dirs.get(dname, 0)
+
 
 # FIXME: path to db in config?
 #
 dbpath = "/var/lib/srp/db"
 
 
+# Multiple srp processes can be using the same db at once (e.g., parallel
+# installs into the same root), so every process holds an fcntl lock on a
+# lock file beside the db while reading it (shared) or writing it
+# (exclusive).  That keeps anyone from reading a half-written db, but
+# commit() also has to make sure we don't overwrite changes that somebody
+# else committed since we loaded.  So, we keep a journal of the changes
+# we've made (register, replace, and unregister calls), and if the db on
+# disk has changed, commit() re-loads it and replays the journal on top of
+# it before writing it back out.
+#
+# NOTE: The indexes get updated by the replayed calls, so they're merged
+#       right along with the db.
+#
+_journal = []
+
+# identifies the version of the db file we loaded (see _stamp)
+_loaded = None
+
+# NOTE: The db doesn't get loaded until something actually needs it (e.g.,
+#       the first lookup), so that things like --build and --help don't
+#       have to wait for it.
+_ready = False
+
+
+@contextlib.contextmanager
+def _locked(path, how):
+    """holds fcntl lock how (LOCK_SH or LOCK_EX) on the lock file for the db
+    at path"""
+    fd = None
+    try:
+        fd = os.open(path + ".lock", os.O_RDWR | os.O_CREAT | os.O_CLOEXEC,
+                     0o644)
+    except OSError:
+        # NOTE: Readers who can't create the lock file (e.g., a normal user
+        #       querying the system db before it exists) will just have to
+        #       do without it.  Writers must have it.
+        if how == fcntl.LOCK_EX:
+            raise
+    try:
+        if fd is not None:
+            fcntl.flock(fd, how)
+        yield
+    finally:
+        if fd is not None:
+            os.close(fd)
+
+
+def _stamp(path):
+    """returns something that changes each time the db at path is
+    committed, or None if there isn't one"""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+def _dump(obj, fname):
+    """pickles obj to fname by way of a temp file, so anyone reading fname
+    sees either the old or the new version"""
+    with open(fname + ".tmp", "wb") as f:
+        pickle.dump(obj, f)
+    os.replace(fname + ".tmp", fname)
+
+
 def commit():
-    """re-pickle __db to disk"""
+    """re-pickle __db to disk, merging in changes committed by anyone else
+    since we loaded it"""
+    global _loaded
+
     # FIXME: should we keep a backup of the last pickle, just in case?
 
     # NOTE: We have to chop the leading '/' off of fname so that
     #       os.path.join will really add in our root path.
     #
     path = os.path.join(srp.params.root, dbpath[1:])
+    if not _ready:
+        load()
+    if _connection():
+        # NOTE: The server batches up commits, so this just tells it we're
+        #       done making changes.
+        print("commiting db via {}".format(sockpath()))
+        _call("commit")
+        return
     print("commiting db to {}".format(path))
 
     os.makedirs(os.path.dirname(path), exist_ok=True)
-    with open(path, "wb") as f:
-        pickle.dump(__db, f)
+    with _locked(path, fcntl.LOCK_EX):
+        if _stamp(path) != _loaded:
+            ops = _journal[:]
+            if srp.params.verbosity:
+                print("db changed since it was loaded, merging {}"
+                      " changes".format(len(ops)))
+            _read(path)
+            for func, args in ops:
+                func(*args)
+        _dump(__db, path)
+        _dump(__provides, path + ".provides")
+        _dump(__dirs, path + ".dirs")
+        _loaded = _stamp(path)
+    del _journal[:]
+
+
+def _read(path):
+    """un-pickle __db and its indexes from path, which must be locked"""
+    global __db, __provides, __dirs, _loaded
+
+    _loaded = _stamp(path)
+    try:
+        with open(path, "rb") as f:
+            __db = pickle.load(f)
+    except IOError:
+        __db = {}
+    except Exception as e:
+        # NOTE: Anything other than IOError means the file was there but
+        #       corrupt... user is gonna want to know about that.
+        print("ERROR: failed to load __db:", e)
+        raise
+
+    # NOTE: The provides index is just an optimization, so if it's missing
+    #       or corrupt we quietly regenerate it.
+    try:
+        with open(path + ".provides", "rb") as f:
+            __provides = pickle.load(f)
+    except Exception:
+        rebuild_provides()
+
+    try:
+        with open(path + ".dirs", "rb") as f:
+            __dirs = pickle.load(f)
+    except Exception:
+        rebuild_dirs()
+
+
+def unload():
+    """forget the loaded db (e.g., because srp.params.root changed), so it
+    gets loaded again next time it's needed"""
+    global _ready, _conn
+    if _conn:
+        _conn.close()
+    _conn = None
+    _ready = False
 
 
 def load():
-    """un-pickle __db from disk"""
-    global __db
+    """un-pickle __db from disk (or connect to the db server)"""
+    global __db, _conn, _conn_pid, _ready
 
     # NOTE: We have to chop the leading '/' off of fname so that
     #       os.path.join will really add in our root path.
     #
     path = os.path.join(srp.params.root, dbpath[1:])
+    del _journal[:]
+    _ready = True
+
+    if _conn:
+        _conn.close()
+    _conn = None
+    if not serving:
+        _conn = _connect()
+        _conn_pid = os.getpid()
+    if _conn:
+        if srp.params.verbosity or srp.params.root != "/":
+            print("using db server at {}".format(sockpath()))
+        __db = {}
+        return
+
     if srp.params.verbosity or srp.params.root != "/":
         print("loading db from {}".format(path))
 
-    try:
-        with open(path, "rb") as f:
-            __db = pickle.load(f)
-    except IOError:
-        __db = {}
-    except Exception as e:
-        # NOTE: Anything other than IOError means the file was there but
-        #       corrupt... user is gonna want to know about that.
-        print("ERROR: failed to load __db:", e)
-        raise
+    with _locked(path, fcntl.LOCK_SH):
+        _read(path)
 
 
 #srp.db.foo = [{"af4237": {
@@ -169,6 +532,8 @@ def load():
 
 #def lookup_by_dep_lib(libname):
 #    pass
+#
+# NOTE: ^^^ That's lookup_by_lib, below.
 
 #def lookup_by_builder():
 #    pass
@@ -178,6 +543,7 @@ def load():
 # should we just plumb something up to dynamically query on any field in
 # NOTES?
 
+@_remote
 def lookup_by_name(name):
     retval = []
     if srp.params.verbosity:
@@ -190,12 +556,24 @@ def lookup_by_name(name):
     return retval
 
 
+@_remote
+def lookup_by_lib(libinfo):
+    """returns list of installed packages providing libinfo, a (file_format,
+    soname) tuple as found in NOTES deps.libs_provided"""
+    retval = []
+    libinfo = tuple(libinfo)
+    for name in __provides.get(libinfo, []):
+        for p in __db.get(name, []):
+            try:
+                if libinfo in map(tuple, p.notes.deps.libs_provided):
+                    retval.append(p)
+            except AttributeError:
+                pass
+    return retval
+
+
 def lookup_by_notes(field, value):
     pass
 
 def lookup_by_manifest(filename):
     pass
-
-
-
-load()
@@ -0,0 +1,198 @@
+"""The SRP db server - keeps the installed package db in memory and serves it
+to other srp processes over a Unix domain socket.
+
+This is the daemon proposed in README.dbus.  Without it, every srp
+invocation unpickles the whole db (and its indexes) just to look up a
+package or two, and concurrent invocations race each other when they
+re-pickle it.  With it running (see srp --db-server), the functions in
+srp.db that read or modify the db get forwarded to the server, which:
+
+  - loads the db once and keeps it (and the provides and dirs indexes)
+    in memory,
+
+  - runs requests one at a time, so concurrent installs can't clobber
+    each other's changes, and
+
+  - batches commits, writing the db out once things have been quiet for
+    commit_delay seconds (and when it shuts down) instead of once per
+    installed package.
+
+The socket lives next to the db (dbpath + ".sock" under srp.params.root),
+so each root gets its own server, and clients find it just by looking
+there.  If nothing is listening, srp.db quietly falls back to loading the
+db itself.
+
+Requests are (method, args) tuples and replies are (ok, result) tuples,
+pickled over a multiprocessing.connection.  The methods map to the ones in
+README.dbus like this:
+
+  query - lookup_by_name, lookup_by_lib, dir_refcount
+
+  add - register
+
+  update - replace
+
+  remove - unregister
+
+NOTE: D-Bus would need glib and pygobject (or dbus-python) installed before
+      srp, which is a lot to add to a bootstrap, so we just use a plain Unix
+      socket.  Since anything sent to the server gets unpickled, the socket
+      is only accessible by the user running the server.
+"""
+
+import multiprocessing.connection
+import os
+import signal
+import threading
+import time
+import traceback
+
+import srp
+
+
+# seconds to wait after the last change before committing the db
+commit_delay = 2.0
+
+# srp.db functions that clients are allowed to call
+methods = ["lookup_by_name", "lookup_by_lib", "dir_refcount", "register",
+           "replace", "unregister", "commit"]
+
+
+def connect(path):
+    """Returns a multiprocessing.connection.Connection to the db server
+    listening on socket `path', or None if there isn't one running.
+
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        return multiprocessing.connection.Client(path, family="AF_UNIX")
+    except (ConnectionRefusedError, FileNotFoundError):
+        # stale socket left behind by a server that didn't exit cleanly
+        return None
+
+
+class Server(srp.SrpObject):
+    """Class representing a running db server.
+
+    Data:
+
+      path - Path of the Unix domain socket being listened on.
+
+      listener - The multiprocessing.connection.Listener instance.
+
+      lock - Lock held while running each request, so the db only ever
+          gets touched by one request at a time.
+
+      dirty - Time of the most recent change that hasn't been committed to
+          disk yet, or None.
+
+      cond - Condition (sharing lock) used to wake up the commit thread.
+
+      done - Set to True to shut down.
+
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.dirty = None
+        self.done = False
+
+        # clean up after a server that didn't exit cleanly
+        if os.path.exists(path):
+            if connect(path):
+                raise Exception("db server already running on {}".format(
+                    path))
+            os.unlink(path)
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # NOTE: Since requests get unpickled, we don't want anyone else
+        #       connecting.
+        umask = os.umask(0o077)
+        try:
+            self.listener = multiprocessing.connection.Listener(
+                path, family="AF_UNIX")
+        finally:
+            os.umask(umask)
+
+    def handle(self, conn):
+        """Serves requests from client connection `conn' until it's closed."""
+        with conn:
+            while True:
+                try:
+                    method, args = conn.recv()
+                except (EOFError, OSError):
+                    return
+                if srp.params.verbosity:
+                    print("request:", method, args)
+                try:
+                    if method not in methods:
+                        raise Exception("invalid method: {}".format(method))
+                    with self.lock:
+                        if method == "commit":
+                            # NOTE: Just schedule it, so commits from a
+                            #       bunch of clients get batched together.
+                            self.dirty = time.time()
+                            self.cond.notify()
+                            ret = None
+                        else:
+                            ret = getattr(srp.db, method)(*args)
+                    reply = (True, ret)
+                except Exception as e:
+                    traceback.print_exc()
+                    reply = (False, "{}: {}".format(type(e).__name__, e))
+                try:
+                    conn.send(reply)
+                except OSError:
+                    return
+
+    def committer(self):
+        """Commits the db to disk once it's been commit_delay seconds since
+        the last change.
+
+        """
+        with self.cond:
+            while not self.done:
+                if self.dirty is None:
+                    self.cond.wait()
+                    continue
+                remaining = self.dirty + commit_delay - time.time()
+                if remaining > 0:
+                    self.cond.wait(remaining)
+                    continue
+                srp.db.commit()
+                self.dirty = None
+
+    def run(self):
+        """Accepts and serves client connections until SIGTERM or SIGINT."""
+        def stop(signum, frame):
+            raise KeyboardInterrupt()
+        signal.signal(signal.SIGTERM, stop)
+
+        t = threading.Thread(target=self.committer, daemon=True)
+        t.start()
+        print("db server listening on", self.path)
+        try:
+            while True:
+                conn = self.listener.accept()
+                threading.Thread(target=self.handle, args=(conn,),
+                                 daemon=True).start()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.listener.close()
+            with self.cond:
+                self.done = True
+                self.cond.notify()
+                if self.dirty is not None:
+                    srp.db.commit()
+            print("db server stopped")
+
+
+def serve():
+    """Runs a db server for srp.params.root in the foreground."""
+    srp.db.serving = True
+    srp.db.load()
+    Server(srp.db.sockpath()).run()
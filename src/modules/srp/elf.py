@@ -0,0 +1,227 @@
+"""Minimal ELF reader.
+
+This module pulls the handful of things srp cares about (file format, and
+the DT_NEEDED and DT_SONAME entries of the dynamic section) straight out of
+ELF files, so we don't have to fork `objdump -p' for every file in a
+package.
+
+NOTE: The file_format strings match the BFD target names reported by
+      objdump (e.g., elf64-x86-64), because that's what we've been
+      recording in NOTES all along.
+"""
+
+import mmap
+import os
+import struct
+
+import srp
+
+
+ELFMAG = b"\x7fELF"
+
+ELFCLASS32 = 1
+ELFCLASS64 = 2
+
+ELFDATA2LSB = 1
+ELFDATA2MSB = 2
+
+PT_LOAD = 1
+PT_DYNAMIC = 2
+PN_XNUM = 0xffff
+
+DT_NULL = 0
+DT_NEEDED = 1
+DT_STRTAB = 5
+DT_SONAME = 14
+
+
+# maps e_machine to the BFD architecture part of the file format name.
+# each entry is a (little endian, big endian) pair, and either can be a
+# dict keyed by ELF class if the name changes between 32 and 64 bit.
+#
+# NOTE: Anything not listed here gets objdump's generic elfNN-little or
+#       elfNN-big name.
+machines = {
+    2: (None, "sparc"),
+    3: ("i386", None),
+    8: ({32: "tradlittlemips", 64: "tradlittlemips"},
+        {32: "tradbigmips", 64: "tradbigmips"}),
+    20: (None, "powerpc"),
+    21: ("powerpcle", "powerpc"),
+    22: (None, "s390"),
+    40: ("littlearm", "bigarm"),
+    43: (None, "sparc"),
+    62: ("x86-64", None),
+    183: ("littleaarch64", "bigaarch64"),
+    243: ("littleriscv", None),
+}
+
+
+class ElfInfo(srp.SrpObject):
+    """Class representing the interesting bits of an ELF file.
+
+    Data:
+
+      file_format - BFD-style file format name (e.g., elf64-x86-64).
+
+      elfclass - Either 32 or 64.
+
+      machine - The numeric e_machine value.
+
+      needed - List of DT_NEEDED library names, in file order.
+
+      soname - The DT_SONAME of the file, or None if it doesn't have one.
+
+    """
+    def __init__(self):
+        self.file_format = None
+        self.elfclass = None
+        self.machine = None
+        self.needed = []
+        self.soname = None
+
+
+def format_name(elfclass, data, machine):
+    """Returns the BFD-style file format name for the specified ELF class,
+    data encoding, and machine.
+
+    """
+    try:
+        arch = machines[machine][data != ELFDATA2LSB]
+    except KeyError:
+        arch = None
+    if isinstance(arch, dict):
+        arch = arch[elfclass]
+    if not arch:
+        arch = "little" if data == ELFDATA2LSB else "big"
+    return "elf{}-{}".format(elfclass, arch)
+
+
+def read(fname):
+    """Returns an ElfInfo instance for file `fname', or None if it isn't
+    an ELF file.  The magic bytes are checked before anything else, so
+    this is cheap to call on every file in a package.
+
+    """
+    fd = os.open(fname, os.O_RDONLY)
+    try:
+        if os.pread(fd, 4, 0) != ELFMAG:
+            return None
+        try:
+            m = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # can't mmap empty files
+            return None
+    finally:
+        os.close(fd)
+
+    with m:
+        try:
+            return parse(m)
+        except (struct.error, IndexError, ValueError):
+            # truncated or corrupt, treat it like objdump would and
+            # pretend it's not an ELF file
+            return None
+
+
+def parse(buf):
+    """Returns an ElfInfo instance populated from `buf' (anything supporting
+    the buffer protocol and slicing, like an mmap), which must contain an
+    entire ELF file.
+
+    """
+    if buf[:4] != ELFMAG:
+        raise ValueError("not an ELF file")
+
+    info = ElfInfo()
+    cls = buf[4]
+    data = buf[5]
+    if cls not in (ELFCLASS32, ELFCLASS64):
+        raise ValueError("invalid ELF class")
+    if data not in (ELFDATA2LSB, ELFDATA2MSB):
+        raise ValueError("invalid ELF data encoding")
+    e = "<" if data == ELFDATA2LSB else ">"
+
+    if cls == ELFCLASS64:
+        info.elfclass = 64
+        ehdr = e + "HHIQQQIHHHHHH"
+        phdr = e + "IIQQQQQQ"
+        shdr = e + "IIQQQQIIQQ"
+        dyn = e + "qQ"
+    else:
+        info.elfclass = 32
+        ehdr = e + "HHIIIIIHHHHHH"
+        phdr = e + "IIIIIIII"
+        shdr = e + "IIIIIIIIII"
+        dyn = e + "iI"
+
+    (e_type, e_machine, e_version, e_entry, e_phoff, e_shoff, e_flags,
+     e_ehsize, e_phentsize, e_phnum, e_shentsize, e_shnum,
+     e_shstrndx) = struct.unpack_from(ehdr, buf, 16)
+
+    info.machine = e_machine
+    info.file_format = format_name(info.elfclass, data, e_machine)
+
+    # lots of program headers means the real count is in section 0's
+    # sh_info
+    if e_phnum == PN_XNUM and e_shoff:
+        e_phnum = struct.unpack_from(shdr, buf, e_shoff)[7]
+
+    # collect PT_LOAD segments (so we can translate virtual addresses to
+    # file offsets) and find PT_DYNAMIC
+    loads = []
+    dynamic = None
+    for i in range(e_phnum):
+        p = struct.unpack_from(phdr, buf, e_phoff + i * e_phentsize)
+        if info.elfclass == 64:
+            p_type, p_flags, p_offset, p_vaddr, p_paddr, p_filesz = p[:6]
+        else:
+            p_type, p_offset, p_vaddr, p_paddr, p_filesz = p[:5]
+        if p_type == PT_LOAD:
+            loads.append((p_vaddr, p_offset, p_filesz))
+        elif p_type == PT_DYNAMIC:
+            dynamic = (p_offset, p_filesz)
+
+    # not dynamically linked (e.g., static binary, object file)
+    if not dynamic:
+        return info
+
+    needed = []
+    soname = None
+    strtab = None
+    size = struct.calcsize(dyn)
+    offset, end = dynamic[0], dynamic[0] + dynamic[1]
+    while offset + size <= end:
+        tag, val = struct.unpack_from(dyn, buf, offset)
+        offset += size
+        if tag == DT_NULL:
+            break
+        elif tag == DT_NEEDED:
+            needed.append(val)
+        elif tag == DT_SONAME:
+            soname = val
+        elif tag == DT_STRTAB:
+            strtab = val
+
+    if strtab is None:
+        return info
+
+    # DT_STRTAB is a virtual address, find the file offset
+    for vaddr, off, filesz in loads:
+        if vaddr <= strtab < vaddr + filesz:
+            strtab = strtab - vaddr + off
+            break
+    else:
+        return info
+
+    def string(i):
+        start = strtab + i
+        stop = buf.find(b"\0", start)
+        if stop == -1:
+            raise ValueError("unterminated string")
+        return bytes(buf[start:stop]).decode(errors="replace")
+
+    info.needed = [string(x) for x in needed]
+    if soname is not None:
+        info.soname = string(soname)
+    return info
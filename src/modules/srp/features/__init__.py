@@ -51,18 +51,28 @@ So for example, when a package is being built, all the SRP main program
 has to do is fetch a list of build functions from all the registered
 Features (sorted via their pre/post rules), and execute them one by one.
 
+Feature modules are only imported when one of their stage functions (or
+info functions) is actually needed.  Until then, all we know about them
+comes from the feature_index (see feature_info), which is plenty for
+things like figuring out the default list of Features.
+
 """
+import collections
+import collections.abc
 import hashlib
 import os
 import pickle
-import tarfile
+import sys
 import tempfile
+import time
 
 import srp
 
 # These lists/maps are populated via calls to register_feature
+#
+# NOTE: registered_features is a _LazyFeatures instance (see below), which
+#       imports each Feature module the first time it's looked up.
 default_features = []
-registered_features = {}
 action_map = {}
 
 # The standard list of stages
@@ -193,41 +203,37 @@ class stage_struct:
             else:
                 post_reqs.append(x)
 
-        for x in other.pre_reqs[:]:
-            if x[0] == "?":
-                other.pre_reqs.remove(x)
-                other.pre_reqs.append(x[1:])
-
-        for x in other.post_reqs[:]:
-            if x[0] == "?":
-                other.post_reqs.remove(x)
-                other.post_reqs.append(x[1:])
+        # NOTE: We must not modify other's lists in place, or the "?"
+        #       markers get lost and get_function_list_deps will start
+        #       recursively enabling optional features.
+        other_pre_reqs = [x.lstrip("?") for x in other.pre_reqs]
+        other_post_reqs = [x.lstrip("?") for x in other.post_reqs]
 
         # does self need to come before other
-        if self.name in other.pre_reqs:
+        if self.name in other_pre_reqs:
             # either true or error
-            if other.name in pre_reqs or self.name in other.post_reqs:
+            if other.name in pre_reqs or self.name in other_post_reqs:
                 raise Exception("circular pre_req dependencies")
             return True
         
         # does other need to come before self
         if other.name in pre_reqs:
             # false or error
-            if self.name in other.pre_reqs or other.name in post_reqs:
+            if self.name in other_pre_reqs or other.name in post_reqs:
                 raise Exception("circular other pre_req dependencies")
             return False
         
         # does self need to come after other
-        if self.name in other.post_reqs:
+        if self.name in other_post_reqs:
             # either false or error
-            if other.name in post_reqs or self.name in other.pre_reqs:
+            if other.name in post_reqs or self.name in other_pre_reqs:
                 raise Exception("circular other post_req dependencies")
             return False
         
         # does other need to come after self
         if other.name in post_reqs:
             # either true or error
-            if self.name in other.post_reqs or other.name in pre_reqs:
+            if self.name in other_post_reqs or other.name in pre_reqs:
                 raise Exception("circular post_req dependencies")
             return True
 
@@ -237,12 +243,12 @@ class stage_struct:
         #       has to happen before core).
 
         # does other have a pre_req that's in our post_reqs
-        for x in other.pre_reqs:
+        for x in other_pre_reqs:
             if x in post_reqs:
                 return True
 
         # does other have a post_req that's in our pre_reqs
-        for x in other.post_reqs:
+        for x in other_post_reqs:
             if x in pre_reqs:
                 return False
 
@@ -251,6 +257,121 @@ class stage_struct:
         #       the interpreter if we don't return anything...
 
 
+class feature_info:
+    """Lightweight description of a Feature, so that we know what it does
+    without importing its module.  The name and default items are the same
+    as in feature_struct.  The stages item is the list of stages it has a
+    stage_struct for, actions is the list of its action names, and info
+    says whether it has an info function.
+
+    """
+    def __init__(self, name, default=False, stages=[], actions=[],
+                 info=False):
+        self.name = name
+        self.default = default
+        self.stages = stages
+        self.actions = actions
+        self.info = info
+
+
+    def __repr__(self):
+        return "feature_info({name!r}, {default}, {stages}, {actions}," \
+            " {info})".format(**self.__dict__)
+
+
+    @classmethod
+    def fromstruct(cls, feature_obj):
+        """Returns the feature_info describing feature_struct instance
+        feature_obj.
+
+        """
+        return cls(feature_obj.name, bool(feature_obj.default),
+                   [x for x in stage_list if getattr(feature_obj, x)],
+                   [a[0] for a in feature_obj.action],
+                   bool(feature_obj.info))
+
+
+    def __eq__(self, other):
+        return self.__dict__ == other.__dict__
+
+
+# The Features in this package, and what they do
+#
+# NOTE: This has to be kept up-to-date with each module's register_feature
+#       call, which checks that they match.  Any module in this directory
+#       that isn't listed here gets imported right away, just like in the
+#       good old days.
+#
+feature_index = {x.name: x for x in [
+    feature_info("checksum", True,
+                 ["install", "install_iter", "install_final", "uninstall",
+                  "uninstall_final"],
+                 ["commit", "verify"]),
+    feature_info("core", True,
+                 ["build", "build_final",
+                  "install", "install_iter", "install_final",
+                  "uninstall", "uninstall_iter", "uninstall_final"],
+                 ["commit"]),
+    feature_info("deps", True, ["build_iter", "install"], info=True),
+    feature_info("perms", False, ["build_iter", "install_iter"], ["verify"]),
+    feature_info("postinstall", False, ["install_final"]),
+    feature_info("size", True, ["build_iter", "install", "install_iter"],
+                 info=True),
+    feature_info("strip_debug", False, ["install_iter"], ["strip_debug"]),
+    feature_info("strip_docs", False, ["install"], ["strip_docs"]),
+]}
+
+
+class _LazyFeatures(collections.abc.Mapping):
+    """Read-only dict mapping the name of each Feature in the feature_index
+    to its feature_struct, importing the Feature's module on first access.
+
+    """
+    def __init__(self):
+        self.loaded = {}
+
+    def __getitem__(self, name):
+        if name not in self.loaded:
+            if name not in feature_index:
+                raise KeyError(name)
+            load_feature(name)
+        return self.loaded[name]
+
+    def __iter__(self):
+        return iter(feature_index)
+
+    def __len__(self):
+        return len(feature_index)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+registered_features = _LazyFeatures()
+
+
+def load_feature(name):
+    """Imports the module for Feature `name' (which registers it), and
+    returns the module.
+
+    """
+    __import__(".".join([__name__, name]))
+    if name not in registered_features.loaded:
+        raise Exception("module {} didn't register feature {}".format(
+            name, name))
+    return sys.modules[".".join([__name__, name])]
+
+
+def load_action(action):
+    """Imports the modules for all the Features implementing `action', so that
+    their stage_structs are in action_map.
+
+    """
+    for x in feature_index.values():
+        if action in x.actions:
+            registered_features[x.name]
+
+
 def register_feature(feature_obj):
     """The registration method for the Feature API.  See documentation for
     features.feature_struct.
@@ -259,8 +380,20 @@ def register_feature(feature_obj):
     if not feature_obj.valid():
         raise Exception("invalid feature_obj")
 
+    # make sure feature_index has the right idea about this feature, or add
+    # it if it's not in there
+    info = feature_info.fromstruct(feature_obj)
+    if feature_obj.name not in feature_index:
+        feature_index[feature_obj.name] = info
+        if info.default:
+            default_features.append(feature_obj.name)
+    elif feature_index[feature_obj.name] != info:
+        raise Exception("feature_index is out of date for {}: {} should be"
+                        " {}".format(feature_obj.name,
+                                     feature_index[feature_obj.name], info))
+
     # add the feature to our registered_features dict
-    registered_features[feature_obj.name] = feature_obj
+    registered_features.loaded[feature_obj.name] = feature_obj
 
     # add any feature-specific actions to our actions_map
     for a in feature_obj.action:
@@ -269,10 +402,6 @@ def register_feature(feature_obj):
         except:
             action_map[a[0]] = [a[1]]
 
-    # add the feature's name to our default list if specified
-    if feature_obj.default:
-        default_features.append(feature_obj.name)
-
 
 def get_function_list(stage, feature_list):
     """Utility function that returns a sorted list of feature stage_struct
@@ -308,11 +437,20 @@ def get_function_list_deps(f, stage, retval=None):
     # if requested feature is unsupported, the following call will raise an
     # exception.
     try:
-        x = getattr(registered_features[f], stage)
+        info = feature_index[f]
     except KeyError:
         print("ERROR: requested unsupported feature: {}".format(f))
         raise
 
+    # feature might not implement a func for this stage
+    #
+    # NOTE: This is checked before looking up the feature_struct, so we
+    #       don't import the feature's module unless we have to.
+    if stage not in info.stages:
+        return retval
+
+    x = getattr(registered_features[f], stage)
+
     # feature might not implement a func for this stage
     if not x:
         return retval
@@ -378,8 +516,13 @@ class WorkBag(srp.SrpObject):
           itself is created when this class gets instantiated, and is up
           to the user to be deleted (upon successful completion)
 
+      jobserver - A (read fd, write fd) tuple for the GNU make jobserver
+          shared by concurrent builds (see srp.build_batch), or None.
+
     """
     def __init__(self):
+        self.jobserver = None
+
         self.build = None
         self.install = None
         self.uninstall = None
@@ -409,6 +552,9 @@ class BuildWork(srp.SrpObject):
       final_funcs - Sorted list of stage_struct instances for the
           build_final stage.
 
+      log - Instance of BuildLog for capturing the output of the build
+          (written to PWD/FULLNAME.log).
+
     """
     def __init__(self):
         with open(srp.params.build.notes, 'rb') as fobj:
@@ -434,6 +580,85 @@ class BuildWork(srp.SrpObject):
         # update notes fields with optional command line flags
         self.notes.update_features(srp.params.options)
 
+        # NOTE: brp.build_key (see srp.build_key) is only set by
+        #       srp.core.build when checking to see if we're up to date,
+        #       since it means hashing the whole source tree.
+
+        self.log = BuildLog(self.notes.header.fullname + ".log")
+
+
+class BuildLog(srp.SrpObject):
+    """Class for capturing the output of a package build (e.g., the build
+    script).
+
+    Each line is echoed to stdout as it arrives and written to the log file
+    prefixed with a timestamp (seconds since the log was created), so the
+    log file ends up in the same order things actually happened in.  The
+    last `tail_lines' lines are also kept in memory for error reports.
+
+    Data:
+
+      fname - Path to the log file.  The file isn't created until the
+          first line is written (i.e., skipped builds don't clobber the
+          previous log).
+
+      tail - collections.deque of the last `tail_lines' lines.
+
+    """
+    tail_lines = 50
+
+    def __init__(self, fname):
+        self.fname = os.path.abspath(fname)
+        self.tail = collections.deque(maxlen=self.tail_lines)
+        self.start = time.monotonic()
+        self.fobj = None
+
+    def write(self, line, echo=True):
+        """Logs a single `line' of output (without the trailing newline).
+        If `echo' is False, the line is only logged.
+
+        """
+        if not self.fobj:
+            self.fobj = open(self.fname, "w", buffering=1)
+        self.fobj.write("[{:10.3f}] {}\n".format(
+            time.monotonic() - self.start, line))
+        self.tail.append(line)
+        if echo:
+            sys.stdout.write(line + "\n")
+            sys.stdout.flush()
+
+    def phase(self, name):
+        """Logs a marker for the start of build phase `name'"""
+        self.write("=== {} ===".format(name))
+
+    def run(self, cmd, echo=True, **kwargs):
+        """Runs `cmd' (see subprocess.Popen, which gets all the extra
+        kwargs) and logs its output as it arrives.  Both stdout and stderr
+        are read from the same pipe so their order is preserved.  Raises
+        subprocess.CalledProcessError on failure, after printing the tail
+        of the log.
+
+        """
+        import subprocess
+
+        with subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                              stderr=subprocess.STDOUT, **kwargs) as p:
+            for line in p.stdout:
+                self.write(line.rstrip(b"\n").decode(errors="replace"),
+                           echo)
+        if p.returncode:
+            print("ERROR: {} failed with status {}, last {} lines of"
+                  " output (see {}):".format(cmd[0], p.returncode,
+                                             len(self.tail), self.fname))
+            for line in self.tail:
+                print("  " + line)
+            raise subprocess.CalledProcessError(p.returncode, cmd)
+
+    def close(self):
+        if self.fobj:
+            self.fobj.close()
+            self.fobj = None
+
 
 def verify_sha(tar):
     sha = hashlib.new("sha1")
@@ -447,6 +672,21 @@ def verify_sha(tar):
     return x
 
 
+def installed_path(fname):
+    """Returns the path on disk of file `fname' from the manifest of the
+    package being installed.  Feature funcs that need to look at installed
+    files during install_iter should use this, because the file might
+    still be staged under a temporary name until srp.install() commits
+    them all (see srp.blob.ExtractContext).
+
+    """
+    # NOTE: We have to chop the leading '/' off of fname so that
+    #       os.path.join will really add in our root path.
+    #
+    path = os.path.join(srp.params.root, fname[1:])
+    return srp.work.install.extract.target(path)
+
+
 class InstallWork(srp.SrpObject):
     """Class holding data for srp.install(), which runs through the install and
     install_iter stages.
@@ -458,11 +698,19 @@ class InstallWork(srp.SrpObject):
       prevs - List of previously installed srp.db.InstalledPackage
           instances of the same name.
 
-      blob - Instance of srp.blob.BlobFile loaded out of the package.
+      blob - Instance of srp.blob.BlobFile loaded out of the package.  For
+          a delta package, this is the BLOB reconstructed from the delta
+          and the previously installed version.
+
+      delta - Instance of srp.bdiff.BlobDelta loaded out of a delta package
+          (see srp.delta()), or None for a regular package.
 
       manifest - Instance of srp.blob.Manifest extracted from the BlobFile
           object.
 
+      extract - Instance of srp.blob.ExtractContext used for all the
+          BlobFile.extract() calls into srp.params.root.
+
       funcs - Sorted list of stage_struct instances for the install stage.
 
       iter_funcs - Sorted list of stage_struct instances for the
@@ -471,8 +719,35 @@ class InstallWork(srp.SrpObject):
       final_funcs - Sorted list of stage_struct instances for the
           install_final stage.
 
+      batch - List of srp.notes.NotesFile instances for any other
+          packages being installed in the same run (e.g., so dependency
+          checks can take them into account), or None if we're not part
+          of a batch.  When set, committing the db is left up to
+          srp.install_batch().
+
+      installed - Instance of srp.db.InstalledPackage registered by the
+          core Feature's install_final func.
+
+      prev - Instance of srp.db.InstalledPackage being upgraded (i.e.,
+          replaced by this package), or None.
+
+      unchanged - Set of filenames that are identical in prev, so they
+          don't need to be extracted.  Populated by the core Feature's
+          install func.
+
+      removed - List of filenames in prev that aren't in this package, to
+          be removed by the core Feature's install_final func.
+
+      sums - Dict mapping filenames in unchanged to (algorithm, checksum)
+          tuples of their contents.
+
     """
-    def __init__(self):
+    def __init__(self, batch=None):
+        import tarfile
+
+        self.batch = batch
+        self.installed = None
+
         # extract required files
         with tarfile.open(srp.params.install.pkg) as p:
             # verify SHA
@@ -483,14 +758,19 @@ class InstallWork(srp.SrpObject):
             n = pickle.load(n_fobj)
             self.notes = n
 
-            # get BLOB
+            # get BLOB (or DELTA and its DATA, for a delta package)
             #
             # NOTE: We need to actually extract this file as apposed to
             #       just using a file object here.  This is because our C
             #       _blob.extract method needs access to the file on disk
             #       somewhere.
             #
-            p.extract("BLOB", srp.work.topdir + "/package")
+            self.delta = None
+            if "DELTA" in p.getnames():
+                self.delta = pickle.load(p.extractfile("DELTA"))
+                p.extract("DATA", srp.work.topdir + "/package")
+            else:
+                p.extract("BLOB", srp.work.topdir + "/package")
 
         # check for previously installed version
         #
@@ -510,7 +790,7 @@ class InstallWork(srp.SrpObject):
         #
         prevs = srp.db.lookup_by_name(n.header.name)
         # make sure upgrading is allowed if needed
-        if prevs and not srp.params.install.allow_upgrade:
+        if prevs and not srp.params.install.upgrade:
             raise Exception("Package {} already installed".format(
                 n.header.name))
 
@@ -526,6 +806,15 @@ class InstallWork(srp.SrpObject):
             print("Upgrading to {}".format(n.header.fullname))
         self.prevs = prevs
 
+        # NOTE: When upgrading, we replace the most recently installed
+        #       version.  Any others are left alone.
+        self.prev = None
+        if prevs:
+            self.prev = prevs[-1]
+        self.unchanged = set()
+        self.removed = []
+        self.sums = {}
+
         # add installed section to NOTES instance
         n.installed = srp.notes.NotesInstalled(from_sha)
 
@@ -535,10 +824,25 @@ class InstallWork(srp.SrpObject):
         # update notes fields with optional command line flags
         n.update_features(srp.params.options)
 
-        self.blob = srp.blob.BlobFile.fromfile(srp.work.topdir+"/package/BLOB")
+        if self.delta:
+            if not self.prev:
+                raise Exception("delta package requires {} to be"
+                                " installed".format(
+                                    self.delta.from_fullname))
+            self.blob = self.delta.apply(self.prev,
+                                         srp.work.topdir+"/package/DATA",
+                                         srp.work.topdir+"/package/BLOB")
+        else:
+            self.blob = srp.blob.BlobFile.fromfile(
+                srp.work.topdir+"/package/BLOB")
 
         self.manifest = self.blob.manifest
 
+        # NOTE: One ExtractContext for the whole run, so the BLOB only gets
+        #       opened once and directories only get created once.
+        self.extract = self.blob.context(srp.params.root,
+                                         srp.params.install.staged)
+
         stages = get_stage_map(self.notes.header.features)
         self.funcs = stages["install"]
         self.iter_funcs = stages["install_iter"]
@@ -546,10 +850,109 @@ class InstallWork(srp.SrpObject):
 
 
 
-# NOTE: We want importing this package to automatically import all .py files in
-#       this directory, because that triggers each individual feature's
-#       registration code.  So, we do some globbing, manipulation, and then use
-#       the __import__ statement here.
+class UninstallWork(srp.SrpObject):
+    """Class holding data for srp.uninstall(), which runs through the
+    uninstall, uninstall_iter, and uninstall_final stages for a single
+    installed package.
+
+    Data:
+
+      package - Instance of srp.db.InstalledPackage being uninstalled.
+
+      notes - The package's srp.notes.NotesFile instance.
+
+      manifest - The package's srp.blob.Manifest instance.
+
+      funcs - Sorted list of stage_struct instances for the uninstall
+          stage.
+
+      iter_funcs - Sorted list of stage_struct instances for the
+          uninstall_iter stage.
+
+      final_funcs - Sorted list of stage_struct instances for the
+          uninstall_final stage.
+
+      times - Dict of how long each phase of the uninstall took, in
+          seconds.
+
+      dirs - List of directories to be removed (if empty) once all the
+          files are gone, in bottom-up order.  Populated by the core
+          Feature's uninstall func.
+
+      pending - Dict mapping directories to lists of files in them that
+          have been queued up for removal, but not removed yet.
+
+      npending - Total number of files in pending.
+
+      nremoved - Number of files removed so far.
+
+    """
+    def __init__(self, package):
+        self.package = package
+        self.notes = package.notes
+        self.manifest = package.manifest
+        self.times = {}
+        self.dirs = []
+        self.pending = {}
+        self.npending = 0
+        self.nremoved = 0
+
+        # NOTE: We use the features the package was installed with, updated
+        #       with any optional command line flags (e.g., no_checksum to
+        #       skip verifying files before removing them).
+        features = self.notes.header.features[:]
+        for o in srp.params.options:
+            if o.startswith("no_"):
+                if o[3:] in features:
+                    features.remove(o[3:])
+            elif o not in features:
+                features.append(o)
+
+        stages = get_stage_map(features)
+        self.funcs = stages["uninstall"]
+        self.iter_funcs = stages["uninstall_iter"]
+        self.final_funcs = stages["uninstall_final"]
+
+
+class ActionWork(srp.SrpObject):
+    """Class holding data for srp.action(), which runs the requested action
+    stage funcs on a list of installed packages.
+
+    Data:
+
+      packages - List of srp.db.InstalledPackage instances matching the
+          action criteria.
+
+      funcs - Dict mapping each requested action name to a sorted list of
+          stage_struct instances registered for that action.
+
+    """
+    def __init__(self):
+        self.packages = []
+        for k, v in srp.params.action.criteria.items():
+            if k == "pkg":
+                self.packages.extend(srp.db.lookup_by_name(v))
+            else:
+                raise Exception("Unsupported criteria '{}'".format(k))
+
+        self.funcs = {}
+        for a in srp.params.action.actions:
+            load_action(a)
+            try:
+                funcs = action_map[a][:]
+            except KeyError:
+                raise Exception("Unsupported action '{}'".format(a))
+            funcs.sort()
+            self.funcs[a] = funcs
+
+
+# populate the default list of Features
+default_features.extend(x.name for x in feature_index.values() if x.default)
+
+# NOTE: Feature modules listed in feature_index get imported as needed (see
+#       _LazyFeatures).  Any other .py files in this directory still get
+#       imported right away, because that triggers each individual
+#       feature's registration code.
 #
 # NOTE: We do not define __all__, so doing 'from features import *' will ONLY
 #       import the API structure and functions (which happens to avoid the
@@ -558,22 +961,19 @@ class InstallWork(srp.SrpObject):
 #
 # FIXME: is that still true?
 #
-import glob
-import os
-for x in glob.glob("{}/*.py".format(__path__[0])):
-    if x == __file__:
-        # skip __init__.py
+for x in sorted(os.listdir(__path__[0])):
+    # we only want .py files, and not __init__.py
+    if not x.endswith(".py") or x == "__init__.py":
         continue
-    # remove leading path
-    x = os.path.basename(x)
-    # we globbed on *.py, so we know that x ends with ".py"... let's remove it
+    # let's remove the .py
     x = x[:-3]
-    __import__(".".join([__name__, x]))
+    if x not in feature_index:
+        __import__(".".join([__name__, x]))
 
 
 # clean up our namespace
-del glob
-del os
+#
+# NOTE: We leave os alone, BuildLog needs it.
 del x
 
 # FIXME: move huge ammount of stuff to api.py
@@ -4,59 +4,299 @@ This feature records checksums for each installed file and allows the user to
 verify files on demand after installation.
 """
 
+import collections
+import concurrent.futures
 import hashlib
+import os
+import pickle
+import stat
+import threading
+import time
 
 import srp
 from srp.features import *
 
 
-# FIXME: MULTI:
+# size of each read when hashing a file
+#
+# NOTE: Hashing in bounded chunks keeps memory usage flat no matter how big
+#       the installed files are.  hashlib releases the GIL while hashing
+#       large buffers, so a handful of threads can keep all the CPUs busy.
+chunk_size = 1024 * 1024
+
+
+class NotesChecksum(srp.SrpObject):
+    def __init__(self):
+        # NOTE: We record the algorithm used so we can still verify
+        #       packages installed before the configured default changed.
+        self.algorithm = srp.config.checksum_algorithm
+
+
+def hash_file(path, algorithm, offset=0, size=None):
+    """Returns the hex digest (as bytes) of `size' bytes of file `path'
+    starting at `offset', or of the whole file if `size' isn't specified.
+    The file is read in chunk_size pieces.
+
+    """
+    h = hashlib.new(algorithm)
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if size is None:
+            while True:
+                buf = os.read(fd, chunk_size)
+                if not buf:
+                    break
+                h.update(buf)
+        else:
+            while size > 0:
+                buf = os.pread(fd, min(size, chunk_size), offset)
+                if not buf:
+                    raise Exception("short read from {}".format(path))
+                h.update(buf)
+                offset += len(buf)
+                size -= len(buf)
+    finally:
+        os.close(fd)
+    return h.hexdigest().encode()
+
+
+# pool of hashing threads and the outstanding jobs submitted to it
+#
+# NOTE: These only live from our install func until our install_final func.
+_pool = None
+_pending = {}
+
+# whether or not we can hash straight from the BLOB
+_from_blob = False
+
+
+def start_sums():
+    """start pool of hashing threads"""
+    global _pool, _from_blob
+    _pool = concurrent.futures.ThreadPoolExecutor(os.cpu_count() or 1)
+    _pending.clear()
+
+    # NOTE: If any install_iter funcs run between core and us, they might
+    #       modify the freshly installed files (e.g., strip_debug), so we
+    #       have to hash what actually landed on disk.  Otherwise, we can
+    #       hash the data in the BLOB and skip re-reading every file we
+    #       just wrote out.
+    names = [f.name for f in srp.work.install.iter_funcs]
+    _from_blob = names.index("checksum") == names.index("core") + 1
+    if srp.params.verbosity:
+        print("checksumming with {} from {}".format(
+            srp.work.install.notes.checksum.algorithm,
+            "BLOB" if _from_blob else "installed files"))
+
+
 def gen_sum(fname):
-    """gen sha of a file, update pkg manifest"""
+    """queue up checksum of a file"""
     x = srp.work.install.manifest[fname]
 
     # only record checksum of regular files
     if not x['tinfo'].isreg():
         return
 
-    # FIXME: we don't really want to hardcode sha1 do we?
-    sha = hashlib.new("sha1")
+    algo = srp.work.install.notes.checksum.algorithm
+    if srp.work.install.sums.get(fname, (None,))[0] == algo:
+        # already summed by the core Feature while figuring out what
+        # changed since the previous version
+        _pending[fname] = concurrent.futures.Future()
+        _pending[fname].set_result(srp.work.install.sums[fname][1])
+    elif _from_blob and x["offset"] is not None:
+        blob = srp.work.install.blob
+        _pending[fname] = _pool.submit(hash_file, blob.fname, algo,
+                                       blob.hdr_offset + x["offset"],
+                                       x['tinfo'].size)
+    else:
+        path = installed_path(fname)
+        _pending[fname] = _pool.submit(hash_file, path, algo)
 
-    # NOTE: The file is already installed on disk, so we don't need to mess
-    #       with the old BLOB
-    #
+
+def finish_sums():
+    """wait for all queued checksums, update pkg manifest"""
+    global _pool
+    m = srp.work.install.manifest
+    try:
+        for fname in _pending:
+            m[fname]["checksum"] = _pending[fname].result()
+    finally:
+        _pool.shutdown()
+        _pool = None
+        _pending.clear()
+
+
+# NOTE: Verification results are cached here so that we can skip re-hashing
+#       files that haven't been touched since they were last verified.
+#
+# FIXME: path in config?
+#
+cachepath = "/var/lib/srp/checksum-cache"
+
+
+class Throttle:
+    """Token bucket shared by all the hashing threads, limiting their total
+    read throughput to `rate' bytes per second.  Calling an instance with
+    a number of bytes blocks until that many bytes fit in the budget.
+
+    """
+    def __init__(self, rate):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.next = time.monotonic()
+
+    def __call__(self, nbytes):
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next)
+            self.next = start + nbytes / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+
+def load_cache():
+    """returns the dict of previously verified files"""
     # NOTE: We have to chop the leading '/' off of fname so that
     #       os.path.join will really add in our root path.
     #
-    path = os.path.join(srp.params.root, fname[1:])
-    with open(path, "rb") as f:
-        sha.update(f.read())
-
-    # FIXME: crap.  i can't do this because TarInfo is implemented using
-    #        __slots__...  looks like i need to go back to
-    #        work['manifest'][fname] = {tinfo: TarInfo} so that I can add to
-    #        this bugger.
-    #
-    #        i wonder if i should throw the NOTES file in there too and
-    #        pickle the whole thing into a single file on disk...? or leave
-    #        NOTES seperate so it's easier for users to go look at?
-    x["checksum"] = sha.hexdigest().encode()
+    path = os.path.join(srp.params.root, cachepath[1:])
+    try:
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    except Exception:
+        # missing or corrupt, either way we just start over
+        return {}
 
-    # put our updated manifest entry back into the global map
-    #
-    # FIXME: i really shouldn't have to do this... was I unsure?  or have
-    #        i forgotten about some gotcha?  :-/
-    #
-    #srp.work.install.manifest[fname] = x
+
+def save_cache(cache):
+    path = os.path.join(srp.params.root, cachepath[1:])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "wb") as f:
+        pickle.dump(cache, f)
+    os.rename(path + ".tmp", path)
+
+
+def verify_file(path, checksum, algorithm, cached=None, throttle=None):
+    """Verifies installed file `path' against `checksum'.  Returns a tuple
+    of the resulting status ("ok", "cached", "failed", "missing", or
+    "changed") and the key to cache for the file (or None).
+
+    If the file's (size, mtime, inode, ctime) match `cached', it was
+    verified before and hasn't been touched since, so it isn't re-hashed.
+
+    """
+    try:
+        st = os.lstat(path)
+    except FileNotFoundError:
+        return "missing", None
+    if not stat.S_ISREG(st.st_mode):
+        return "changed", None
+
+    key = (st.st_size, st.st_mtime_ns, st.st_ino, st.st_ctime_ns, checksum)
+    if key == cached:
+        return "cached", key
+
+    if throttle:
+        throttle(st.st_size)
+    if hash_file(path, algorithm) != checksum:
+        return "failed", None
+    return "ok", key
+
+
+def verify_packages(pkgs, iolimit=None):
+    """Re-hashes all installed files of InstalledPackage instances `pkgs'
+    and compares them to the checksums recorded at install-time.  Files
+    from all the packages share a single pool of hashing threads (and
+    `iolimit' bytes per second budget, if specified).  Problems are
+    printed as they're found.  Returns a collections.Counter of results.
+
+    """
+    cache = load_cache()
+    throttle = None
+    if iolimit:
+        throttle = Throttle(iolimit)
+
+    results = collections.Counter()
+    with concurrent.futures.ThreadPoolExecutor(os.cpu_count() or 1) as pool:
+        jobs = {}
+        for p in pkgs:
+            # NOTE: Packages installed before we started recording the
+            #       algorithm were always sha1.
+            try:
+                algo = p.notes.checksum.algorithm
+            except AttributeError:
+                algo = "sha1"
+
+            for fname in p.manifest:
+                checksum = p.manifest[fname].get("checksum")
+                if not checksum:
+                    continue
+                path = os.path.join(srp.params.root, fname[1:])
+                job = pool.submit(verify_file, path, checksum, algo,
+                                  cache.get(path), throttle)
+                jobs[job] = (p.notes.header.fullname, fname, path)
+
+        for job in concurrent.futures.as_completed(jobs):
+            name, fname, path = jobs[job]
+            try:
+                status, key = job.result()
+            except Exception as e:
+                status, key = "error", None
+                print("ERROR: {}: {}: {}".format(name, fname, e))
+            results[status] += 1
+
+            if key:
+                cache[path] = key
+            else:
+                cache.pop(path, None)
+
+            if status in ["failed", "missing", "changed"]:
+                print("{}: {}: {}".format(status.upper(), name, fname))
+            elif srp.params.verbosity > 1:
+                print("{}: {}: {}".format(status, name, fname))
+
+    save_cache(cache)
+
+    print("verified {} files ({} unchanged since last verify),"
+          " {} failed, {} missing, {} changed".format(
+              results["ok"] + results["cached"], results["cached"],
+              results["failed"] + results["error"], results["missing"],
+              results["changed"]))
+    return results
 
 
 def verify_sums():
     """verify, issue warning"""
-    # FIXME: MULTI: this one can't be an iter func, because we would want it
-    #        to happen before anything else.  But we COULD put an
-    #        independant multiprocessing block in here to use multiple cores
-    #        nicely.
-    pass
+    verify_packages(srp.work.action.packages, srp.params.action.iolimit)
+
+
+def purge_cache(paths):
+    """removes installed files `paths' from the dict of previously verified
+    files (e.g., because they've been removed)"""
+    cache = load_cache()
+    n = len(cache)
+    for x in paths:
+        cache.pop(x, None)
+    if len(cache) != n:
+        save_cache(cache)
+
+
+def verify_uninstall():
+    """verify before removal (if requested), issue warning"""
+    # NOTE: This means reading every file we're about to delete, so it's
+    #       only done if asked for.
+    if srp.params.uninstall.verify:
+        verify_packages([srp.work.uninstall.package])
+
+
+def purge_uninstall():
+    """forget about removed files"""
+    # NOTE: We have to chop the leading '/' off of fname so that
+    #       os.path.join will really add in our root path.
+    #
+    purge_cache(os.path.join(srp.params.root, x[1:])
+                for x in srp.work.uninstall.manifest)
+
 
 # FIXME: i don't really remember how i was planning on implementing this.
 #        if i have a commit action, i'll want it to have it's own iter
@@ -72,10 +312,16 @@ register_feature(
     feature_struct("checksum",
                    __doc__,
                    True,
+                   install = stage_struct("checksum", start_sums, [], []),
                    install_iter = stage_struct("checksum", gen_sum,
-                                               ["core"], []),
-                   uninstall = stage_struct("checksum", verify_sums,
+                                               ["core"], ["?size"]),
+                   install_final = stage_struct("checksum", finish_sums,
+                                                [], ["core"]),
+                   uninstall = stage_struct("checksum", verify_uninstall,
                                             [], ["core"]),
+                   uninstall_final = stage_struct("checksum",
+                                                  purge_uninstall,
+                                                  ["core"], []),
                    action = [("commit",
                               stage_struct("checksum", commit_func, [], [])),
                              ("verify",
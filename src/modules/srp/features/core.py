@@ -4,22 +4,23 @@ This feature module implements the core functionality of the package manager
 (i.e., creating, building, installing packages).
 """
 
+import concurrent.futures
 import glob
 import hashlib
 import io
 import os
 import pickle
-import platform
 import pwd
+import re
 import shutil
 import socket
 import stat
-import subprocess
 import tarfile
 import tempfile
 import time
 
 import srp
+import srp.features.checksum
 from srp.features import *
 
 # FIXME: put this as a function somewhere useful... we'll be doing it in
@@ -47,12 +48,205 @@ def partition_list(full_list, n):
 
 
 
+# where the results of bootstrapping source trees get cached (see
+# bootstrap_key)
+bootstrap_cache = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+    "srp", "bootstrap")
+
+# tools whose versions affect the output of bootstrapping
+bootstrap_tools = ["autoreconf", "autoconf", "automake", "aclocal",
+                   "autoheader", "libtoolize", "autopoint"]
+
+
+def _walk_source(sourcedir):
+    """Yields (relpath, lstat) for everything in `sourcedir' except version
+    control dirs and autom4te.cache.
+
+    """
+    for top, dirs, files in os.walk(sourcedir):
+        dirs[:] = sorted(x for x in dirs
+                         if x not in (".git", ".svn", ".hg", "autom4te.cache"))
+        for x in sorted(files + [d for d in dirs
+                                 if os.path.islink(os.path.join(top, d))]):
+            fname = os.path.join(top, x)
+            yield os.path.relpath(fname, sourcedir), os.lstat(fname)
+
+
+# other files that bootstrap inputs pull in: files named in m4_esyscmd
+# calls (e.g., build-aux/git-version-gen .tarball-version) and automake
+# include lines (e.g., *.mk fragments)
+bootstrap_refs = [
+    (re.compile(r"m4_esyscmd(?:_s)?\(([^)]*)\)"), False),
+    (re.compile(r"^[ \t]*-?include[ \t]+(\S+)", re.MULTILINE), True),
+]
+
+
+def _bootstrap_refs(sourcedir, relpath):
+    """Yields the relative paths of files in `sourcedir' referred to by
+    bootstrap input `relpath' (see bootstrap_refs).
+
+    NOTE: Included files are yielded whether they exist or not, but only
+          the words of an m4_esyscmd command that name existing files are
+          (since we can't tell which other words are supposed to be
+          paths).
+
+    """
+    try:
+        with open(os.path.join(sourcedir, relpath), "rb") as f:
+            buf = f.read().decode(errors="replace")
+    except OSError:
+        return
+    topdir = os.path.dirname(relpath)
+    for regex, include in bootstrap_refs:
+        for m in regex.finditer(buf):
+            if include:
+                # automake includes are relative to the Makefile.am
+                x = m.group(1)
+                for var in ("$(top_srcdir)/", "${top_srcdir}/"):
+                    if x.startswith(var):
+                        x = x[len(var):]
+                        break
+                else:
+                    for var in ("$(srcdir)/", "${srcdir}/", "%D%/",
+                                "%reldir%/"):
+                        if x.startswith(var):
+                            x = x[len(var):]
+                            break
+                    x = os.path.join(topdir, x)
+                words = [x]
+            else:
+                # esyscmd commands get run from the top of the tree
+                words = re.split(r"[\s\[\]'\"`;|&<>()]+", m.group(1))
+            for x in words:
+                if not x or "$" in x:
+                    continue
+                x = os.path.normpath(x)
+                if x.startswith((os.pardir, os.sep)) or x == os.curdir:
+                    continue
+                if include or os.path.isfile(os.path.join(sourcedir, x)):
+                    yield x
+
+
+def bootstrap_key(go, sourcedir):
+    """Returns a hex digest of all the inputs to bootstrap command `go' in
+    `sourcedir' (i.e., configure.ac, Makefile.am, m4 files, the bootstrap
+    script itself, anything they pull in (see bootstrap_refs), and the git
+    revision if it's a git checkout) and the autotools installed on the
+    host.
+
+    """
+    import subprocess
+
+    sha = hashlib.new("sha256")
+    sha.update(repr(go).encode())
+    for x in bootstrap_tools:
+        path = shutil.which(x)
+        if path:
+            st = os.stat(path)
+            sha.update("{}:{}:{}\0".format(
+                path, st.st_size, st.st_mtime_ns).encode())
+
+    script = os.path.normpath(go[0])
+    inputs = set()
+    for relpath, st in _walk_source(sourcedir):
+        x = os.path.basename(relpath)
+        if (relpath == script or x == "configure.in"
+            or (x.endswith((".ac", ".am", ".m4")) and x != "aclocal.m4")):
+            inputs.add(relpath)
+
+    todo = sorted(inputs)
+    while todo:
+        for x in _bootstrap_refs(sourcedir, todo.pop()):
+            if x not in inputs:
+                inputs.add(x)
+                todo.append(x)
+
+    for relpath in sorted(inputs):
+        fname = os.path.join(sourcedir, relpath)
+        sha.update(relpath.encode() + b"\0")
+        if os.path.islink(fname):
+            sha.update(os.readlink(fname).encode())
+        elif os.path.isfile(fname):
+            with open(fname, "rb") as f:
+                sha.update(f.read())
+        else:
+            # NOTE: Whether it's there or not matters too (e.g.,
+            #       .tarball-version)
+            sha.update(b"\0missing\0")
+
+    # version scripts (e.g., git-version-gen) look at the git revision,
+    # tags and whether the tree is dirty
+    if os.path.exists(os.path.join(sourcedir, ".git")):
+        for cmd in (["git", "rev-parse", "HEAD"],
+                    ["git", "describe", "--always", "--tags", "--dirty"]):
+            try:
+                sha.update(subprocess.check_output(
+                    cmd, cwd=sourcedir, stderr=subprocess.DEVNULL))
+            except (OSError, subprocess.CalledProcessError):
+                pass
+    return sha.hexdigest()
+
+
+def bootstrap(go, sourcedir, env):
+    """Runs bootstrap command `go' in `sourcedir', or restores its results
+    from the bootstrap_cache if we've already done it for the same inputs
+    (see bootstrap_key).
+
+    The results are whatever files were created or modified by the
+    bootstrap command, stored as a tar file named after the key.
+
+    NOTE: Restored files get their mtimes set to now, so they're newer than
+          their inputs and the automake rebuild rules don't kick in.
+
+    """
+    log = srp.work.build.log
+    key = bootstrap_key(go, sourcedir)
+    cached = os.path.join(bootstrap_cache, key + ".tar")
+    if os.path.exists(cached):
+        kwargs = {}
+        if hasattr(tarfile, "data_filter"):
+            # same behavior as before extraction filters existed
+            kwargs["filter"] = "fully_trusted"
+        with tarfile.open(cached) as f:
+            members = f.getmembers()
+            f.extractall(sourcedir, **kwargs)
+        now = time.time_ns()
+        for m in members:
+            if not m.issym():
+                os.utime(os.path.join(sourcedir, m.name), ns=(now, now))
+        log.write("restored {} bootstrapped files from {}".format(
+            len(members), cached))
+        return
+
+    before = dict((relpath, (st.st_mtime_ns, st.st_size))
+                  for relpath, st in _walk_source(sourcedir))
+    log.run(go, cwd=sourcedir, env=env)
+
+    changed = [relpath for relpath, st in _walk_source(sourcedir)
+               if before.get(relpath) != (st.st_mtime_ns, st.st_size)]
+    try:
+        os.makedirs(bootstrap_cache, exist_ok=True)
+        tmp = "{}.{}.tmp".format(cached, os.getpid())
+        with tarfile.open(tmp, "w") as f:
+            for relpath in changed:
+                f.add(os.path.join(sourcedir, relpath), arcname=relpath,
+                      recursive=False)
+        os.rename(tmp, cached)
+        log.write("cached {} bootstrapped files in {}".format(
+            len(changed), cached), echo=bool(srp.params.verbosity))
+    except OSError as e:
+        # NOTE: It's just a cache, no reason to fail the build
+        log.write("WARNING: failed to cache bootstrap results: {}".format(e))
+
+
 def build_func():
     """run build script to populate payload dir, then create TarInfo objects for
     all files"""
 
     # get some local refs with shorter names
     n = srp.work.build.notes
+    log = srp.work.build.log
 
     # define paths once
     sourcedir = srp.work.topdir + '/source'
@@ -68,25 +262,16 @@ def build_func():
     #       dir.  If --copysrc was specified, we'll make a copy of src in
     #       the build dir.  If src is a source tarball, we'll extract it
     #       in dir.
+    log.phase("source")
+    n.brp.time_source_prep = time.time()
+    n.brp.time_bootstrap = 0
     if os.path.isfile(srp.params.build.src):
         print("extracting source tarball {}".format(srp.params.build.src))
-        with tarfile.open(srp.params.build.src) as f:
-            f.extractall(sourcedir)
-
-        # put source dir in source, not souce/source-x.y.z/
-        #
-        # FIXME: This means if the source tarball is some odd tar that isn't
-        #        all contained in a toplevel dir, we have problems...
-        #
-        #        maybe use TarFile object to check for messy source
-        #        tarball and skip this code if detected?
-        d = os.listdir(sourcedir)
-        if len(d) == 1:
-            d = d[0]
-            for x in os.listdir(sourcedir + "/" + d):
-                os.rename(sourcedir + "/" + d + "/" + x,
-                          sourcedir + "/" + x)
-            os.rmdir(sourcedir + "/" + d)
+        # NOTE: This puts source dir in source, not souce/source-x.y.z/
+        #       (unless it's some odd tar that isn't all contained in a
+        #       toplevel dir)
+        srp.utils.extract_tarball(srp.params.build.src, sourcedir)
+        n.brp.time_source_prep = time.time() - n.brp.time_source_prep
 
     else:
         # user provided external source tree
@@ -99,8 +284,13 @@ def build_func():
         #        we need that here?
         #
         if srp.params.build.copysrc:
-            print("copying external sourcetree...")
-            shutil.copytree(srp.params.build.src, sourcedir)
+            print("copying external sourcetree ({})...".format(
+                srp.params.build.copysrc))
+            counts = srp.utils.copytree(srp.params.build.src, sourcedir,
+                                        srp.params.build.copysrc)
+            log.write("copied source tree: {reflink} reflinked,"
+                      " {hardlink} hardlinked, {copy} copied".format(**counts),
+                      echo=bool(srp.params.verbosity))
 
         elif srp.params.build.gitsrc:
             print("cloning external sourcetree...")
@@ -108,16 +298,14 @@ def build_func():
             if srp.params.build.gitsrc != "HEAD":
                 go += ["--branch", srp.params.build.gitsrc]
             go += [srp.params.build.src, sourcedir]
-            if not srp.params.verbosity:
-                # be silent
-                subprocess.check_call(go, stdout=subprocess.PIPE,
-                                      stderr=subprocess.PIPE)
-            else:
-                subprocess.check_call(go)
+            # only echo if verbose, but log it either way
+            log.run(go, echo=bool(srp.params.verbosity))
 
         else:
             sourcedir = srp.params.build.src
 
+        n.brp.time_source_prep = time.time() - n.brp.time_source_prep
+
         # src is a source tree, do we need to bootstrap?
         #
         # NOTE: If this source tree doesn't use autotools, this block should
@@ -129,24 +317,27 @@ def build_func():
             #       the environment because it's fairly common for
             #       bootstrap/autogen scripts to invoke configure when
             #       they're finished and we don't want that.
+            n.brp.time_bootstrap = time.time()
             new_env = dict(os.environ)
             new_env['NOCONFIGURE'] = "1"
+            go = None
             if os.path.exists(sourcedir + '/bootstrap.sh'):
-                subprocess.check_call(["./bootstrap.sh"],
-                                      cwd=sourcedir, env=new_env)
+                go = ["./bootstrap.sh"]
 
             elif os.path.exists(sourcedir + '/bootstrap'):
-                subprocess.check_call(["./bootstrap"],
-                                      cwd=sourcedir, env=new_env)
+                go = ["./bootstrap"]
 
             elif os.path.exists(sourcedir + '/autogen.sh'):
-                subprocess.check_call(["./autogen.sh"],
-                                      cwd=sourcedir, env=new_env)
+                go = ["./autogen.sh"]
 
             elif (os.path.exists(sourcedir + '/configure.in') or
                   os.path.exists(sourcedir + '/configure.ac')):
-                subprocess.check_call(["autoreconf", "--force", "--install"],
-                                      cwd=sourcedir, env=new_env)
+                go = ["autoreconf", "--force", "--install"]
+
+            if go:
+                log.phase("bootstrap")
+                bootstrap(go, sourcedir, new_env)
+            n.brp.time_bootstrap = time.time() - n.brp.time_bootstrap
 
 
     # create build script
@@ -184,21 +375,10 @@ def build_func():
     #
     #        FUNCTIONS: Absolute path to our helpful functions file.
     #
-    # FIXME: the v2 code is really bad at keeping output synchronized when
-    #        redirecting stdout to a logfile (i.e., output coming directly
-    #        from srp and output coming from subprocesses do not apear in
-    #        the same order in the logfile that they would have w/out
-    #        redirection...).  This has always driven me nuts, but i don't
-    #        know how to fix it.  perhaps we should play with different
-    #        invocations here.  I'm pretty sure that the problem could be
-    #        avoided by returning the output from the subprocess to the
-    #        parent process and then printing it... but that will lead to no
-    #        output from the build until it's all finished, then spamming it
-    #        all to the screen...
-    #
-    #        in C i'd say to use popen and read chunks of stdout from the
-    #        resulting pipe... can we do that easily using subprocess
-    #        module?
+    # NOTE: The v2 code was really bad at keeping output synchronized when
+    #       redirecting stdout to a logfile.  We avoid that by reading the
+    #       build script's stdout and stderr from a single pipe and
+    #       echoing/logging each line ourselves (see BuildLog).
     #
     new_env = dict(os.environ)
     new_env['SOURCE_DIR'] = sourcedir
@@ -206,10 +386,19 @@ def build_func():
     new_env['PAYLOAD_DIR'] = payloaddir
     new_env['EXTRA_DIR'] = extradir
     new_env['FUNCTIONS'] = srp.config.build_functions
+    # share job slots w/ concurrent builds via the GNU make jobserver
+    #
+    # NOTE: Build scripts must call make w/out -j to honor this (see
+    #       MAKE_JOBS in the functions file).
+    pass_fds = ()
+    if srp.work.jobserver:
+        pass_fds = srp.work.jobserver
+        new_env['MAKEFLAGS'] = "-j --jobserver-auth={},{}".format(*pass_fds)
     os.mkdir(builddir)
     os.mkdir(payloaddir)
+    log.phase("build_script")
     n.brp.time_build_script = time.time()
-    subprocess.check_call([buildscript], cwd=builddir, env=new_env)
+    log.run([buildscript], cwd=builddir, env=new_env, pass_fds=pass_fds)
 
     # create manifest
     #
@@ -230,6 +419,7 @@ def build_func():
     # FIXME: straighten out these comments
     #
     n.brp.time_build_script = time.time() - n.brp.time_build_script
+    log.phase("manifest")
     n.brp.time_manifest_creation = time.time()
     srp.work.build.manifest = srp.blob.Manifest.fromdir(payloaddir)
     n.brp.time_manifest_creation = time.time() - n.brp.time_manifest_creation
@@ -240,14 +430,12 @@ def build_final():
 
     # get some local refs with shorter names
     n = srp.work.build.notes
+    srp.work.build.log.phase("package")
 
     # create the toplevel brp archive
     #
     # FIXME: we should remove this file if we fail...
-    mach = platform.machine()
-    if not mach:
-        mach = "unknown"
-    pname = "{}.{}.brp".format(n.header.fullname, mach)
+    pname = srp.brp_name(n)
     n.brp.pname = pname
     print("finalizing", pname)
 
@@ -327,6 +515,9 @@ def build_final():
     brp.close()
     __brp.close()
 
+    srp.work.build.log.phase("done")
+    srp.work.build.log.close()
+
     # clean out topdir
     for g in glob.glob("{}/*".format(srp.work.topdir)):
         if os.path.isdir(g):
@@ -339,13 +530,164 @@ def build_final():
     #        helpful during a --build-and-install?
 
 
+def upgrade_key(t):
+    """Returns the bits of TarInfo `t' that have to match for an installed
+    file to be considered identical to the new one when upgrading (aside
+    from the checksum of regular files).
+
+    NOTE: Ownership isn't compared, because the perms Feature rewrites it
+          in the installed manifest.
+
+    """
+    return (t.type, t.size, t.mode, t.linkname, t.devmajor, t.devminor)
+
+
+def unchanged_file(fname, checksum, algo):
+    """Returns the checksum of the BLOB's copy of `fname' if it matches
+    `checksum' and the installed copy still looks like the one we
+    installed, otherwise None.
+
+    """
+    w = srp.work.install
+    x = w.manifest[fname]
+
+    # NOTE: This is just a cheap sanity check that the file hasn't been
+    #       replaced or truncated since we installed it.  Verifying the
+    #       contents is what --action=verify is for.
+    try:
+        st = os.lstat(os.path.join(srp.params.root, fname[1:]))
+    except FileNotFoundError:
+        return None
+    if not stat.S_ISREG(st.st_mode) or st.st_size != x["tinfo"].size:
+        return None
+
+    new = srp.features.checksum.hash_file(w.blob.fname, algo,
+                                          w.blob.hdr_offset + x["offset"],
+                                          x["tinfo"].size)
+    if new != checksum:
+        return None
+    return new
+
+
+def install_func():
+    """figure out what needs extracting when upgrading"""
+    w = srp.work.install
+    if not w.prev:
+        return
+
+    old = w.prev.manifest
+    new = w.manifest
+    try:
+        algo = w.prev.notes.checksum.algorithm
+    except AttributeError:
+        # NOTE: Packages installed before we started recording the
+        #       algorithm were always sha1.
+        algo = "sha1"
+
+    # NOTE: Regular files that look the same in both manifests still have
+    #       to be checksummed to be sure, so we do those in a pool of
+    #       threads just like the checksum Feature.
+    jobs = {}
+    with concurrent.futures.ThreadPoolExecutor(os.cpu_count() or 1) as pool:
+        for fname in new:
+            try:
+                o = old[fname]
+            except KeyError:
+                continue
+            t = new[fname]["tinfo"]
+            if w.delta and t.isreg():
+                # NOTE: The delta already verified the installed copy of
+                #       each file it left out of the BLOB (see
+                #       srp.bdiff.BlobDelta.apply).
+                if new[fname]["offset"] is None:
+                    w.unchanged.add(fname)
+                    w.sums[fname] = (w.delta.algorithm,
+                                     w.delta.files[fname][4])
+                continue
+            if upgrade_key(o["tinfo"]) != upgrade_key(t):
+                continue
+            if not t.isreg():
+                w.unchanged.add(fname)
+            elif o.get("checksum"):
+                jobs[fname] = pool.submit(unchanged_file, fname,
+                                          o["checksum"], algo)
+
+        for fname, job in jobs.items():
+            checksum = job.result()
+            if checksum:
+                w.unchanged.add(fname)
+                w.sums[fname] = (algo, checksum)
+
+    # hard links have to be re-created if the file they link to gets
+    # re-extracted
+    for owner, aliases in new.hardlinks().items():
+        if owner not in w.unchanged:
+            w.unchanged.difference_update(aliases)
+
+    w.removed = [x for x in old if x not in new]
+
+    print("upgrading from {}: {} unchanged, {} added or changed, {}"
+          " removed".format(w.prev.notes.header.fullname, len(w.unchanged),
+                            len(new) - len(w.unchanged), len(w.removed)))
+
+
 def install_iter(fname):
     """install a file"""
-    srp.work.install.blob.extract(fname, srp.params.root)
+    if fname in srp.work.install.unchanged:
+        return
+    srp.work.install.blob.extract(fname, srp.params.root,
+                                  ctx=srp.work.install.extract)
+
+
+def remove_stale():
+    """Removes the files and dirs that were in the package we're upgrading
+    from, but aren't in the new one.
+
+    """
+    w = srp.work.install
+    old = w.prev.manifest
+    dirs = []
+    files = []
+    for fname in w.removed:
+        # NOTE: We have to chop the leading '/' off of fname so that
+        #       os.path.join will really add in our root path.
+        #
+        path = os.path.join(srp.params.root, fname[1:])
+        if old[fname]["tinfo"].isdir():
+            # NOTE: Only if no other installed package has it (see
+            #       uninstall_func).
+            if srp.db.dir_refcount(fname) <= 1:
+                dirs.append(path)
+            continue
+        files.append(path)
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print("WARNING: failed to remove {}: {}".format(path, e))
+
+    # the checksum Feature doesn't need to remember verifying them anymore
+    srp.features.checksum.purge_cache(files)
+
+    # bottom-up
+    dirs.sort(reverse=True)
+    for path in dirs:
+        try:
+            os.rmdir(path)
+        except OSError:
+            pass
 
 
 def install_final():
     """db registration and cleanup"""
+    # done extracting
+    #
+    # NOTE: If we were staging, srp.install() already moved everything into
+    #       place.
+    ctx = srp.work.install.extract
+    ctx.close()
+
     # commit NOTES to disk in srp db
     n = srp.work.install.notes
 
@@ -353,13 +695,34 @@ def install_final():
     m = srp.work.install.manifest
 
     # register w/ srp db
+    #
+    # NOTE: When upgrading, the new package takes the old one's place in
+    #       the db.
+    #
+    # NOTE: If we're part of a batch, we're in a forked child and the
+    #       parent registers us (see srp.install_batch()).  We'd only be
+    #       updating our own copy of the db anyway, unless it's being
+    #       served by srp.dbserver, in which case we'd register twice.
     inst = srp.db.InstalledPackage(n, m)
-    srp.db.register(inst)
+    if srp.work.install.prev:
+        remove_stale()
+    if srp.work.install.batch is None:
+        if srp.work.install.prev:
+            srp.db.replace(srp.work.install.prev, inst)
+        else:
+            srp.db.register(inst)
+    srp.work.install.installed = inst
+
+    if srp.params.verbosity:
+        print("extract syscalls:", ctx.report())
 
     # commit db to disk
     #
     # FIXME: is there a better place for this?
-    if not srp.params.dry_run:
+    #
+    # NOTE: If we're part of a batch, srp.install_batch() commits once
+    #       everything's been installed.
+    if not srp.params.dry_run and srp.work.install.batch is None:
         srp.db.commit()
 
     # clean out topdir
@@ -370,19 +733,110 @@ def install_final():
             os.remove(g)
 
 
-def uninstall_func():
-    """remove files listed in pkg manifest"""
-    # FIXME: MULTI: why not?  i guess directory removal might get odd, but
-    #        that's already a hard question... where does the removal of
-    #        /usr/local/share/foo happen?  when i remove the last file in
-    #        foo?  what keeps us from accidentally removing share when i
-    #        remove foo if there are no other files in share?
-    pass
+# number of files to queue up before unlinking them
+#
+# NOTE: Files get unlinked a directory at a time, relative to an fd for the
+#       parent directory, so the kernel doesn't have to resolve the full
+#       path of every single file.
+unlink_batch = 4096
 
 
-def uninstall_iter(unused, fname):
+def uninstall_func():
+    """figure out which dirs can be removed"""
+    m = srp.work.uninstall.manifest
+
+    # NOTE: Directories can be shared by lots of packages (e.g., /usr/bin),
+    #       so we only remove the ones that no other installed package
+    #       contains according to the db's directory refcount index.  Even
+    #       then, we leave them alone if there's something else in them
+    #       (e.g., files the user created).
+    dirs = []
+    for fname in m:
+        if m[fname]["tinfo"].isdir() and srp.db.dir_refcount(fname) <= 1:
+            dirs.append(fname)
+    # NOTE: Reverse sorted order puts every dir before its parent.
+    dirs.sort(reverse=True)
+    srp.work.uninstall.dirs = dirs
+
+
+def unlink_pending():
+    """unlink all the queued up files"""
+    w = srp.work.uninstall
+    start = time.time()
+    for d, names in w.pending.items():
+        # NOTE: We have to chop the leading '/' off of d so that
+        #       os.path.join will really add in our root path.
+        #
+        path = os.path.join(srp.params.root, d[1:])
+        try:
+            fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+        except FileNotFoundError:
+            # already gone, and so is everything in it
+            continue
+        try:
+            for x in names:
+                try:
+                    os.unlink(x, dir_fd=fd)
+                    w.nremoved += 1
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    print("WARNING: failed to remove {}: {}".format(
+                        os.path.join(path, x), e))
+        finally:
+            os.close(fd)
+    w.pending = {}
+    w.npending = 0
+    w.times["unlink"] = w.times.get("unlink", 0) + time.time() - start
+
+
+# FIXME: what if another installed package contains the same file?  we'll
+#        happily remove it out from under them...
+#
+def uninstall_iter(fname):
     """remove a file"""
-    pass
+    w = srp.work.uninstall
+    if w.manifest[fname]["tinfo"].isdir():
+        # removed in uninstall_final, once they're empty
+        return
+
+    d, x = os.path.split(fname)
+    w.pending.setdefault(d, []).append(x)
+    w.npending += 1
+    if w.npending >= unlink_batch:
+        unlink_pending()
+
+
+def uninstall_final():
+    """remove dirs, db unregistration"""
+    w = srp.work.uninstall
+
+    # unlink whatever's still queued up
+    unlink_pending()
+
+    # remove unshared dirs, bottom-up
+    start = time.time()
+    ndirs = 0
+    for d in w.dirs:
+        path = os.path.join(srp.params.root, d[1:])
+        try:
+            os.rmdir(path)
+            ndirs += 1
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            if srp.params.verbosity:
+                print("leaving {}: {}".format(path, e.strerror))
+    w.times["rmdir"] = time.time() - start
+
+    # unregister from srp db
+    start = time.time()
+    srp.db.unregister(w.package)
+    if not srp.params.dry_run:
+        srp.db.commit()
+    w.times["db"] = time.time() - start
+
+    print("removed {} files and {} directories".format(w.nremoved, ndirs))
 
 
 def commit_func():
@@ -403,10 +857,13 @@ register_feature(
                    True,
                    build = stage_struct("core", build_func, [], []),
                    build_final = stage_struct("core", build_final, [], []),
+                   install = stage_struct("core", install_func, [], []),
                    install_iter = stage_struct("core", install_iter, [], []),
                    install_final = stage_struct("core", install_final, [], []),
                    uninstall = stage_struct("core", uninstall_func, [], []),
                    uninstall_iter = stage_struct("core", uninstall_iter,
                                                  [], []),
+                   uninstall_final = stage_struct("core", uninstall_final,
+                                                  [], []),
                    action = [("commit",
                               stage_struct("core", commit_func, [], []))]))
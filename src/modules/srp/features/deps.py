@@ -9,12 +9,13 @@ NOTE: This is probably not as portable as it could/should be...
 """
 
 import srp
+import srp.elf
 from srp.features import *
 
-import ctypes
 import glob
 import os
-import subprocess
+import pickle
+import struct
 
 
 class NotesDeps(srp.SrpObject):
@@ -44,22 +45,24 @@ def build_func(fname):
     if srp.params.verbosity > 1:
         print("calculating deps for:", realname)
 
-    # NOTE: We're using objdump here instead of ldd.  The difference is that
-    #       objdump will only tell us what libraries this executable EXPLICITLY
+    # NOTE: We only look at the dynamic section here (i.e., what objdump -p
+    #       would tell us) instead of using ldd.  The difference is that
+    #       this will only tell us what libraries this executable EXPLICITLY
     #       requires, whereas ldd will recursively gather all libraries needed
     #       by this executable and all its libs and all its libs' libs, etc,
     #       etc.  From a package manager's standpoint, I don't think we really
     #       care what other libs a library we need needs... if the system has
     #       it, we'll assume that the system has it AND ALL ITS DEPS already.
-    p = subprocess.Popen(["objdump", "-p", realname],
-                         stdout=subprocess.PIPE,
-                         stderr=subprocess.PIPE)
-    buf = p.communicate()[0]
-    if p.returncode != 0:
-        # objdump failed, must not be an elf binary
+    #
+    # NOTE: This used to fork objdump for every file in the payload, which
+    #       was painfully slow for big packages.  srp.elf checks the magic
+    #       bytes and reads the dynamic section in-process.
+    elf = srp.elf.read(realname)
+    if not elf:
+        # must not be an elf binary
         return
 
-    # We do a whole bunch with this output.
+    # We get a few things out of the elf info.
     #
     #  1. file_format - This is the elf file_format of fname (and it's
     #     required libs).
@@ -69,19 +72,11 @@ def build_func(fname):
     #  3. deps - This list gets populated with (file_format, soname)
     #     tuples of any libraries needed by this file.
     #
-    file_format = None
-    soname = None
-    for line in buf.decode().split('\n'):
-        line = line.strip().split()
-        if not line:
-            continue
-        if line[-3:-1] == ['file', 'format']:
-            file_format = line[-1]
-        if line[0] == "NEEDED":
-            deps.append((file_format, line[1]))
-        if line[0] == "SONAME":
-            soname = line[1]
-    
+    file_format = elf.file_format
+    soname = elf.soname
+    for x in elf.needed:
+        deps.append((file_format, x))
+
     if srp.params.verbosity > 1:
         print("needed:", deps)
 
@@ -119,29 +114,11 @@ def build_func(fname):
 
 def install_func():
     """check system for required libs"""
-    # FIXME: libreadline stupidly has unresolved symbols unless you link it
-    #        with libncurses (or libtermcap, if memory serves).  so,
-    #        ctypes.cdll.LoadLibrary("libreadline.so.6") will fail, even
-    #        though we DO have the library.
-    #
-    # FIXME: sooo, i think this should be fixed by the distro when
-    #        installing readline (e.g., LFS does a 'make
-    #        SHLIB_LIBS=-lncurses')... but should i print a warning about
-    #        this particular lib if we encounter one w/ unresolved refs?  we
-    #        should be able to pick this out by looking at the error msg.
-    #        for undefined refs we get:
-    #
-    #        OSError: /home/mike/staging/lib/libreadline.so.6: undefined
-    #        symbol: PC
-    #
-    #        but for a completely missing lib, we got:
-    #
-    #        OSError: libasdf.so.5: cannot open shared object file: No such
-    #        file or directory
-    #
-    # FIXME: for now, when tesing on systems with broken libreadline, you
-    #        can get the deps check to pass by setting
-    #        LD_PRELOAD=libncurses.so.5 on the command line.
+    # NOTE: We don't actually load the libraries (via ctypes or the ELF
+    #       interpreter) anymore, we just look them up by name in an index of
+    #       what the dynamic linker would find.  That means libs with
+    #       unresolved symbols (e.g., libreadline not linked against
+    #       libncurses) no longer trip up the check.
     n = srp.work.install.notes
     deps = n.deps.libs_needed[:]
     if srp.params.verbosity:
@@ -153,6 +130,32 @@ def install_func():
             deps.remove(x)
         except:
             pass
+
+    # weed out libs provided by other packages being installed along with
+    # this one
+    for other in srp.work.install.batch or []:
+        try:
+            provided = other.deps.libs_provided
+        except AttributeError:
+            continue
+        for x in provided:
+            if x in deps:
+                if srp.params.verbosity:
+                    print("{} provides {}".format(other.header.fullname, x))
+                deps.remove(x)
+
+    # weed out libs provided by installed packages
+    #
+    # NOTE: This is just a lookup in the db's provides index, so for a
+    #       system where everything was installed via srp, we never have to
+    #       go poking around the filesystem.
+    for x in deps[:]:
+        provs = srp.db.lookup_by_lib(x)
+        if provs:
+            if srp.params.verbosity:
+                print("{} provides {}".format(
+                    provs[0].notes.header.fullname, x))
+            deps.remove(x)
     if srp.params.verbosity:
         print("deps:", deps)
 
@@ -170,9 +173,14 @@ def install_func():
     for d in deps:
         if not lookup_lib(*d):
             missing.append(d)
-    
+
+    # keep any newly cached file formats for next time
+    save_index()
+
     if missing:
-        raise Exception("missing required libraries:\n  --> " + "\n  --> ".join(missing))
+        raise Exception("missing required libraries:\n  --> " +
+                        "\n  --> ".join("{} ({})".format(x[1], x[0])
+                                         for x in missing))
 
 
 
@@ -189,105 +197,251 @@ def info_func(p):
 
 # objdump -p fname | grep "file format"
 def lookup_file_format(fname):
-    p = subprocess.Popen(["objdump", "-p", fname],
-                         stdout=subprocess.PIPE,
-                         stderr=subprocess.PIPE)
-    buf = p.communicate()[0]
-    if p.returncode != 0:
-        # objdump failed, must not be an elf binary
+    elf = srp.elf.read(fname)
+    if not elf:
+        # must not be an elf binary
         return
 
-    file_format = None
-    for line in buf.decode().split('\n'):
-        line = line.strip().split()
-        if not line:
-            continue
-        if line[-3:-1] == ['file', 'format']:
-            file_format = line[-1]
-            break
-
-    return file_format
-
-
-# grep ld-linux $(which ldd)
-def lookup_elf_interpreters():
-    p = subprocess.Popen(["which", "ldd"],
-                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    buf = p.communicate()[0]
-    if p.returncode != 0:
-        raise Exception("Failed to locate ldd")
-    
-    ldd = buf.decode().split('\n')[0]
-    with open(ldd) as f:
-        retval = {}
-        for line in f:
-            line = line.strip()
-            if not line:
-                continue
-            if line.startswith("RTLDLIST="):
-                line = line[9:].strip('"').split()
-                for x in line:
-                    if os.path.exists(x):
-                        retval[lookup_file_format(x)] = x
-    
-    if not retval:
-        raise Exception("Failed to detect any valid elf interpreters")
-    
-    return retval
-
-
-# FIXME: this could look in tons of other dirs... but really, what's the
-#        chance that there are no libraries in the directory alongside
-#        ld-linux.so?
+    return elf.file_format
+
+
+# NOTE: The library index is persisted here so we don't have to re-scan the
+#       system on every install.  It gets rebuilt automatically whenever
+#       ld.so.cache, ld.so.conf, or any of the scanned dirs change.
 #
-def lookup_matching_lib(elf, file_format):
-    # start in dirname(elf)
-    for x in glob.glob("{}/lib*.so*".format(os.path.dirname(elf))):
-        if srp.params.verbosity > 1:
-            print("checking for {}: {}".format(file_format, x))
-        fmt = lookup_file_format(x)
-        if srp.params.verbosity > 1:
-            print("file_format:", fmt)
-        if file_format == fmt:
-            return x
-    
-    raise Exception("Failed to find any libs of format {}".format(file_format))
+# FIXME: path in config?
+#
+cachepath = "/var/lib/srp/libcache"
 
+# the standard library dirs searched by the dynamic linker (in addition to
+# whatever is listed in ld.so.conf)
+#
+# NOTE: Multiarch dirs (e.g., /usr/lib/x86_64-linux-gnu) get added via
+#       lib_dir_globs.
+lib_dirs = ["/lib", "/lib64", "/lib32", "/libx32",
+            "/usr/lib", "/usr/lib64", "/usr/lib32", "/usr/libx32"]
+lib_dir_globs = ["/lib/*-linux-*", "/usr/lib/*-linux-*"]
+
+
+class LibraryIndex(srp.SrpObject):
+    """Class representing an index of all the shared libraries available on
+    the system rooted at `root' (i.e., what the dynamic linker would find
+    via ld.so.cache and the standard library dirs).
+
+    Data:
+
+      root - The root dir the index describes.
+
+      sources - Dict mapping each file or dir the index was built from to
+          its mtime at the time (or None if it didn't exist).
+
+      paths - Dict mapping library names to a list of candidate paths, in
+          the order the dynamic linker would try them.
+
+      formats - Dict caching the file_format of each candidate path we've
+          already looked at.
+
+    NOTE: Paths are stored relative to root (i.e., as they would appear on
+          the installed system).
+
+    """
+    def __init__(self, root):
+        self.root = root
+        self.sources = {}
+        self.paths = {}
+        self.formats = {}
+        self.dirty = False
+
+    def realpath(self, path):
+        # NOTE: We have to chop the leading '/' off of path so that
+        #       os.path.join will really add in our root path.
+        return os.path.join(self.root, path[1:])
+
+    def mtime(self, path):
+        try:
+            return os.stat(self.realpath(path)).st_mtime_ns
+        except OSError:
+            return None
+
+    def valid(self):
+        """Returns True if none of the index's sources have changed"""
+        for path, mtime in self.sources.items():
+            if self.mtime(path) != mtime:
+                return False
+        return True
+
+    def add(self, name, path):
+        paths = self.paths.setdefault(name, [])
+        if path not in paths:
+            paths.append(path)
+
+    def scan(self):
+        """(Re)populates the index from ld.so.cache and the library dirs"""
+        self.sources = {}
+        self.paths = {}
+        self.formats = {}
+        self.dirty = True
+
+        self.sources["/etc/ld.so.cache"] = self.mtime("/etc/ld.so.cache")
+        for name, path in self.read_ld_cache("/etc/ld.so.cache"):
+            self.add(name, path)
+
+        dirs = self.read_ld_conf("/etc/ld.so.conf")
+        dirs.extend(lib_dirs)
+        for g in lib_dir_globs:
+            dirs.extend(sorted(x[len(self.root.rstrip("/")):] for x in
+                               glob.glob(self.realpath(g))))
+        for d in dirs:
+            if d in self.sources:
+                continue
+            self.sources[d] = self.mtime(d)
+            try:
+                entries = sorted(os.listdir(self.realpath(d)))
+            except OSError:
+                continue
+            for x in entries:
+                if ".so" in x:
+                    self.add(x, os.path.join(d, x))
+
+    def read_ld_cache(self, path):
+        """Returns a list of (name, path) tuples from the ld.so.cache file at
+        `path' (new format only, which is what glibc has written by default
+        since 2.32)
+
+        """
+        try:
+            with open(self.realpath(path), "rb") as f:
+                buf = f.read()
+        except OSError:
+            return []
+
+        # NOTE: Old glibc wrote the old format followed by the new one, in
+        #       which case we skip past the old table.
+        offset = 0
+        if buf.startswith(b"ld.so-1.7.0"):
+            nlibs = struct.unpack_from("=I", buf, 12)[0]
+            offset = (16 + nlibs * 12 + 7) & ~7
+        if buf[offset:offset+20] != b"glibc-ld.so.cache1.1":
+            return []
+
+        # NOTE: String offsets in the new format are relative to the start
+        #       of the new header.
+        def string(i):
+            i += offset
+            return buf[i:buf.index(b"\0", i)].decode(errors="replace")
+
+        retval = []
+        nlibs = struct.unpack_from("=I", buf, offset + 20)[0]
+        for i in range(nlibs):
+            flags, key, value = struct.unpack_from(
+                "=iII", buf, offset + 48 + i * 24)
+            retval.append((string(key), string(value)))
+        return retval
+
+    def read_ld_conf(self, path, depth=0):
+        """Returns a list of dirs from ld.so.conf file `path' (including
+        dirs from any included files)
+
+        """
+        self.sources[path] = self.mtime(path)
+        try:
+            with open(self.realpath(path)) as f:
+                lines = f.readlines()
+        except OSError:
+            return []
+
+        retval = []
+        for line in lines:
+            line = line.split("#")[0].strip()
+            if not line:
+                continue
+            if line.startswith("include") and depth < 8:
+                for pattern in line.split()[1:]:
+                    if not pattern.startswith("/"):
+                        pattern = os.path.join(os.path.dirname(path), pattern)
+                    for x in sorted(glob.glob(self.realpath(pattern))):
+                        x = x[len(self.root.rstrip("/")):]
+                        retval.extend(self.read_ld_conf(x, depth + 1))
+            elif not line.startswith("hwcap"):
+                retval.append(line)
+        return retval
+
+    def lookup(self, file_format, libname):
+        """Returns the path to library `libname' of `file_format', or None
+        if the system doesn't have it.
+
+        """
+        for path in self.paths.get(libname, []):
+            try:
+                fmt = self.formats[path]
+            except KeyError:
+                try:
+                    fmt = lookup_file_format(self.realpath(path))
+                except OSError:
+                    # e.g., dangling symlink
+                    fmt = None
+                self.formats[path] = fmt
+                self.dirty = True
+            if fmt == file_format:
+                return path
+
+
+# the LibraryIndex for the current root
+_index = None
+
+
+def get_index():
+    """Returns a valid LibraryIndex for srp.params.root, loading it from disk
+    or rebuilding (and saving) it as needed.
+
+    """
+    global _index
+    if _index and _index.root == srp.params.root and _index.valid():
+        return _index
+
+    path = os.path.join(srp.params.root, cachepath[1:])
+    try:
+        with open(path, "rb") as f:
+            _index = pickle.load(f)
+        if _index.root == srp.params.root and _index.valid():
+            return _index
+    except Exception:
+        pass
 
-# LD_PRELOAD=libfoo.so /lib64/ld-linux-x86-64.so.2 \
-#    --list /lib64/libdl.so
-def lookup_lib(file_format, libname):
-    # get list of available elf interpreters
-    elf = lookup_elf_interpreters()[file_format]
-    
-    # find an appropriate lib to interrogate
-    piggy = lookup_matching_lib(elf, file_format)
-    
-    # add the lib we're checking for via LD_PRELOAD (basically pretend
-    # that whatever library we're using as our guinea pig was linked
-    # against it) and have the interpreter go find all the libraries on
-    # the system.
-    #
-    # "LD_PRELOAD={} {} --list {}".format(libname, elf, piggy))
-    #
-    p = subprocess.Popen([elf, "--list", piggy],
-                         stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                         env = {"LD_PRELOAD": libname})
-    out,err = p.communicate()
     if srp.params.verbosity:
-        print(err)
-        print(out)
-    
-    for line in out.decode().split('\n'):
-        line = line.strip().split()
-        if srp.params.verbosity:
-            print(line)
-        if not line:
-            continue
-        if line[0] == libname:
-            return line[2]
+        print("scanning system libraries")
+    _index = LibraryIndex(srp.params.root)
+    _index.scan()
+    save_index()
+    return _index
+
+
+def save_index():
+    """Saves the current LibraryIndex (e.g., after caching more formats)"""
+    if not _index or not _index.dirty or srp.params.dry_run:
+        return
+    path = os.path.join(srp.params.root, cachepath[1:])
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        _index.dirty = False
+        # NOTE: The tmp file is per-process because we might be one of
+        #       several concurrent installs (see srp.install_batch).
+        tmp = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp, "wb") as f:
+            pickle.dump(_index, f)
+        os.rename(tmp, path)
+    except OSError:
+        # NOTE: The index is just a cache, so it's not a problem if we
+        #       can't save it (e.g., non-root user querying)
+        pass
+
 
+def lookup_lib(file_format, libname):
+    """Returns the path to library `libname' of `file_format' on the system
+    (or None).  This is just a dict lookup in the cached LibraryIndex.
 
+    """
+    return get_index().lookup(file_format, libname)
 
 
 register_feature(
@@ -12,6 +12,7 @@ NOTE: This is the only appropriate way to set file ownership.  Using chown in
 import srp.notes
 from srp.features import *
 
+import functools
 import os
 import re
 import tarfile
@@ -93,6 +94,8 @@ class PermsList(list):
 
             self.append({'regex': re.compile(pattern), 'options': options_dict})
 
+        self._compile()
+
 
     def __getitem__(self, fname):
         """
@@ -108,24 +111,95 @@ class PermsList(list):
         if isinstance(fname, int):
             return list.__getitem__(self, fname)
 
-        retval = []
-        for x in self:
+        hits = set()
+
+        # NOTE: Most files don't match any rule at all, so we check the
+        #       combined filter first and only bother with the individual
+        #       regexes if it matches.
+        if self._filter is None or self._filter.search(fname):
+            for i, r in self._filtered:
+                if r.search(fname):
+                    hits.add(i)
+        for i, r in self._unfiltered:
+            if r.search(fname):
+                hits.add(i)
+
+        # recursive rules match on fname or any of its parent dirs
+        if self._recursive:
+            hits.update(self._recursive_matches(
+                fname.rpartition(os.path.sep)[0]))
+            for i, r in self._recursive:
+                if r.search(fname):
+                    hits.add(i)
+
+        # NOTE: Return matches in the order the rules were defined
+        return [list.__getitem__(self, i) for i in sorted(hits)]
+
+
+    def _compile(self):
+        """Builds the lookup structures used by __getitem__.  Non-recursive
+        rules are combined into a single alternation that is used to
+        quickly weed out files that don't match any of them.
+
+        """
+        self._recursive = []
+        self._filtered = []
+        self._unfiltered = []
+        for i, x in enumerate(self):
             if x['options']['recursive'] != "false":
-                # we have to try matching on fname and each of it's parent dirs
-                sep = os.path.sep
-                y = fname.split(sep)
-                for i in range(len(y)):
-                    subname = sep.join(y[:len(y)-i])
-                    if not subname:
-                        continue
-                    if x['regex'].search(subname):
-                        retval.append(x)
-                        break
+                self._recursive.append((i, x['regex']))
+            elif x['regex'].groups:
+                # NOTE: Patterns with groups (e.g., backrefs) would change
+                #       meaning in the combined alternation, so they always
+                #       get checked individually.
+                self._unfiltered.append((i, x['regex']))
+            else:
+                self._filtered.append((i, x['regex']))
+
+        self._filter = None
+        if self._filtered:
+            try:
+                self._filter = re.compile("|".join(
+                    "(?:{})".format(r.pattern) for i, r in self._filtered))
+            except re.error:
+                # e.g., inline global flags in the middle of the
+                # alternation, fall back to checking each one
+                pass
+
+        # maps dir name to frozenset of recursive rule indices that match
+        # the dir or any of its parents
+        self._dircache = {}
+
 
-            elif x['regex'].search(fname):
-                retval.append(x)
+    def _recursive_matches(self, d):
+        """Returns a frozenset of the indices of recursive rules that match
+        directory `d' or any of its parent dirs.  Results are cached per
+        directory, so each rule gets tried on each directory only once.
 
-        return retval
+        """
+        if not d:
+            return frozenset()
+        try:
+            return self._dircache[d]
+        except KeyError:
+            pass
+
+        hits = self._recursive_matches(d.rpartition(os.path.sep)[0])
+        new = [i for i, r in self._recursive if r.search(d)]
+        if new:
+            hits = hits.union(new)
+        self._dircache[d] = hits
+        return hits
+
+
+@functools.lru_cache(maxsize=None)
+def compile_perms(buf):
+    """Returns a PermsList for perms buffer `buf'.  The result is cached so
+    that the rules only get parsed and compiled once per build instead of
+    once per file.
+
+    """
+    return PermsList(buf)
 
 
 # NOTE: We want this to be done at build time... At build time, we could
@@ -150,7 +224,7 @@ class PermsList(list):
 def build_func(fname):
     """update tarinfo via perms section of NOTES file"""
     n = srp.work.build.notes
-    p = PermsList(n.perms.buffer)
+    p = compile_perms(n.perms.buffer)
 
     x = srp.work.build.manifest[fname]["tinfo"]
     if srp.params.verbosity > 1:
@@ -190,10 +264,11 @@ def build_func(fname):
     #
     # NOTE: We need to use fname here instead of x.name because leading slashes
     #       are pruned off of the TarInfo objects
-    if not p[fname]:
+    rules = p[fname]
+    if not rules:
         return
 
-    for rule in p[fname]:
+    for rule in rules:
         if srp.params.verbosity > 1:
             print("rule:", rule)
 
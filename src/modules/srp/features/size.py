@@ -46,11 +46,7 @@ def increment_notes_install(fname):
 
     # NOTE: The file is already installed on disk, so we don't need to mess
     #       with the old BLOB
-    #
-    # NOTE: We have to chop the leading '/' off of fname so that
-    #       os.path.join will really add in our root path.
-    #
-    path = os.path.join(srp.params.root, fname[1:])
+    path = installed_path(fname)
     n.size.total += os.stat(path)[stat.ST_SIZE]
 
 
@@ -34,11 +34,7 @@ def install_func(fname):
 
     # NOTE: The file is already installed on disk, so we don't need to mess
     #       with the old BLOB
-    #
-    # NOTE: We have to chop the leading '/' off of fname so that
-    #       os.path.join will really add in our root path.
-    #
-    path = os.path.join(srp.params.root, fname[1:])
+    path = installed_path(fname)
 
     go = ["strip", "--strip-unneeded", path]
     # NOTE: I'd love to do a check_call here, but strip returns error if
@@ -7,12 +7,10 @@ import collections
 import configparser
 import re
 import base64
-import tarfile
 import tempfile
 import types
 import os
 import pwd
-import socket
 import time
 
 # FIXME: we should implement a v2->v3 translator here.  it should translate
@@ -142,6 +140,8 @@ class NotesScript(NotesBuffer):
 
 class NotesBrp(srp.SrpObject):
     def __init__(self):
+        import socket
+
         # FIXME: should have a .srprc file to specify a full name (e.g.,
         #        'Joe Bloe <bloe@mail.com>'), and fallback to user id if
         #        it's not set
@@ -161,6 +161,13 @@ class NotesBrp(srp.SrpObject):
         #
         self.time_total = time.time()
 
+        # Hash of everything that went into the package (see
+        # srp.build_key)
+        #
+        # NOTE: Set by srp.core.build for update builds.
+        #
+        self.build_key = None
+
 
 class NotesInstalled(srp.SrpObject):
     def __init__(self, from_sha):
@@ -215,6 +222,11 @@ class NotesFile(srp.SrpObject):
         for s in c.keys():
             if s not in ["header", "script", "brp", "installed", "DEFAULT"]:
                 self.header.features.append(s)
+                # NOTE: The feature's module defines the subsection class
+                #       (and sticks it in our namespace), so we have to make
+                #       sure it's been imported.
+                if s in srp.features.feature_index:
+                    srp.features.registered_features[s]
                 # instantiate special feature subsections
                 setattr(self, s,
                         globals()["Notes"+s.capitalize()](c[s]))
@@ -270,10 +282,9 @@ class NotesFile(srp.SrpObject):
     # used to update features on the command line
     def update_features(self, options):
         for o in options:
-            if o in self.header.features:
-                # already there
-                continue
-
+            # NOTE: This has to happen even if the disabler is already
+            #       there, in case the feature has been re-enabled since
+            #       (e.g., by the defaults).
             if o.startswith("no_"):
                 try:
                     self.header.features.remove(o[3:])
@@ -281,4 +292,8 @@ class NotesFile(srp.SrpObject):
                     # wasn't enabled to begin with
                     pass
 
+            if o in self.header.features:
+                # already there
+                continue
+
             self.header.features.append(o)
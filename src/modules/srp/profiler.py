@@ -0,0 +1,236 @@
+"""Profiling hooks for srp's operational modes and Feature stage functions.
+
+When srp.params.profile is set to a directory, srp.build(), srp.install()
+and srp.query() are each run under cProfile and a wall-clock stack
+sampler.  Each stage (e.g., build_iter) gets its own region, and if
+srp.params.profile_funcs is also set, each Feature stage function gets a
+region nested inside its stage.
+
+Regions are named hierarchically with dots, prefixed by a sequence number
+so that chained invocations (e.g., -b foo -b bar) don't clobber each
+other:
+
+  1-build
+  1-build.build_iter
+  1-build.build_iter.perms
+
+For every region, two files are written when the mode finishes:
+
+  NAME.pstats - Output suitable for pstats.Stats or snakeviz.
+
+  NAME.folded - Collapsed stacks, one "frame;frame;frame count" per line,
+      suitable for feeding directly into flamegraph.pl.
+
+Each file includes the data for all of its nested regions, so 1-build.pstats
+covers the whole build.
+
+NOTE: Only one cProfile.Profile can be active at a time, so entering a
+      nested region suspends the parent's profiler until the nested region
+      is exited.  The data gets merged back together at dump time.
+
+NOTE: The stack sampler uses SIGALRM, so it only works when srp is running
+      in the main thread.  We quietly skip sampling otherwise.
+"""
+
+import collections
+import contextlib
+import cProfile
+import functools
+import os
+import signal
+import threading
+import time
+
+import srp
+
+
+# seconds of wall-clock time between stack samples
+sample_interval = 0.001
+
+# number of mode-level regions profiled so far (used to prefix region names)
+_sequence = 0
+
+# stack of currently active region names
+_active = []
+
+# maps region name to cProfile.Profile instance
+_profiles = {}
+
+# maps region name to collections.Counter of folded stack strings
+_samples = {}
+
+# maps region name to [call count, total wall-clock seconds]
+_timings = {}
+
+# maps plain region name (e.g., install_iter) to total wall-clock seconds
+#
+# NOTE: This gets updated whether or not profiling is enabled, because it's
+#       basically free (see benchmark.py).
+times = collections.Counter()
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return "{} ({}:{})".format(code.co_name,
+                               os.path.basename(code.co_filename),
+                               code.co_firstlineno)
+
+
+def _sample(signum, frame):
+    """SIGALRM handler that records the interrupted stack for the innermost
+    active region.
+
+    """
+    if not _active:
+        return
+    stack = []
+    while frame:
+        # skip our own bookkeeping frames
+        if frame.f_code.co_filename != __file__:
+            stack.append(_frame_label(frame))
+        frame = frame.f_back
+    stack.reverse()
+    _samples[_active[-1]][";".join(stack)] += 1
+
+
+def _sampler_start():
+    if threading.current_thread() is not threading.main_thread():
+        return
+    signal.signal(signal.SIGALRM, _sample)
+    signal.setitimer(signal.ITIMER_REAL, sample_interval, sample_interval)
+
+
+def _sampler_stop():
+    if threading.current_thread() is not threading.main_thread():
+        return
+    signal.setitimer(signal.ITIMER_REAL, 0)
+    signal.signal(signal.SIGALRM, signal.SIG_DFL)
+
+
+@contextlib.contextmanager
+def region(name):
+    """Context manager that profiles everything executed inside it as region
+    `name' (nested inside whatever region is currently active).  If
+    profiling isn't enabled, we just add up how long it took in `times'.
+
+    """
+    if not srp.params.profile or not _active:
+        t = time.time()
+        try:
+            yield
+        finally:
+            times[name] += time.time() - t
+        return
+
+    name = "{}.{}".format(_active[-1], name)
+    if name not in _profiles:
+        _profiles[name] = cProfile.Profile()
+        _samples[name] = collections.Counter()
+        _timings[name] = [0, 0.0]
+
+    # suspend parent, activate us
+    _profiles[_active[-1]].disable()
+    _active.append(name)
+    t = time.time()
+    _profiles[name].enable()
+    try:
+        yield
+    finally:
+        _profiles[name].disable()
+        _timings[name][0] += 1
+        _timings[name][1] += time.time() - t
+        _active.pop()
+        _profiles[_active[-1]].enable()
+
+
+def call(f, *args):
+    """Calls stage_struct `f' with `args', profiling it as its own region if
+    srp.params.profile_funcs is set.
+
+    """
+    if not (srp.params.profile and srp.params.profile_funcs):
+        return f.func(*args)
+    with region(f.name):
+        return f.func(*args)
+
+
+def profiled(mode):
+    """Decorator for the toplevel operational mode functions (e.g.,
+    srp.build).  If srp.params.profile is set, the decorated function is
+    run as a new toplevel region and all the collected data is written to
+    disk when it returns (or raises).
+
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            global _sequence
+            if not srp.params.profile or _active:
+                return func(*args, **kwargs)
+
+            _sequence += 1
+            name = "{}-{}".format(_sequence, mode)
+            _profiles[name] = cProfile.Profile()
+            _samples[name] = collections.Counter()
+            _timings[name] = [1, 0.0]
+
+            _active.append(name)
+            _sampler_start()
+            t = time.time()
+            _profiles[name].enable()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _profiles[name].disable()
+                _timings[name][1] = time.time() - t
+                _sampler_stop()
+                _active.pop()
+                dump(name)
+
+        return wrapper
+    return decorator
+
+
+def dump(top):
+    """Writes .pstats and .folded files for toplevel region `top' and all
+    its nested regions to srp.params.profile, then discards the data.
+
+    """
+    # NOTE: pstats is slow to import and we only need it here, so there's
+    #       no sense making every srp invocation pay for it.
+    import pstats
+
+    outdir = srp.params.profile
+    os.makedirs(outdir, exist_ok=True)
+
+    names = [x for x in sorted(_profiles)
+             if x == top or x.startswith(top + ".")]
+    for name in names:
+        # each region's files include all of its nested regions
+        subs = [x for x in names if x == name or x.startswith(name + ".")]
+
+        # NOTE: pstats refuses to load a Profile that never recorded
+        #       anything, so we have to skip those.
+        stats = pstats.Stats()
+        for x in subs:
+            if _profiles[x].getstats():
+                stats.add(_profiles[x])
+        stats.dump_stats(os.path.join(outdir, name + ".pstats"))
+
+        folded = collections.Counter()
+        for x in subs:
+            folded.update(_samples[x])
+        with open(os.path.join(outdir, name + ".folded"), "w") as f:
+            for stack in sorted(folded):
+                f.write("{} {}\n".format(stack, folded[stack]))
+
+        if srp.params.verbosity:
+            print("profile: {}: {} calls, {:.3f}s".format(
+                name, *_timings[name]))
+
+    print("profile data for {} written to {}".format(top, outdir))
+
+    for name in names:
+        del _profiles[name]
+        del _samples[name]
+        del _timings[name]
@@ -1,8 +1,13 @@
 """random utility functions
 """
 
+import errno
+import fcntl
 import glob
+import grp
 import os
+import pwd
+import shutil
 
 def wrap_text(buf, cols=80, indent=0):
     """Simple formatter that eats up internal line breaks and whitespace, then
@@ -51,3 +56,283 @@ def expand_path(path):
 
     rv = os.path.abspath(rv[0])
     return rv
+
+
+def parse_size(size):
+    """Returns integer number of bytes represented by string `size', which
+    can have a K, M, or G suffix (powers of 1024).
+
+    """
+    size = str(size).strip()
+    mult = 1
+    for suffix, m in [("K", 1024), ("M", 1024**2), ("G", 1024**3)]:
+        if size.upper().endswith(suffix):
+            size = size[:-1]
+            mult = m
+            break
+    return int(float(size) * mult)
+
+
+def parse_bool(value):
+    """Returns bool represented by `value', which may already be a bool or
+    may be a string from the command line (e.g., 'True', 'no', '0').
+
+    """
+    if isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes", "on")
+    return bool(value)
+
+
+def extract_tarball(fname, dest):
+    """Extracts tarball `fname' into directory `dest' in a single streaming
+    pass.  If everything in the archive is inside a single toplevel dir
+    (i.e., a typical source tarball), that dir is stripped off.
+
+    We don't know if the archive is well behaved until we've seen all of
+    it, so the first member's toplevel dir is stripped optimistically.  If
+    anything turns up outside of it, what's been extracted so far gets
+    moved back down into it and we carry on w/out stripping.
+
+    """
+    import tarfile
+
+    os.makedirs(dest, exist_ok=True)
+    kwargs = {}
+    if hasattr(tarfile, "data_filter"):
+        # same behavior as before extraction filters existed
+        kwargs["filter"] = "fully_trusted"
+
+    def normalize(name):
+        while name.startswith("./"):
+            name = name[2:]
+        return name.rstrip("/")
+
+    prefix = None
+    dirs = []
+    with tarfile.open(fname, "r|*") as tar:
+        for m in tar:
+            name = normalize(m.name)
+            if m.islnk():
+                m.linkname = normalize(m.linkname)
+            if not name or name == ".":
+                continue
+            top, sep, rest = name.partition("/")
+
+            if prefix is None:
+                prefix = top if sep or m.isdir() else ""
+            elif prefix and top != prefix:
+                # messy tarball, put back what we stripped
+                tmp = dest + ".tmp"
+                os.rename(dest, tmp)
+                os.mkdir(dest)
+                os.rename(tmp, os.path.join(dest, prefix))
+                for d in dirs:
+                    d.name = prefix + "/" + d.name
+                prefix = ""
+
+            if prefix:
+                if not rest:
+                    # the toplevel dir itself
+                    continue
+                m.name = rest
+                if m.islnk() and m.linkname.startswith(prefix + "/"):
+                    m.linkname = m.linkname[len(prefix)+1:]
+            else:
+                m.name = name
+
+            if m.isdir():
+                # NOTE: Like extractall, we set directory attributes at
+                #       the very end, so read-only dirs don't get in our way
+                dirs.append(m)
+                tar.extract(m, dest, set_attrs=False, **kwargs)
+            else:
+                tar.extract(m, dest, **kwargs)
+
+    for d in reversed(dirs):
+        path = os.path.join(dest, d.name)
+        os.chmod(path, d.mode)
+        os.utime(path, (d.mtime, d.mtime))
+
+
+# ioctl request number for FICLONE (see linux/fs.h)
+FICLONE = 0x40049409
+
+
+def copytree(src, dst, mode="reflink"):
+    """Recursively copies directory `src' to `dst' (see shutil.copytree)
+    and returns a dict counting how many files were reflinked, hardlinked,
+    and copied.  Valid values for `mode':
+
+      reflink - Clone each file w/ the FICLONE ioctl (i.e., copy-on-write,
+          nearly free on btrfs, xfs, etc).
+
+      hardlink - Create a farm of hard links to the original files.
+
+      copy - Plain old copy.
+
+    Reflinks and hard links both fall back to a regular copy when the
+    filesystem can't do them (e.g., ext4, or dst is on another device).
+
+    NOTE: Hard linked files are shared w/ src, so anything that modifies a
+          file in place (as apposed to replacing it) modifies the original
+          too.
+
+    """
+    counts = {"reflink": 0, "hardlink": 0, "copy": 0}
+    state = {"reflink": mode == "reflink", "hardlink": mode == "hardlink"}
+
+    def copy(s, d):
+        if state["hardlink"]:
+            try:
+                os.link(s, d)
+                counts["hardlink"] += 1
+                return d
+            except OSError as e:
+                # EXDEV means none of them are going to work, but something
+                # like EPERM (e.g., protected_hardlinks) is per-file
+                if e.errno == errno.EXDEV:
+                    state["hardlink"] = False
+
+        if state["reflink"]:
+            try:
+                with open(s, "rb") as fs, open(d, "wb") as fd:
+                    fcntl.ioctl(fd.fileno(), FICLONE, fs.fileno())
+                shutil.copystat(s, d)
+                counts["reflink"] += 1
+                return d
+            except OSError as e:
+                if e.errno not in (errno.EOPNOTSUPP, errno.ENOTTY,
+                                   errno.EXDEV, errno.EINVAL, errno.ENOSYS):
+                    raise
+                # not supported here, don't bother trying again
+                state["reflink"] = False
+
+        counts["copy"] += 1
+        return shutil.copy2(s, d)
+
+    shutil.copytree(src, dst, copy_function=copy)
+    return counts
+
+
+class IdMap(object):
+    """Class mapping user and group names to ids (and back) for the system
+    rooted at `root', caching every lookup.
+
+    NOTE: When `root' isn't the host's root, we parse its own etc/passwd and
+          etc/group instead of asking the host (which would be wrong for
+          --root installs, and can be slow if NSS is going out to LDAP or
+          whatever).  If the alternate root doesn't have those files yet,
+          we fall back to the host.
+
+    """
+    def __init__(self, root="/"):
+        self.root = root
+        self.users = None
+        self.groups = None
+        if os.path.realpath(root) != "/":
+            self.users = self._parse("passwd")
+            self.groups = self._parse("group")
+        self.cache = {}
+
+    def _parse(self, name):
+        """Returns a (name->id, id->name) pair of dicts from file `name' in
+        our root's etc dir, or None if it's not there.
+
+        """
+        try:
+            with open(os.path.join(self.root, "etc", name)) as f:
+                lines = f.readlines()
+        except OSError:
+            return None
+        ids = {}
+        names = {}
+        for line in lines:
+            fields = line.split(":")
+            if len(fields) < 3 or line.startswith("#"):
+                continue
+            try:
+                i = int(fields[2])
+            except ValueError:
+                continue
+            ids.setdefault(fields[0], i)
+            names.setdefault(i, fields[0])
+        return ids, names
+
+    def _lookup(self, kind, key):
+        try:
+            return self.cache[kind, key]
+        except KeyError:
+            pass
+        if kind in ("uid", "uname"):
+            table = self.users
+        else:
+            table = self.groups
+        ret = None
+        if table is not None:
+            ret = table[kind in ("uname", "gname")].get(key)
+        else:
+            try:
+                if kind == "uid":
+                    ret = pwd.getpwnam(key).pw_uid
+                elif kind == "uname":
+                    ret = pwd.getpwuid(key).pw_name
+                elif kind == "gid":
+                    ret = grp.getgrnam(key).gr_gid
+                else:
+                    ret = grp.getgrgid(key).gr_name
+            except (KeyError, OverflowError):
+                pass
+        self.cache[kind, key] = ret
+        return ret
+
+    def uid(self, name):
+        """Returns the uid for user `name', or None if there's no such user."""
+        return self._lookup("uid", name)
+
+    def gid(self, name):
+        """Returns the gid for group `name', or None if there's no such
+        group.
+
+        """
+        return self._lookup("gid", name)
+
+    def uname(self, uid):
+        """Returns the name of user `uid', or None if there's no such user."""
+        return self._lookup("uname", uid)
+
+    def gname(self, gid):
+        """Returns the name of group `gid', or None if there's no such
+        group.
+
+        """
+        return self._lookup("gname", gid)
+
+
+_idmaps = {}
+
+def idmap(root="/"):
+    """Returns the IdMap instance for `root', creating it the first time
+    around.  That way, each name only gets looked up once per run.
+
+    NOTE: The cached instance is thrown away if root's etc/passwd or
+          etc/group has changed (or shown up) since it was created (e.g.,
+          an earlier package in the same run installed them or added a
+          user).
+
+    """
+    stamp = []
+    for x in ("passwd", "group"):
+        try:
+            st = os.stat(os.path.join(root, "etc", x))
+            stamp.append((st.st_mtime_ns, st.st_ino))
+        except OSError:
+            stamp.append(None)
+    try:
+        ret, prev = _idmaps[root]
+        if prev == stamp:
+            return ret
+    except KeyError:
+        pass
+    ret = IdMap(root)
+    _idmaps[root] = ret, stamp
+    return ret